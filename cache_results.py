@@ -3,11 +3,108 @@
 """
 
 import argparse
+import concurrent.futures
+import fcntl
 import json
 import logging
 import os
 import shutil
-from typing import Optional
+import signal
+import socket
+import socketserver
+import sys
+import time
+from typing import Callable, Iterator, Optional
+
+# Default number of bytes to hold in memory while copying each file
+DEFAULT_FILE_BYTE_BUDGET = 1024 * 1024
+
+# The most bytes shutil.copyfile() holds in memory when the kernel can't copy the file for it
+COPYFILE_BUFFER_SIZE = getattr(shutil, 'COPY_BUFSIZE', 16 * 1024)
+
+# The list of cached files for makeflow use: the first and last lines are fixed, and each entry is on a line of its own
+FILE_LIST_FILE_NAME = 'cached_files_makeflow_list.json'
+FILE_LIST_FIRST_LINE = '{"FILE_LIST": ['
+FILE_LIST_LAST_LINE = ']}'
+
+# Index of the results files that were cached, so that they can be found without searching folders: each line is the
+# JSON path of a results file relative to the index's folder
+RESULT_INDEX_FILE_NAME = 'result_index.json'
+
+# The keys of results files whose lists are read one element at a time, and the number of characters read at a time
+RESULT_LIST_KEYS = ('container', 'containers', 'file', 'files')
+RESULTS_READ_BLOCK_SIZE = 64 * 1024
+
+# Options that select how this script runs instead of how results are cached; they're not sent to the resident service
+RUN_MODE_OPTIONS = ['batch', 'serve', 'submit']
+
+# Options holding a path, or colon separated paths, that are made absolute before they're sent to the caching service
+SERVICE_PATH_OPTIONS = ['results_file', 'cache_folder', 'result_index', 'extra_files']
+
+# The number of bytes read and written at a time when merging CSV files
+CSV_MERGE_BLOCK_SIZE = 1024 * 1024
+
+# The maximum number of containers whose files can be waiting to be copied, which limits the results held in memory
+MAX_PENDING_CONTAINERS = 64
+
+# The first and last lines of a file of several JSON records, which is written as a JSON array with a record on each line
+JSON_RECORDS_START = '[\n'
+JSON_RECORDS_END = ']\n'
+
+# The key of a path trie node that holds the path ending at that node
+PATH_TRIE_END = None
+
+
+def find_files(source_folder: str, file_name: str, search_depth: int = None, first_found_only: bool = False,
+               use_index: bool = True) -> list:
+    """Looks for files with the specified name in a folder tree
+    Arguments:
+        source_folder: the folder to search
+        file_name: the name of the files to find
+        search_depth: the maximum folder depth to search; None searches the entire tree
+        first_found_only: when True, the sub-folders of a folder containing the file aren't searched
+        use_index: when True and the folder has a result index, the files listed in the index are returned without
+                   searching
+    Return:
+        Returns a list of the paths of found files
+    Notes:
+        A search depth of less than 2 will not recurse into sub-folders; a search depth of 2 will only recurse into
+        immediate sub-folders and no deeper; a search depth of 3 will recurse into the sub-folders of sub-folders; and
+        so on. The folder is searched when a file listed in the result index doesn't exist
+    """
+    if use_index:
+        index_path = os.path.join(source_folder, RESULT_INDEX_FILE_NAME)
+        if os.path.isfile(index_path):
+            logging.debug("Using result index: '%s'", index_path)
+            indexed = [one_path for one_path in read_result_index(index_path) if os.path.basename(one_path) == file_name]
+            missing = [one_path for one_path in indexed if not os.path.isfile(one_path)]
+            if not missing:
+                return indexed
+            logging.warning("Searching folder '%s' since %s files in its result index don't exist, such as '%s'",
+                            source_folder, str(len(missing)), missing[0])
+
+    found = []
+    folders = [(source_folder, 1)]
+    while folders:
+        folder, depth = folders.pop()
+        sub_folders = []
+        folder_found = False
+        try:
+            with os.scandir(folder) as entries:
+                for one_entry in entries:
+                    if one_entry.name == file_name and one_entry.is_file():
+                        logging.debug("Found file: '%s'", one_entry.path)
+                        found.append(one_entry.path)
+                        folder_found = True
+                    elif (search_depth is None or depth < search_depth) and one_entry.is_dir():
+                        sub_folders.append((one_entry.path, depth + 1))
+        except (FileNotFoundError, NotADirectoryError, PermissionError) as ex:
+            logging.debug("Unable to search folder '%s': %s", folder, str(ex))
+            continue
+        if not (first_found_only and folder_found):
+            folders.extend(reversed(sub_folders))
+
+    return found
 
 
 def _find_results_files(source_path: str, search_depth: int = 2) -> list:
@@ -18,69 +115,200 @@ def _find_results_files(source_path: str, search_depth: int = 2) -> list:
     Return:
         Returns a list containing found files
     Notes:
-        A search depth of less than 2 will not recurse into sub-folders; a search depth of 2 will only recurse into
-        immediate sub-folders and no deeper; a search depth of 3 will recurse into the sub-folders of sub-folders; and
-        so on
+        See find_files() for how the search depth is used
     """
     res_name = 'results.json'
-    res_name_len = len(res_name)
-
-    # Common expression declared once outside of recursion
-    # Checks that the file name matches exactly the testing string (res_name)
-    name_check_passes = lambda name: name.endswith(res_name) and os.path.isdir(name[:-res_name_len])
 
     if not source_path:
         return []
 
-    # Declare embedded function to do the work
-    def perform_recursive_find(path: str, depth: int) -> list:
-        """Recursively finds results files
-        Arguments:
-            path: the path to check for results files
-            depth: the maximum folder depth to recurse (starting at 1)
-        Return:
-            Returns a list of found files
-        """
-        return_list = []
+    if os.path.isfile(source_path):
+        if os.path.basename(source_path) == res_name:
+            logging.debug("Result file check specified result file: '%s'", source_path)
+            return [source_path]
 
-        # Basic checks
-        if os.path.isfile(path):
-            if name_check_passes(path):
-                logging.debug("Result file check specified result file: '%s'", path)
-                return [path]
+        logging.debug("Result file check name is not valid: '%s'", source_path)
+        return []
 
-            logging.debug("Result file check name is not valid: '%s'", path)
-            return return_list
+    return find_files(source_path, res_name, search_depth)
 
-        # We only process folders after the above checks
-        if not os.path.isdir(path):
-            logging.debug("Error: result file check path is not a file or folder: '%s'", path)
-            return return_list
 
-        # Loop over current folder looking for other folders and for a results file
-        for one_name in os.listdir(path):
-            check_name = os.path.join(path, one_name)
-            if name_check_passes(check_name):
-                logging.debug("Found result file: '%s'", check_name)
-                return_list.append(check_name)
-            elif depth > 1 and os.path.isdir(check_name):
-                logging.debug("Searching folder for result files: '%s'", check_name)
-                found_results = perform_recursive_find(check_name, depth - 1)
-                if found_results:
-                    return_list.extend(found_results)
+def read_result_index(index_path: str) -> list:
+    """Reads the results files listed in a result index
+    Arguments:
+        index_path: the path of the index
+    Return:
+        Returns the list of paths of the results files, with the index's folder prepended
+    """
+    index_folder = os.path.dirname(index_path)
+    found = {}
+    for one_path in read_metadata_file(index_path):
+        found[os.path.join(index_folder, one_path)] = True
+    return list(found.keys())
 
-        return return_list
 
-    # Find those files!
-    return perform_recursive_find(source_path, search_depth)
+def _add_to_result_index(index_path: str, results_file: str, cache_folder: str) -> None:
+    """Adds a results file to a result index
+    Arguments:
+        index_path: the path of the index
+        results_file: the path of the results file to add
+        cache_folder: the folder the results were cached into
+    Notes:
+        The results file is recorded by its path relative to the parent of the cache folder, which is the layout that the
+        cached results are copied into next to the index
+    """
+    cache_parent = os.path.dirname(os.path.abspath(cache_folder.rstrip('/\\')))
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    _write_json_record(index_path, os.path.relpath(os.path.abspath(results_file), cache_parent), True)
 
 
-def _get_path_maps(maps_param: str) -> Optional[dict]:
-    """Parses the map parameter and returns a dictionary of mappings
+class PathMapper():
+    """Maps the starting folders of paths using the longest matching mapping"""
+
+    def __init__(self, path_maps: dict):
+        """Initializes class instance and compiles the mappings
+        Arguments:
+            path_maps: the dictionary of source folders and the folders they're mapped to
+        """
+        self.path_maps = path_maps
+        self.reverse_maps = {mapped: source for source, mapped in path_maps.items()}
+        self.source_trie = self._build_trie(path_maps.keys())
+        self.mapped_trie = self._build_trie(self.reverse_maps.keys())
+
+    @staticmethod
+    def _build_trie(folders) -> dict:
+        """Builds a trie of path components of the folders
+        Arguments:
+            folders: the folders to add to the trie
+        Return:
+            Returns the root node of the trie
+        """
+        root = {}
+        for one_folder in folders:
+            node = root
+            for component in one_folder.replace('\\', '/').split('/'):
+                node = node.setdefault(component, {})
+            node[PATH_TRIE_END] = one_folder
+        return root
+
+    @staticmethod
+    def _find_longest(trie: dict, file_path: str) -> Optional[tuple]:
+        """Finds the longest folder in the trie that starts the path
+        Arguments:
+            trie: the root node of the trie to search
+            file_path: the path to match
+        Return:
+            Returns a tuple of the matched folder and its length in the path, or None if there isn't a match
+        Notes:
+            Partial folder names don't match; for example, '/home/foo' doesn't match '/home/foobar'
+        """
+        search_path = file_path.replace('\\', '/')
+        found = None
+        node = trie
+        start = 0
+        while True:
+            end = search_path.find('/', start)
+            if end < 0:
+                end = len(search_path)
+            node = node.get(search_path[start:end])
+            if node is None:
+                break
+            if PATH_TRIE_END in node:
+                found = (node[PATH_TRIE_END], end)
+            if end >= len(search_path):
+                break
+            start = end + 1
+        return found
+
+    def map_path(self, file_path: str) -> str:
+        """Maps the start of the path to its replacement
+        Arguments:
+            file_path: the path to map
+        Return:
+            Returns the mapped path, or the original path if there isn't a mapping or the path is already mapped
+        """
+        match = self._find_longest(self.source_trie, file_path)
+        if match is None:
+            logging.debug("No mapping found for: '%s'", file_path)
+            return file_path
+        source_folder, source_len = match
+        if source_len == len(file_path):
+            return file_path
+        # Check for files that are already mapped
+        mapped_folder = self.path_maps[source_folder]
+        if file_path.startswith(mapped_folder) and file_path[len(mapped_folder):len(mapped_folder) + 1] in ['/', '\\']:
+            return file_path
+        new_path = os.path.join(mapped_folder, file_path[source_len + 1:])
+        logging.debug("Mapping file '%s' to '%s'", file_path, new_path)
+        return new_path
+
+    def unmap_path(self, file_path: str) -> str:
+        """Maps the start of a mapped path back to its source folder
+        Arguments:
+            file_path: the mapped path
+        Return:
+            Returns the source path, or the original path if it doesn't start with a mapped folder
+        """
+        match = self._find_longest(self.mapped_trie, file_path)
+        if match is None:
+            return file_path
+        mapped_folder, mapped_len = match
+        if mapped_len == len(file_path):
+            return self.reverse_maps[mapped_folder]
+        return os.path.join(self.reverse_maps[mapped_folder], file_path[mapped_len + 1:])
+
+    def strip_mapped_path(self, file_path: str) -> str:
+        """Strips the mapped folder from the start of the path
+        Arguments:
+            file_path: the mapped path
+        Return:
+            Returns the path relative to the mapped folder, an empty string if the path is the mapped folder, or the
+            original path if it doesn't start with a mapped folder
+        """
+        match = self._find_longest(self.mapped_trie, file_path)
+        if match is None:
+            logging.debug("No mapped path found for: '%s'", file_path)
+            return file_path
+        mapped_len = match[1]
+        if mapped_len == len(file_path):
+            logging.debug("Full path match for stripping folder mapping, returning empty string")
+            return ""
+        return file_path[mapped_len + 1:]
+
+    def map_paths(self, file_paths: list) -> list:
+        """Maps a list of paths
+        Arguments:
+            file_paths: the paths to map
+        Return:
+            Returns the list of mapped paths
+        """
+        return [self.map_path(one_path) for one_path in file_paths]
+
+    def unmap_paths(self, file_paths: list) -> list:
+        """Maps a list of mapped paths back to their source folders
+        Arguments:
+            file_paths: the mapped paths
+        Return:
+            Returns the list of source paths
+        """
+        return [self.unmap_path(one_path) for one_path in file_paths]
+
+    def strip_mapped_paths(self, file_paths: list) -> list:
+        """Strips the mapped folders from a list of paths
+        Arguments:
+            file_paths: the mapped paths
+        Return:
+            Returns the list of stripped paths
+        """
+        return [self.strip_mapped_path(one_path) for one_path in file_paths]
+
+
+def _get_path_maps(maps_param: str) -> Optional[PathMapper]:
+    """Parses the map parameter and returns the compiled mappings
     Arguments:
-        maps_param: the parameter to parse into a mapping dictionary
+        maps_param: the parameter to parse into mappings
     Return:
-        A dict of mappings of they're found and valid, or None
+        A PathMapper instance of the mappings if they're found and valid, or None
     """
     if not maps_param:
         return None
@@ -104,7 +332,7 @@ def _get_path_maps(maps_param: str) -> Optional[dict]:
 
     if not path_maps:
         logging.info("Path mappings specified but none were found")
-    return path_maps if path_maps else None
+    return PathMapper(path_maps) if path_maps else None
 
 
 def _check_paths_errors(file_path: str, dir_path: str) -> str:
@@ -123,41 +351,16 @@ def _check_paths_errors(file_path: str, dir_path: str) -> str:
     return error_msg if error_msg else None
 
 
-def _combine_results(source_results: list, new_results: list) -> list:
-    """Combines the specified dictionaries
-    Arguments:
-        source_results: the source dictionary to merge into
-        new_results: the dictionary to add
-    Return:
-        Returns the combined dictionary
-    Notes:
-        Runtime parameters that evaluate to False are transparently handled (for example, receiving an empty dict
-        runtime parameter will not raise an error and will return a list - which may also be empty)
-    """
-    if not source_results:
-        source_results = []
-
-    # Handle edge cases
-    if not source_results:
-        if not new_results:
-            return []
-        return new_results
-    if not new_results:
-        return source_results
-
-    return source_results + new_results
-
-
-def _map_path(file_path: str, path_maps: dict = None) -> str:
-    """Looks up the path in the dictionary and maps that portion of the path to its replacement
+def _map_path(file_path: str, path_maps: PathMapper = None) -> str:
+    """Looks up the path in the mappings and maps that portion of the path to its replacement
     Arguments:
         file_path: the path to look into modifying
-        path_maps: the dictionary of path mappings
+        path_maps: the path mappings
     Return:
         The path to use. This is the original path if the starting path particle is not found in the mappings.
-        Otherwise, the start of the path will be replaced as specified by the associated path_map value.
+        Otherwise, the start of the path will be replaced as specified by the associated mapping.
     Notes:
-        No checks for best (maximal) fit is made; the first found match is the one that's used.
+        The longest matching mapping is the one that's used.
         White space is maintained; for example, '/usr/bin:/usr/local/bin ' will change '/usr/bin/x.sh' to
         '/usr/local/bin /x.sh'.
         Partial folder name mappings are not supported; for example, the path
@@ -166,59 +369,91 @@ def _map_path(file_path: str, path_maps: dict = None) -> str:
     if not path_maps:
         return file_path
 
-    # Loop through looking for a good match
-    file_path_len = len(file_path)
-    for one_path in path_maps:
-        if file_path.startswith(one_path):
-            path_len = len(one_path)
-            if path_len == file_path_len:
-                return file_path
-            # Check for files that are already mapped
-            if file_path.startswith(path_maps[one_path]):
-                sep_char = file_path[len(path_maps[one_path])]
-                if sep_char in ['/', '\\']:
-                    return file_path
-            # Perform the mapping
-            if path_len < file_path_len:
-                sep_char = file_path[path_len]
-                if sep_char in ['/', '\\']:
-                    new_path = os.path.join(path_maps[one_path], file_path[path_len + 1:])
-                    logging.info("Mapping file '%s' to '%s'", file_path, new_path)
-                    return new_path
-
-    logging.debug("No mapping found for: '%s", file_path)
-    return file_path
-
-
-def _strip_mapped_path(file_path: str, path_maps: dict = None) -> str:
+    return path_maps.map_path(file_path)
+
+
+def _strip_mapped_path(file_path: str, path_maps: PathMapper = None) -> str:
     """Searches the path maps for a previously mapped path and strips it from the source path.
-       The values in the path maps are used for comparison, not the keys.
+       The mapped folders are used for comparison, not the source folders.
     Arguments:
         file_path: the path to look into modifying
-        path_maps: the dictionary of path mappings
+        path_maps: the path mappings
     Return:
         The path with the starting matched part stripped when a match is found, otherwise the original file_path
     """
     if not path_maps:
         return file_path
 
-    # Loop through looking for a matching path
-    file_path_len = len(file_path)
-    for _, one_path in path_maps.items():
-        if file_path.startswith(one_path):
-            path_len = len(one_path)
-            if path_len == file_path_len:
-                logging.debug("Full path match for stripping folder mapping, returning empty string")
-                return ""
-            if path_len < file_path_len:
-                sep_char = file_path[path_len]
-                if sep_char in ['/', '\\']:
-                    new_path = file_path[path_len + 1:]
-                    logging.info("Stripping mapped file '%s' to '%s'", file_path, new_path)
-                    return new_path
-
-    logging.debug("No mapped path found for: '%s", file_path)
-    return file_path
+    return path_maps.strip_mapped_path(file_path)
+
+
+def _write_json_record(file_path: str, record, append: bool) -> None:
+    """Writes a record as a line of JSON while holding a lock on the file
+    Arguments:
+        file_path: the path of the file to write to
+        record: the record to write
+        append: when True the record is added to the end of the file, otherwise it replaces the file's contents
+    Notes:
+        The file is always one valid JSON document: a file with one record holds only that record, and a file with more
+        records holds a JSON array of them with one record on each line. The first append to a file rewrites it as an
+        array; later appends only replace the array's closing line
+    """
+    line = json.dumps(record)
+    with open(file_path, "a+") as out_file:
+        fcntl.flock(out_file.fileno(), fcntl.LOCK_EX)
+        file_size = os.fstat(out_file.fileno()).st_size
+        if not append or file_size == 0:
+            out_file.truncate(0)
+            out_file.write(line + '\n')
+            return
+        out_file.seek(0)
+        if out_file.readline() == JSON_RECORDS_START:
+            out_file.truncate(file_size - len(JSON_RECORDS_END))
+            out_file.write(',\n' + line + '\n' + JSON_RECORDS_END)
+            return
+        out_file.seek(0)
+        records = _decode_json_records(out_file.read())
+        out_file.truncate(0)
+        out_file.write(JSON_RECORDS_START + ',\n'.join([json.dumps(one_record) for one_record in records] + [line]) +
+                       '\n' + JSON_RECORDS_END)
+
+
+def read_metadata_file(metadata_file: str) -> list:
+    """Reads the metadata records of a file
+    Arguments:
+        metadata_file: the path of the file to read
+    Return:
+        Returns the list of records in the file
+    Notes:
+        Files written by _write_json_record() are read, as are files of JSON documents separated by whitespace or commas
+    """
+    with open(metadata_file, "r") as in_file:
+        fcntl.flock(in_file.fileno(), fcntl.LOCK_SH)
+        text = in_file.read()
+
+    if text.startswith(JSON_RECORDS_START):
+        return json.loads(text)
+    return _decode_json_records(text)
+
+
+def _decode_json_records(text: str) -> list:
+    """Decodes JSON documents separated by whitespace or commas
+    Arguments:
+        text: the text to decode
+    Return:
+        Returns the list of decoded documents
+    """
+    decoder = json.JSONDecoder()
+    records = []
+    position = 0
+    while True:
+        while position < len(text) and text[position] in ' \t\r\n,':
+            position += 1
+        if position >= len(text):
+            break
+        record, position = decoder.raw_decode(text, position)
+        records.append(record)
+    return records
 
 
 def _save_result_metadata(metadata_file: str, metadata: dict) -> None:
@@ -229,8 +464,8 @@ def _save_result_metadata(metadata_file: str, metadata: dict) -> None:
     Notes:
         Looks for a 'replace' key to determine if the metadata is appended to existing metadata or not (as
         specified by the file name passed in). If 'replace' is missing, or evaluates to False, any existing metadata
-        is replaced. Otherwise the metadata is appended to the end of the file - the current file contents are not
-        loaded first.
+        is replaced. Otherwise the metadata is appended to the end of the file as another record - the current file
+        contents are not loaded first.
         A 'data' key is looked for as an indication of what metadata to save. If a 'data' key isn't specified, the
         entire metadata parameter is written to the file.
     """
@@ -243,24 +478,20 @@ def _save_result_metadata(metadata_file: str, metadata: dict) -> None:
         if 'replace' in metadata:
             append = not metadata['replace']
 
-    with open(metadata_file, "a" if append else "w") as out_file:
-        if append:
-            out_file.write(',')
-        json.dump(write_metadata, out_file, indent=2)
+    _write_json_record(metadata_file, write_metadata, append)
 
 
-def cache_files(result_files: list, cache_dir: str, path_maps: dict = None, file_handlers: dict = None) -> list:
-    """Copies any files found in the results to the cache location
+def _prepare_copy_list(result_files: list, cache_dir: str, path_maps: PathMapper = None) -> list:
+    """Builds the list of files to copy from the result files
     Arguments:
         result_files: the list of file dictionary to copy
         cache_dir: the location to copy the files to
         path_maps: path mappings to use on file paths
-        file_handlers: special handling of files instead of normal copy
     Return:
-        Returns a list of copied files
+        Returns a list of dicts with the source ('src') and destination ('dst') paths, and any 'metadata' of the files
+    Exceptions:
+        Raises RuntimeError if any of the files are missing
     """
-    # Loop through and build up a list of files to copy
-    copied_files = []
     copy_list = []
     total_count = 0
     problem_count = 0
@@ -294,7 +525,52 @@ def cache_files(result_files: list, cache_dir: str, path_maps: dict = None, file
     if skip_count:
         logging.info("Skipping %s entries that are missing the 'path' key", str(skip_count))
 
-    # Copy the files
+    return copy_list
+
+
+def _copy_file(source_path: str, dest_path: str, metadata: dict = None, file_byte_budget: int = DEFAULT_FILE_BYTE_BUDGET) -> str:
+    """Copies one file and saves any metadata associated with it
+    Arguments:
+        source_path: the path of the file to copy
+        dest_path: the path to copy the file to
+        metadata: optional metadata to save alongside the copied file
+        file_byte_budget: the maximum number of bytes to hold in memory while copying the file
+    Return:
+        Returns the destination path
+    Notes:
+        The file is copied with shutil.copyfile(), which lets the kernel copy the data where it can, unless the budget
+        is smaller than the buffer it would otherwise use
+    """
+    logging.debug("Copy file: '%s' to '%s'", str(source_path), str(dest_path))
+    if file_byte_budget >= COPYFILE_BUFFER_SIZE:
+        shutil.copyfile(source_path, dest_path)
+    else:
+        with open(source_path, 'rb') as in_file:
+            with open(dest_path, 'wb') as out_file:
+                shutil.copyfileobj(in_file, out_file, file_byte_budget)
+    if metadata:
+        metadata_file_name = os.path.splitext(dest_path)[0] + '.json'
+        logging.debug("Saving metadata to file: %s", metadata_file_name)
+        _save_result_metadata(metadata_file_name, metadata)
+    return dest_path
+
+
+def _start_copies(copy_list: list, cache_dir: str, file_handlers: dict = None, executor: concurrent.futures.Executor = None,
+                  file_byte_budget: int = DEFAULT_FILE_BYTE_BUDGET) -> list:
+    """Starts copying the files in the list
+    Arguments:
+        copy_list: the list of files to copy as returned by _prepare_copy_list()
+        cache_dir: the location to copy the files to
+        file_handlers: special handling of files instead of normal copy
+        executor: optional executor to perform the copies on; files are copied before returning if not specified
+        file_byte_budget: the maximum number of bytes to hold in memory while copying each file
+    Return:
+        Returns a list of pending copies to pass to _finish_copies(): each entry is either a future or a list of files
+        returned by a special file handler
+    Notes:
+        Special file handlers are always called in list order on the calling thread since they may update shared files
+    """
+    pending = []
     for one_file in copy_list:
         file_ext = os.path.splitext(one_file['src'])[1]
         file_metadata = one_file['metadata'] if 'metadata' in one_file else None
@@ -303,25 +579,60 @@ def cache_files(result_files: list, cache_dir: str, path_maps: dict = None, file
             logging.debug("Special handling for file: %s (%s)", file_ext, one_file['src'])
             handled_files = file_handlers[file_ext](one_file['src'], cache_dir, file_metadata)
             if isinstance(handled_files, list):
-                for one_handled_file in handled_files:
-                    if one_handled_file not in copied_files:
-                        copied_files.append(one_handled_file)
+                pending.append(handled_files)
             elif handled_files is not None:
                 logging.warning("Invalid return from special file handler. Ignoring results")
+        elif executor:
+            pending.append(executor.submit(_copy_file, one_file['src'], one_file['dst'], file_metadata, file_byte_budget))
         else:
-            logging.debug("Copy file: '%s' to '%s'", str(one_file['src']), str(one_file['dst']))
-            shutil.copyfile(one_file['src'], one_file['dst'])
-            if file_metadata:
-                metadata_file_name = os.path.splitext(one_file['dst'])[0] + '.json'
-                logging.debug("Saving metadata to file: %s", metadata_file_name)
-                _save_result_metadata(metadata_file_name, file_metadata)
-            copied_files.append(one_file['dst'])
+            pending.append(_copy_file(one_file['src'], one_file['dst'], file_metadata, file_byte_budget))
 
+    return pending
+
+
+def _finish_copies(pending: list) -> list:
+    """Waits for the pending copies to finish
+    Arguments:
+        pending: the list of pending copies returned by _start_copies()
+    Return:
+        Returns the list of copied files, in the order the copies were started
+    Exceptions:
+        Any exception raised while copying a file is re-raised
+    """
+    copied_files = []
+    for one_pending in pending:
+        if isinstance(one_pending, concurrent.futures.Future):
+            copied_files.append(one_pending.result())
+        elif isinstance(one_pending, list):
+            for one_handled_file in one_pending:
+                if one_handled_file not in copied_files:
+                    copied_files.append(one_handled_file)
+        else:
+            copied_files.append(one_pending)
 
     return copied_files
 
 
-def cache_containers(container_list: list, cache_dir: str, path_maps: dict = None, file_handlers: dict = None) -> list:
+def cache_files(result_files: list, cache_dir: str, path_maps: PathMapper = None, file_handlers: dict = None,
+                executor: concurrent.futures.Executor = None, file_byte_budget: int = DEFAULT_FILE_BYTE_BUDGET) -> list:
+    """Copies any files found in the results to the cache location
+    Arguments:
+        result_files: the list of file dictionary to copy
+        cache_dir: the location to copy the files to
+        path_maps: path mappings to use on file paths
+        file_handlers: special handling of files instead of normal copy
+        executor: optional executor to perform the copies on
+        file_byte_budget: the maximum number of bytes to hold in memory while copying each file
+    Return:
+        Returns a list of copied files
+    """
+    copy_list = _prepare_copy_list(result_files, cache_dir, path_maps)
+    return _finish_copies(_start_copies(copy_list, cache_dir, file_handlers, executor, file_byte_budget))
+
+
+def cache_containers(container_list: list, cache_dir: str, path_maps: PathMapper = None, file_handlers: dict = None,
+                     executor: concurrent.futures.Executor = None, file_byte_budget: int = DEFAULT_FILE_BYTE_BUDGET,
+                     on_cached: Callable[[dict], None] = None) -> list:
     """Searches the list of containers for files to copy and copies them to a folder in the cache_dir.
        The folders are named after the container name.
     Arguments:
@@ -329,11 +640,27 @@ def cache_containers(container_list: list, cache_dir: str, path_maps: dict = Non
         cache_dir: the location to copy the files to
         path_maps: path mappings to use on file paths
         file_handlers: special handling of files instead of normal copy
+        executor: optional executor to perform the copies on
+        file_byte_budget: the maximum number of bytes to hold in memory while copying each file
+        on_cached: optional function called with each container's entry of the returned list once its files are copied
     Return:
         Returns a list of copied files
+    Notes:
+        When an executor is specified, the files of up to MAX_PENDING_CONTAINERS containers are copied concurrently. The
+        container list can be an iterator that reads the containers as they're needed
     """
+    pending_list = []
     file_list = []
 
+    def finish_oldest() -> None:
+        """Waits for the copies of the oldest pending container to finish"""
+        pending, container_metadata_path = pending_list.pop(0)
+        copied_files = _finish_copies(pending)
+        if copied_files:
+            file_list.append({'files': copied_files, 'metadata_path': container_metadata_path})
+            if on_cached:
+                on_cached(file_list[-1])
+
     for container in container_list:
         if 'name' in container:
             working_dir = os.path.join(cache_dir, container['name'])
@@ -352,49 +679,52 @@ def cache_containers(container_list: list, cache_dir: str, path_maps: dict = Non
             # Copy files
             for key in ['file', 'files']:
                 if key in container:
-                    copied_files = cache_files(container[key], working_dir, path_maps, file_handlers)
-                    if copied_files:
-                        file_list.append({'files': copied_files, 'metadata_path': container_metadata_path})
+                    copy_list = _prepare_copy_list(container[key], working_dir, path_maps)
+                    pending = _start_copies(copy_list, working_dir, file_handlers, executor, file_byte_budget)
+                    pending_list.append((pending, container_metadata_path))
                     break
 
+            if len(pending_list) >= MAX_PENDING_CONTAINERS:
+                finish_oldest()
+
+    while pending_list:
+        finish_oldest()
+
     return file_list
 
 
 def _append_metadata_to_file(metadata: dict, metadata_file: str) -> None:
-    """Appends metadata to a file as a JSON array element
+    """Appends metadata to a file as another record (see _write_json_record())
     Arguments:
         metadata: the metadata to store in the file
         metadata_file: path to the metadata file to save to
     """
     write_metadata = metadata if 'data' not in metadata else metadata['data']
 
-    if not os.path.exists(metadata_file):
-        with open(metadata_file, "w") as out_file:
-            out_file.write("{\n[\n")
-            json.dump(write_metadata, out_file, indent=2)
-            out_file.write("]\n}\n")
-    else:
-        reverse_find_chars = '}]}'
-        with open(metadata_file, "a+") as out_file:
-            try:
-                for one_char in reverse_find_chars:
-                    found_char = False
-                    while not found_char:
-                        os.lseek(out_file.fileno(), -1, os.SEEK_END)
-                        if out_file.buffer.peek().decode('utf-8').startswith(one_char):
-                            found_char = True
-            except Exception as ex:
-                msg = "Unable to find end of metadata to append to in file: '%s'" % metadata_file
-                logging.error(msg)
-                if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
-                    logging.error("Exception caught")
-                raise RuntimeError("Unable to append metadata to file") from ex
+    _write_json_record(metadata_file, write_metadata, True)
 
-            # Truncate the file and write out the new metadata
-            out_file.truncate()
-            out_file.write("},\n")
-            json.dump(write_metadata, out_file, indent=2)
-            out_file.write("]\n}\n")
+
+def _skip_csv_header_lines(in_file, header_lines: int) -> bytes:
+    """Reads past the header lines of a CSV file opened in binary mode
+    Arguments:
+        in_file: the file to read from
+        header_lines: the number of header lines to skip
+    Return:
+        Returns the data that was read after the headers, which may be empty even when there's more data to read
+    """
+    if header_lines <= 0:
+        return in_file.read(CSV_MERGE_BLOCK_SIZE)
+    block = b''
+    while header_lines > 0:
+        line_end = block.find(b'\n')
+        if line_end >= 0:
+            block = block[line_end + 1:]
+            header_lines -= 1
+            continue
+        block = in_file.read(CSV_MERGE_BLOCK_SIZE)
+        if not block:
+            break
+    return block
 
 
 def _handle_csv_merge(csv_path: str, cache_dir: str, metadata: dict = None, header_lines: int = 0) -> list:
@@ -406,24 +736,39 @@ def _handle_csv_merge(csv_path: str, cache_dir: str, metadata: dict = None, head
         header_lines: the number of header lines in the source CSV file (headers are discarded after first CSV file)
     Exceptions:
         Exceptions may be raised when accessing the file system or reading the CSV file
+    Notes:
+        The destination file is locked while the data is appended to it so that concurrent merges into the same file
+        don't interleave or lose rows
     """
     # Generate the destination filename
     dest_file = os.path.join(cache_dir, os.path.basename(csv_path))
 
-    # If the destination isn't there, just copy the file. Otherwise assume it's configured correctly and copy content
-    if not os.path.exists(dest_file):
-        shutil.copyfile(csv_path, dest_file)
-    else:
-        with open(dest_file, "a") as out_file:
-            # We don't use shutil.copyfileobj to allow for ending line break (aka: newline, carriage return, etc)
-            with open(csv_path, "r") as in_file:
-                for line in in_file:
-                    # Skip over headers
-                    if header_lines > 0:
-                        header_lines -= 1
-                        continue
-                    # Write the data line: ensure we have one newline
-                    out_file.write(line.strip('\n') + '\n')
+    with open(dest_file, "ab") as out_file:
+        fcntl.flock(out_file.fileno(), fcntl.LOCK_EX)
+        with open(csv_path, "rb") as in_file:
+            # If the destination is empty, just copy the file. Otherwise assume it's configured correctly and copy content
+            dest_size = os.fstat(out_file.fileno()).st_size
+            if dest_size == 0:
+                shutil.copyfileobj(in_file, out_file, CSV_MERGE_BLOCK_SIZE)
+            else:
+                # Make sure the appended data starts on a line of its own
+                with open(dest_file, "rb") as dest_check:
+                    dest_check.seek(dest_size - 1)
+                    last_byte = dest_check.read(1)
+                block = _skip_csv_header_lines(in_file, header_lines)
+                if last_byte != b'\n':
+                    out_file.write(b'\n')
+                    last_byte = b'\n'
+                while True:
+                    if block:
+                        out_file.write(block)
+                        last_byte = block[-1:]
+                    block = in_file.read(CSV_MERGE_BLOCK_SIZE)
+                    if not block:
+                        break
+                # Write the data: ensure we end with one newline
+                if last_byte != b'\n':
+                    out_file.write(b'\n')
 
     # If we have metadata merge it with existing metadata
     if metadata:
@@ -448,46 +793,18 @@ def _check_get_parameters(args: argparse.Namespace) -> dict:
         logging.error(error_msg)
         raise RuntimeError(error_msg)
 
-    # Load the contents of the results
-    with open(args.results_file, "r") as in_file:
-        results = json.load(in_file)
-
     # Simple parameter setup
-    return_dict = {'result_containers': None, 'result_files': None, 'cache_dir': None}
+    return_dict = {'results_files': None, 'cache_dir': None}
     if args.extra_files:
         return_dict['extra_files'] = []
         for one_file in args.extra_files.split(':'):
             return_dict['extra_files'].append({'path': one_file})
 
-    # Loop through and copy any files (without sub-paths)
+    # The results files are read while caching
     if os.path.isdir(args.results_file):
-        results_files = _find_results_files(args.results_file)
+        return_dict['results_files'] = _find_results_files(args.results_file)
     else:
-        results_files = [args.results_file]
-
-    for one_file in results_files:
-        with open(one_file, "r") as in_file:
-            results = json.load(in_file)
-
-        # Look for containers first
-        found_containers = None
-        for key in ['container', 'containers']:
-            if key in results:
-                found_containers = results[key]
-                return_dict['result_containers'] = _combine_results(return_dict['result_containers'], found_containers)
-                break
-        if found_containers is None:
-            logging.info("No containers found in results: '%s'", one_file)
-
-        # Look file top-level files
-        found_files = None
-        for key in ['file', 'files']:
-            if key in results:
-                found_files = results[key]
-                return_dict['result_files'] = _combine_results(return_dict['result_files'], found_files)
-                break
-        if found_files is None:
-            logging.info("No top-level files found in results: '%s'", one_file)
+        return_dict['results_files'] = [args.results_file]
 
     # Prepare the mappings
     mappings = None
@@ -504,73 +821,505 @@ def _check_get_parameters(args: argparse.Namespace) -> dict:
     return_dict['cache_dir'] = args.cache_folder
     return_dict['path_maps'] = mappings
     return_dict['file_handlers'] = file_handlers if file_handlers else None
+    return_dict['jobs'] = max(int(args.jobs), 1)
+    return_dict['file_byte_budget'] = max(int(args.file_byte_budget), 1)
 
     return return_dict
 
 
-def cache_results(result_containers: list, result_files: list, cache_dir: str, extra_files: list = None, path_maps: dict = None,
-                  file_handlers: dict = None) -> None:
+class FileListWriter():
+    """Writes the list of cached files for makeflow one entry at a time"""
+
+    def __init__(self, file_path: str, path_maps: PathMapper = None):
+        """Initializes class instance and starts the list
+        Arguments:
+            file_path: the path of the file to write
+            path_maps: path mappings used when the files were cached
+        """
+        self.path_maps = path_maps
+        self.separator = ''
+        self.out_file = open(file_path, 'w')
+        self.out_file.write(FILE_LIST_FIRST_LINE + '\n')
+        self.out_file.flush()
+
+    def write_set(self, one_set: dict) -> None:
+        """Adds a set of cached files to the list and flushes them to disk
+        Arguments:
+            one_set: a dict with the list of cached 'files' and an optional 'metadata_path' for them
+        """
+        if 'metadata_path' in one_set and one_set['metadata_path']:
+            file_metadata = {
+                'METADATA': one_set['metadata_path'],
+                'METADATA_NAME': _strip_mapped_path(one_set['metadata_path'], self.path_maps),
+                'BASE_METADATA_NAME': os.path.splitext(os.path.basename(one_set['metadata_path']))[0]
+            }
+        else:
+            file_metadata = {
+                'METADATA': "",
+                'METADATA_NAME': "",
+                'BASE_METADATA_NAME': ""
+            }
+
+        file_names = self.path_maps.strip_mapped_paths(one_set['files']) if self.path_maps else one_set['files']
+        for one_file, file_name in zip(one_set['files'], file_names):
+            self.write_entry({**{
+                'PATH': one_file,
+                'NAME': file_name,
+                'BASE_IMAGE_NAME': os.path.splitext(os.path.basename(one_file))[0]
+            }, **file_metadata})
+        self.out_file.flush()
+
+    def write_entry(self, entry: dict) -> None:
+        """Adds one entry to the list
+        Arguments:
+            entry: the entry to add
+        Notes:
+            Each entry is written as JSON on a line of its own (JSON escapes any line breaks in the values) so that the
+            list can be read one entry at a time. The entry isn't flushed to disk
+        """
+        self.out_file.write(self.separator + json.dumps(entry) + '\n')
+        self.separator = ','
+
+    def close(self) -> None:
+        """Ends the list and closes the file"""
+        self.out_file.write(FILE_LIST_LAST_LINE + '\n')
+        self.out_file.close()
+
+
+def _parse_file_list_line(one_line: str) -> Optional[dict]:
+    """Parses a line of a list of cached files written by FileListWriter
+    Arguments:
+        one_line: the line to parse
+    Return:
+        Returns the entry on the line, or None if the line doesn't have an entry
+    """
+    one_line = one_line.strip().lstrip(',')
+    if not one_line or one_line in (FILE_LIST_FIRST_LINE, FILE_LIST_LAST_LINE):
+        return None
+    return json.loads(one_line)
+
+
+def read_file_list(file_path: str) -> Iterator[dict]:
+    """Reads the entries of a list of cached files one at a time
+    Arguments:
+        file_path: the path of the file to read
+    Return:
+        Yields each entry of the list
+    Exceptions:
+        Raises ValueError if the file doesn't have a 'FILE_LIST'
+    Notes:
+        Lists written by FileListWriter are read a line at a time; other JSON files with a 'FILE_LIST' are loaded whole
+    """
+    with open(file_path, 'r') as in_file:
+        if in_file.readline().strip() == FILE_LIST_FIRST_LINE:
+            for one_line in in_file:
+                entry = _parse_file_list_line(one_line)
+                if entry is not None:
+                    yield entry
+            return
+
+        in_file.seek(0)
+        file_list = json.load(in_file)
+    if 'FILE_LIST' not in file_list:
+        raise ValueError("No FILE_LIST found in '%s'" % file_path)
+    yield from file_list['FILE_LIST']
+
+
+class _JsonStreamReader():
+    """Reads the values of a JSON document from a file as they're needed instead of loading the entire document"""
+
+    def __init__(self, in_file):
+        """Initializes class instance
+        Arguments:
+            in_file: the file to read from
+        """
+        self.in_file = in_file
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.at_end = False
+
+    def _read_more(self) -> bool:
+        """Adds more of the file to the unread characters
+        Return:
+            Returns False if the end of the file was already reached
+        """
+        if self.at_end:
+            return False
+        # Read at least as much as is already buffered so that a large value is parsed a small number of times
+        unread = self.buffer[self.position:]
+        data = self.in_file.read(max(RESULTS_READ_BLOCK_SIZE, len(unread)))
+        if not data:
+            self.at_end = True
+        self.buffer = unread + data
+        self.position = 0
+        return True
+
+    def next_char(self) -> str:
+        """Returns the next character that isn't white space and moves past it
+        Exceptions:
+            Raises ValueError if the end of the file is reached
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+                self.position += 1
+            if self.position < len(self.buffer):
+                self.position += 1
+                return self.buffer[self.position - 1]
+            if not self._read_more():
+                raise ValueError("Unexpected end of JSON document")
+
+    def peek_char(self) -> str:
+        """Returns the next character that isn't white space without moving past it"""
+        found = self.next_char()
+        self.position -= 1
+        return found
+
+    def expect_char(self, expected: str) -> None:
+        """Moves past the next character that isn't white space
+        Arguments:
+            expected: the character that's expected
+        Exceptions:
+            Raises ValueError if a different character is found
+        """
+        found = self.next_char()
+        if found != expected:
+            raise ValueError("Expected '%s' in JSON document but found '%s'" % (expected, found))
+
+    def at_closing_char(self, closing: str) -> bool:
+        """Moves past the separator after a value of an object or list
+        Arguments:
+            closing: the character that closes the object or list
+        Return:
+            Returns True if the object or list was closed and False if another value follows
+        Exceptions:
+            Raises ValueError if neither a separator nor the closing character is found
+        """
+        found = self.next_char()
+        if found == closing:
+            return True
+        if found != ',':
+            raise ValueError("Expected ',' or '%s' in JSON document but found '%s'" % (closing, found))
+        return False
+
+    def next_value(self):
+        """Returns the next value in the document and moves past it"""
+        self.peek_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number may continue in the part of the file that hasn't been read yet
+                is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                if self.at_end or not is_number or self.buffer[end:].lstrip('0123456789.eE+-'):
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.at_end:
+                    raise
+            self._read_more()
+
+
+def iter_results(results_file: str, list_keys: tuple = RESULT_LIST_KEYS) -> Iterator[tuple]:
+    """Reads the values in a results file one at a time
+    Arguments:
+        results_file: the path of the results file to read
+        list_keys: the keys whose lists are returned one element at a time
+    Return:
+        Yields a (key, value) tuple for each top-level key of the results, except that each element of the lists of the
+        list_keys is returned as a value of its own
+    Exceptions:
+        Raises ValueError if the file isn't a JSON object
+    Notes:
+        Only one value is held in memory at a time, so the number of containers and files doesn't change the memory used
+    """
+    with open(results_file, 'r') as in_file:
+        reader = _JsonStreamReader(in_file)
+        reader.expect_char('{')
+        if reader.peek_char() == '}':
+            return
+        while True:
+            key = reader.next_value()
+            reader.expect_char(':')
+            if key in list_keys and reader.peek_char() == '[':
+                reader.expect_char('[')
+                if reader.peek_char() == ']':
+                    reader.expect_char(']')
+                else:
+                    while True:
+                        yield key, reader.next_value()
+                        if reader.at_closing_char(']'):
+                            break
+            else:
+                yield key, reader.next_value()
+            if reader.at_closing_char('}'):
+                break
+
+
+def follow_file_list(file_path: str, is_finished: Callable[[], bool], poll_sec: float = 1.0) -> Iterator[list]:
+    """Reads the entries of a list of cached files while it's being written by FileListWriter
+    Arguments:
+        file_path: the path of the file to read
+        is_finished: function returning True once nothing more will be written to the file
+        poll_sec: the number of seconds to wait before checking the file for new entries
+    Return:
+        Yields lists of the entries found each time new entries are written
+    Notes:
+        Reading stops when the end of the list is found, or when is_finished() returns True and there aren't any new
+        entries to read
+    """
+    position = 0
+    partial_line = ''
+    while True:
+        finished = is_finished()
+        new_entries = []
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as in_file:
+                in_file.seek(position)
+                partial_line += in_file.read()
+                position = in_file.tell()
+            lines = partial_line.split('\n')
+            partial_line = lines.pop()
+            for one_line in lines:
+                if one_line.strip() == FILE_LIST_LAST_LINE:
+                    finished = True
+                    break
+                entry = _parse_file_list_line(one_line)
+                if entry is not None:
+                    new_entries.append(entry)
+        if new_entries:
+            yield new_entries
+        if finished:
+            return
+        time.sleep(poll_sec)
+
+
+def _read_result_containers(results_file: str, result_files: list, found_keys: set) -> Iterator[dict]:
+    """Reads the containers of a results file one at a time
+    Arguments:
+        results_file: the path of the results file to read
+        result_files: the list that the top-level files of the results are added to
+        found_keys: the set that the top-level keys of the results are added to
+    Return:
+        Yields each container in the results
+    """
+    for key, value in iter_results(results_file):
+        found_keys.add(key)
+        if key in ['container', 'containers']:
+            yield value
+        elif key in ['file', 'files']:
+            result_files.append(value)
+
+
+def cache_results(results_files: list, cache_dir: str, extra_files: list = None, path_maps: PathMapper = None,
+                  file_handlers: dict = None, jobs: int = 1, file_byte_budget: int = DEFAULT_FILE_BYTE_BUDGET) -> None:
     """Handles caching the containers and files found in the results
     Arguments:
-        result_containers: the dictionary of containers with files to copy
-        result_files: the dictionary of files to copy
+        results_files: the results files with the containers and files to copy
         cache_dir: the location to copy the files to
         extra_files: additional files to copy
         path_maps: path mappings to use on file paths
         file_handlers: special handling of files instead of normal copy
+        jobs: the maximum number of files to copy at the same time
+        file_byte_budget: the maximum number of bytes to hold in memory while copying each file
+    Notes:
+        The containers are read from the results files and cached one at a time (see iter_results()), and the top-level
+        files are cached after the containers of each results file
     """
-    file_list = []
+    # The list of copied files is written as files are cached so that it can be read while caching continues
+    manifest = FileListWriter(os.path.join(cache_dir, FILE_LIST_FILE_NAME), path_maps)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        for one_file in results_files:
+            found_keys = set()
+            result_files = []
+
+            # Handle containers first
+            containers = _read_result_containers(one_file, result_files, found_keys)
+            cache_containers(containers, cache_dir, path_maps, file_handlers, executor, file_byte_budget, manifest.write_set)
+            if not found_keys.intersection(['container', 'containers']):
+                logging.info("No containers found in results: '%s'", one_file)
+
+            # Handle any top-level files
+            if result_files:
+                copied_files = cache_files(result_files, cache_dir, path_maps, file_handlers, executor, file_byte_budget)
+                if copied_files:
+                    manifest.write_set({'files': copied_files})
+            if not found_keys.intersection(['file', 'files']):
+                logging.info("No top-level files found in results: '%s'", one_file)
+
+        # Handle any extra files
+        if extra_files:
+            copied_files = cache_files(extra_files, cache_dir, None, file_handlers, executor, file_byte_budget)
+            if copied_files:
+                manifest.write_set({'files': copied_files})
+
+        # Finish with the list of copied files for makeflow use
+        manifest.close()
+
+
+def _read_batch(batch_file: str) -> list:
+    """Reads the results files and cache folders to process from a batch manifest
+    Arguments:
+        batch_file: the path to the manifest, or '-' to read it from stdin
+    Return:
+        Returns a list of (results file, cache folder) tuples
+    Exceptions:
+        Raises RuntimeError if a line of the manifest is invalid
+    Notes:
+        Each line of the manifest has a results file and a cache folder separated by a tab; empty lines and lines
+        starting with '#' are skipped
+    """
+    def parse_lines(lines) -> list:
+        """Parses the lines of the manifest"""
+        pairs = []
+        for line_number, one_line in enumerate(lines, 1):
+            one_line = one_line.rstrip('\r\n')
+            if not one_line.strip() or one_line.startswith('#'):
+                continue
+            parts = one_line.split('\t')
+            if len(parts) != 2 or not parts[0] or not parts[1]:
+                raise RuntimeError("Invalid line %s in batch '%s': expected <results>TAB<cache>" % (str(line_number), batch_file))
+            pairs.append((parts[0], parts[1]))
+        return pairs
+
+    if batch_file == '-':
+        return parse_lines(sys.stdin)
+    with open(batch_file, 'r') as in_file:
+        return parse_lines(in_file)
+
+
+def cache_batch(args: argparse.Namespace, pairs: list) -> list:
+    """Caches the results of several transformer runs using the same options
+    Arguments:
+        args: the command line parameters to use for every run; the results file and cache folder are replaced
+        pairs: list of (results file, cache folder) tuples
+    Return:
+        Returns a list of error messages, one for each pair that couldn't be cached
+    """
+    errors = []
+    for results_file, cache_folder in pairs:
+        pair_args = argparse.Namespace(**vars(args))
+        pair_args.results_file, pair_args.cache_folder = results_file, cache_folder
+        try:
+            cache_results(**_check_get_parameters(pair_args))
+            if args.result_index:
+                _add_to_result_index(args.result_index, results_file, cache_folder)
+        except Exception as ex:
+            msg = "Unable to cache results '%s' into '%s': %s" % (str(results_file), str(cache_folder), str(ex))
+            logging.exception(msg)
+            errors.append(msg)
+    return errors
+
+
+def _service_request(args: argparse.Namespace, results_file: str, cache_folder: str) -> dict:
+    """Returns the request sent to the resident service for caching one set of results
+    Arguments:
+        args: the command line parameters
+        results_file: the results file to cache
+        cache_folder: the folder to cache the results into
+    Return:
+        Returns a dict with the parameters in 'args'
+    Notes:
+        Relative paths in the parameters, including the destination folders of path mappings, are made absolute since
+        the service doesn't run in the working folder of this process
+    """
+    request_args = {key: value for key, value in vars(args).items() if key not in RUN_MODE_OPTIONS}
+    request_args['results_file'], request_args['cache_folder'] = results_file, cache_folder
+    for one_option in SERVICE_PATH_OPTIONS:
+        if request_args.get(one_option):
+            request_args[one_option] = ':'.join([os.path.abspath(one_path)
+                                                 for one_path in request_args[one_option].split(':')])
+    if request_args.get('maps'):
+        request_args['maps'] = ','.join([one_map.split(':')[0] + ':' + os.path.abspath(one_map.split(':')[1])
+                                         if one_map.count(':') == 1 else one_map
+                                         for one_map in request_args['maps'].split(',')])
+    return {'args': request_args}
+
+
+def submit_batch(socket_path: str, args: argparse.Namespace, pairs: list) -> list:
+    """Hands the caching of several sets of results to the resident service
+    Arguments:
+        socket_path: the path of the service's socket
+        args: the command line parameters to use for every set of results
+        pairs: list of (results file, cache folder) tuples
+    Return:
+        Returns a list of error messages, one for each pair that couldn't be cached
+    Notes:
+        The pairs the service hasn't answered for are cached locally when the service isn't available or the connection
+        to it fails, including the pair it was working on
+    """
+    errors = []
+    done_count = 0
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as service:
+            service.connect(socket_path)
+            with service.makefile('rw') as service_file:
+                for results_file, cache_folder in pairs:
+                    service_file.write(json.dumps(_service_request(args, results_file, cache_folder)) + '\n')
+                    service_file.flush()
+                    reply = service_file.readline()
+                    if not reply:
+                        raise ConnectionError("Caching service closed the connection")
+                    errors.extend(json.loads(reply)['errors'])
+                    done_count += 1
+                return errors
+    except OSError as ex:
+        logging.warning("Caching %s results locally since the service at '%s' isn't available: %s",
+                        str(len(pairs) - done_count), socket_path, str(ex))
+    return errors + cache_batch(args, pairs[done_count:])
+
+
+class CacheRequestHandler(socketserver.StreamRequestHandler):
+    """Handles the requests of one connection to the resident caching service; each request is a line of JSON with the
+    command line parameters for caching one set of results, which is answered with a line of JSON listing any 'errors'"""
+
+    def handle(self) -> None:
+        """Handles the requests of the connection"""
+        for one_line in self.rfile:
+            try:
+                request = json.loads(one_line)
+                request_args = argparse.Namespace(**request['args'])
+                errors = cache_batch(request_args, [(request_args.results_file, request_args.cache_folder)])
+            except Exception as ex:
+                logging.exception("Unable to handle caching request: %s", str(one_line))
+                errors = ["Invalid caching request: %s" % str(ex)]
+            self.wfile.write((json.dumps({'errors': errors}) + '\n').encode('utf-8'))
 
-    # Handle containers first
-    if result_containers:
-        copied_files = cache_containers(result_containers, cache_dir, path_maps, file_handlers)
-        if copied_files:
-            file_list.extend(copied_files)
 
-    # Handle any top-level files
-    if result_files:
-        copied_files = cache_files(result_files, cache_dir, path_maps, file_handlers)
-        if copied_files:
-            file_list.append({'files': copied_files})
+class CacheServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The resident caching service, which handles each connection on its own thread"""
+    # Don't wait for connections that are still being handled when stopping
+    daemon_threads = True
 
-    # Handle any extra files
-    if extra_files:
-        copied_files = cache_files(extra_files, cache_dir, None, file_handlers)
-        if copied_files:
-            file_list.append({'files': copied_files})
-
-    # Save the list of copied files for makeflow use
-    makeflow_list_file = os.path.join(cache_dir, "cached_files_makeflow_list.json")
-    with open(makeflow_list_file, "w") as out_file:
-        out_file.write('{\n  "FILE_LIST": [')
-        separator = ""
-        for one_set in file_list:
-            definition_lines = []
-            if 'metadata_path' in one_set:
-                file_metadata = {
-                    'METADATA': one_set['metadata_path'],
-                    'METADATA_NAME': _strip_mapped_path(one_set['metadata_path'], path_maps),
-                    'BASE_METADATA_NAME': os.path.splitext(os.path.basename(one_set['metadata_path']))[0]
-                }
-            else:
-                file_metadata = {
-                    'METADATA': "",
-                    'METADATA_NAME': "",
-                    'BASE_METADATA_NAME': ""
-                }
 
-            for one_file in one_set['files']:
-                definition_lines.append({**{
-                    'PATH': one_file,
-                    'NAME': _strip_mapped_path(one_file, path_maps),
-                    'BASE_IMAGE_NAME': os.path.splitext(os.path.basename(one_file))[0]
-                }, **file_metadata})
+def _exit_on_signal(signal_number: int, frame) -> None:
+    """Signal handler that exits the process
+    Arguments:
+        signal_number: the number of the received signal
+        frame: the current stack frame
+    """
+    # pylint: disable=unused-argument
+    raise SystemExit(128 + signal_number)
 
-            out_file.write('%s\n  \n    %s\n' % (separator, ',\n    '.join([str(entry).replace("'", '"')
-                                                                            for entry in definition_lines])))
-            separator = ','
 
-        out_file.write('\n  ]\n}')
+def serve(socket_path: str) -> None:
+    """Runs the resident caching service until the process is stopped
+    Arguments:
+        socket_path: the path of the socket to listen on; an existing file is replaced
+    Notes:
+        Each connection is handled on its own thread so that the rules of several workflows cache their results at
+        the same time. Requests are expected to have absolute paths (see _service_request())
+    """
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # Exit through the finally below when asked to terminate so that the socket is removed
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    with CacheServer(socket_path, CacheRequestHandler) as server:
+        logging.info("Caching service is listening on '%s'", socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
 
 
 def add_arguments(parser: argparse.ArgumentParser) -> None:
@@ -586,9 +1335,23 @@ def add_arguments(parser: argparse.ArgumentParser) -> None:
                         help='one or more comma separated folder mappings of <source path>:<destination path>')
     parser.add_argument('--extra_files', nargs='?', type=str,
                         help='one or more colon separated files to copy <file 1>:<file 2>:...')
-    parser.add_argument('results_file', metavar='<results>', type=str,
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='the maximum number of files to copy at the same time (default=1)')
+    parser.add_argument('--file_byte_budget', type=int, default=DEFAULT_FILE_BYTE_BUDGET,
+                        help='the maximum number of bytes to hold in memory while copying each file (default=%s)' %
+                        str(DEFAULT_FILE_BYTE_BUDGET))
+    parser.add_argument('--result_index', type=str, metavar='<index>',
+                        help='add each cached results file to this result index, relative to the parent of its cache folder')
+    parser.add_argument('--batch', type=str,
+                        help='file listing a <results> TAB <cache> pair on each line to process instead of a single pair '
+                             '("-" to read it from stdin)')
+    parser.add_argument('--serve', type=str, metavar='<socket>',
+                        help='run the resident caching service on the socket until stopped')
+    parser.add_argument('--submit', type=str, metavar='<socket>',
+                        help='hand the caching to the resident service on the socket, caching locally if it is not running')
+    parser.add_argument('results_file', metavar='<results>', type=str, nargs='?',
                         help='the path to the results file to act upon')
-    parser.add_argument('cache_folder', metavar='<cache>', type=str,
+    parser.add_argument('cache_folder', metavar='<cache>', type=str, nargs='?',
                         help='the path to cache the results into')
 
     parser.epilog = 'Mappings are exact character matches from the start of file paths; no checks are made to ensure complete' +\
@@ -604,6 +1367,18 @@ if __name__ == "__main__":
 
     logging.getLogger().setLevel(logging.DEBUG)
 
+    if ARGS.serve:
+        serve(ARGS.serve)
+        sys.exit(0)
+
     # Process the results
-    PARAMS = _check_get_parameters(ARGS)
-    cache_results(**PARAMS)
+    if ARGS.batch:
+        PAIRS = _read_batch(ARGS.batch)
+    elif ARGS.results_file and ARGS.cache_folder:
+        PAIRS = [(ARGS.results_file, ARGS.cache_folder)]
+    else:
+        PARSER.error('the <results> and <cache> arguments are required unless --batch or --serve is specified')
+    ERRORS = submit_batch(ARGS.submit, ARGS, PAIRS) if ARGS.submit else cache_batch(ARGS, PAIRS)
+    if ERRORS:
+        logging.error("Unable to cache %s of %s results", str(len(ERRORS)), str(len(PAIRS)))
+        sys.exit(1)
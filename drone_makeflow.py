@@ -1,35 +1,119 @@
 """Handles preparing and starting a makeflow run
 """
 
+import atexit
+import concurrent.futures
 from copy import deepcopy
 import datetime
+import errno
+import fcntl
+import hashlib
 import json
 import logging
 import os
+import selectors
 import shutil
+import signal
 import stat
 import subprocess
 import tempfile
+import threading
 import time
-from typing import Union, Optional
+from typing import Union, Optional, TextIO
 import yaml
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from urllib3.util.retry import Retry
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
 
 import pyclowder.connectors as connectors
-import pyclowder.datasets as datasets
 import pyclowder.files as files
+from pyclowder.utils import CheckMessage
 import terrautils.extractors as extractors
 from terrautils.secure import encrypt_pipeline_string
 
+import cache_results
+
 # Timeouts relating to processing
-PROC_WAIT_SLEEP_SEC = 5  # Amount of time to sleep before checking process status
-PROC_WAIT_TOTAL_SEC = 24 * 60 * 60  # Total wait time for process to finish
-PROC_COMMUNICATE_TIMEOUT_SEC = 2  # Number of seconds to wait for a communicate call to complete
+PROC_WAIT_TOTAL_SEC = 24 * 60 * 60  # Default total wait time for a workflow step's process to finish
+PROC_TERMINATE_TIMEOUT_SEC = 30  # Number of seconds to wait for a terminated process to exit before killing it
+PROC_READ_BUFFER_SIZE = 64 * 1024  # Maximum number of bytes to read from process output at one time
+PROC_POLL_SEC = 1  # Maximum number of seconds between checks of whether a process has exited while reading its output
+PROC_EXIT_DRAIN_SEC = 2  # Number of seconds output is still read after a process exits, while others hold it open
 
 # Access permissions for folders we create
 CREATED_FOLDER_PERMISSIONS = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP |\
                              stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH
 
+# Ways of staging files for a workflow step, in order of preference
+STAGING_STRATEGIES = ['hardlink', 'reflink', 'copy_file_range', 'copy']
+STAGING_REFLINK_IOCTL = 0x40049409  # The Linux FICLONE ioctl request number for cloning a file's extents
+STAGING_COPY_CHUNK_SIZE = 64 * 1024 * 1024  # Maximum number of bytes to request with each copy_file_range() call
+STAGING_NO_LINK_EXTENSIONS = ['.json', '.csv']  # Files that may be rewritten or appended to after they're staged, which
+                                                # are never hard linked
+
+# Running a workflow step while the previous step is still producing its cached files
+STREAM_BATCH_SIZE = 16  # Maximum number of cached file entries handed to one makeflow run of the consuming step
+STREAM_MAX_RUNS = 4  # Maximum number of makeflow runs of the consuming step at the same time
+STREAM_POLL_SEC = 5  # Number of seconds between checks for newly cached files
+
+# Publishing the results of workflow steps
+RESULT_LIST_KEYS = ('container', 'file', 'files')  # Keys of result lists that are read from results files one element at a time
+RESULT_PUBLISH_BATCH_SIZE = 100  # Maximum number of containers or files handed to Clowder at one time
+
+# Reusing the results of workflow steps across messages
+STEP_CACHE_INFO_FILE_NAME = 'step_cache.json'  # Information on a cached workflow step run
+STEP_CACHE_HASH_CHUNK_SIZE = 1024 * 1024  # Number of bytes read at a time when hashing input files
+
+# Combining bursts of messages for the same dataset
+COALESCE_QUIET_SEC = 30  # Default number of seconds without new messages for a dataset before it's processed
+COALESCE_POLL_SEC = 1  # Number of seconds between checks for the end of a quiet period
+COALESCE_FORGET_SEC = 7 * 24 * 60 * 60  # Number of seconds without messages before a dataset's processed files are forgotten
+
+# Running the workflow steps of several messages at the same time
+STEP_DEFAULT_CORES = 1  # Number of cores a workflow step needs if it doesn't specify 'cores'
+STEP_DEFAULT_MEMORY_MB = 2048  # Megabytes of memory a workflow step needs if it doesn't specify 'memory_mb'
+RULE_DEFAULT_CORES = 1  # Number of cores each item of a step's fan-out rules needs if the step doesn't specify 'rule_cores'
+RULE_DEFAULT_MEMORY_MB = 1024  # Megabytes of memory for each item of a fan-out rule if the step doesn't specify 'rule_memory_mb'
+
+# Managing the space used by the working space
+WORKSPACE_RUN_MARKER_FILE_NAME = '.drone_makeflow_run'  # Marks a message's working folder; locked while the folder is in use
+
+# Resuming interrupted messages
+RUN_INFO_FILE_NAME = 'run_info.json'  # Describes the run of a message in its working folder
+RUN_STATUS_RUNNING = 'running'  # Run status of a message that is being processed, or was interrupted
+RUN_STATUS_FINISHED = 'finished'  # Run status of a message that was processed successfully
+
+# Clowder connections
+CLOWDER_POOL_SIZE = 10  # Default maximum number of connections kept open to Clowder
+CLOWDER_TIMEOUT_SEC = 300  # Default number of seconds to wait for Clowder to respond
+CLOWDER_RETRIES = 5  # Number of times idempotent requests are retried
+CLOWDER_BACKOFF_SEC = 0.5  # Factor for the exponentially increasing number of seconds to wait between retries
+CLOWDER_RETRY_STATUS_CODES = [429, 500, 502, 503, 504]  # HTTP status codes that cause idempotent requests to be retried
+
+# Dataset ID lookups
+DATASET_ID_CACHE_TTL_SEC = 60 * 60  # Number of seconds a found dataset ID is remembered
+DATASET_PREFETCH_MIN_LENGTH = 8  # Minimum length of the common part of names used for bulk dataset lookups
+DATASET_PREFETCH_LIMIT = 1000  # Maximum number of datasets returned by a bulk dataset lookup
+
+# Running workflow rules on Work Queue workers
+BATCH_TYPES = ['local', 'wq']  # Supported makeflow batch types
+WQ_DEFAULT_PROJECT = 'drone_makeflow'  # Default Work Queue project name workers connect to through the catalog server
+
+# Running a workflow step on overlapping tiles of a large image
+TILE_DEFAULT_SIZE = 4096  # Default width and height of tiles in pixels, not counting their overlap
+TILE_DEFAULT_OVERLAP = 256  # Default number of pixels each tile overlaps its neighbors by
+
+# Scripts copied to the script folder of each workflow step
+WORKFLOW_SCRIPT_FILE_NAMES = ['cache_results.py', 'merge_tiles.py']
+
+# Resident cache_results.py service that workflow rules hand caching to
+CACHE_RESULTS_SOCKET_TEMPLATE = '.cache_results_{host}_{pid}.sock'  # Name of the service's socket in the working space
+
 # Name of mount point on Docker images
 IMAGE_MOUNT_POINT_NAME = '/mnt/'
 
@@ -53,28 +137,25 @@ def _preprocess_canopy_cover_json(env: dict, json_file: str) -> str:
     return_filename = json_file
     logging.debug("Looking into canopy cover makeflow preprocess file: '%s' to folder '%s'", json_file, dest_dir)
     try:
-        new_json = None
-        with open(json_file, 'r') as in_file:
-            target_json = json.load(in_file)
-            logging.debug("Checking for FILE_LIST key in %s", str(target_json.keys()))
-            if 'FILE_LIST' in target_json:
-                new_json = []
-                for one_file in target_json['FILE_LIST']:
-                    logging.debug("Looking for METADATA in %s", str(one_file))
-                    if 'METADATA' in one_file:
-                        logging.debug("Adding to new JSON")
-                        new_json.append(one_file)
-
-        if new_json is not None:
-            new_json_file = os.path.join(dest_dir, WORKFLOW_STEP_CACHE_FILE_NAME)
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
-            logging.debug("Saving new JSON to '%s' with %s entries", new_json_file, str(len(new_json)))
-            with open(new_json_file, 'w') as out_file:
-                json.dump({'FILE_LIST': new_json}, out_file)
-                return_filename = new_json_file
-        else:
-            logging.debug("No new data stored")
+        new_json_file = os.path.join(dest_dir, WORKFLOW_STEP_CACHE_FILE_NAME)
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+
+        # The entries are copied one at a time so that large lists aren't held in memory. The new list replaces the old
+        # one instead of overwriting it since the old one may share its file with the previous step's cached list
+        entry_count = 0
+        temp_json_file = new_json_file + '.tmp'
+        writer = cache_results.FileListWriter(temp_json_file)
+        try:
+            for one_file in cache_results.read_file_list(json_file):
+                if 'METADATA' in one_file:
+                    writer.write_entry(one_file)
+                    entry_count += 1
+        finally:
+            writer.close()
+        os.replace(temp_json_file, new_json_file)
+        logging.debug("Saved new JSON to '%s' with %s entries", new_json_file, str(entry_count))
+        return_filename = new_json_file
 
     except Exception as ex:
         msg = "Ignoring exception while pre processing canopy cover JSON file: '%s' %s" % (json_file, str(ex))
@@ -90,8 +171,12 @@ WORKFLOW = [
         'docker_version_number': '2.0',                         # The version of the docker image to use
         'arguments': None,                                      # Additional arguments for makeflow command
         'return_code_success': lambda code: int(code) == 0,     # Function that indicates success based upon return code
+        'cores': 8,                                             # Number of cores the step needs while running
+        'memory_mb': 16384,                                     # Megabytes of memory the step needs while running
+        'exclusive': True,                                      # The step is given all the cores and memory when it runs
         'force_dataset': True,                                  # Force the output to a dataset if not specified
-        'dataset_name_template': '{date}_{experiment}_{name}'   # Template for dataset names
+        'dataset_name_template': '{date}_{experiment}_{name}',  # Template for dataset names
+        'cache_input_extensions': ['.jpg', '.jpeg', '.tif', '.tiff', '.txt']  # Input files that affect the step's results
     },
     {
         'name': 'Soil Mask',                                    # Name of the workflow step
@@ -99,8 +184,15 @@ WORKFLOW = [
         'docker_version_number': '2.0',                         # The version of the docker image to use
         'arguments': None,                                      # Additional arguments for makeflow command
         'return_code_success': lambda code: int(code) == 0,     # Function that indicates success based upon return code
+        'cores': 4,                                             # Number of cores the step needs while running
+        'memory_mb': 4096,                                      # Megabytes of memory the step needs while running
+        'rule_cores': 1,                                        # Number of cores needed by each tile's container run
+        'rule_memory_mb': 1024,                                 # Megabytes of memory needed by each tile's container run
         'force_dataset': False,                                 # Force the output to a dataset if not specified
-        'dataset_name_template': '{date}_{experiment}_{name}'   # Template for dataset names
+        'dataset_name_template': '{date}_{experiment}_{name}',  # Template for dataset names
+        'tile_image': 'odm_orthophoto.tif',                     # Image that's split into tiles processed separately
+        'tile_size': TILE_DEFAULT_SIZE,                         # Width and height of the tiles in pixels
+        'tile_overlap': TILE_DEFAULT_OVERLAP                    # Number of pixels the tiles overlap by
     },
     {
         'name': 'Plot Clip',                                    # Name of the workflow step
@@ -108,6 +200,8 @@ WORKFLOW = [
         'docker_version_number': '2.0',                         # The version of the docker image to use
         'arguments': None,                                      # Additional arguments for makeflow command
         'return_code_success': lambda code: int(code) == 0,     # Function that indicates success based upon return code
+        'cores': 2,                                             # Number of cores the step needs while running
+        'memory_mb': 4096,                                      # Megabytes of memory the step needs while running
         'force_dataset': False,                                 # Force the output to a dataset if not specified
         'dataset_name_template': '{date}_{experiment}_{name}'   # Template for dataset names
     },
@@ -117,14 +211,714 @@ WORKFLOW = [
         'docker_version_number': '1.0',                         # The version of the docker image to use
         'arguments': None,                                      # Additional arguments for makeflow command
         'return_code_success': lambda code: int(code) == 0,     # Function that indicates success based upon return code
+        'cores': 4,                                             # Number of cores the step needs while running
+        'memory_mb': 4096,                                      # Megabytes of memory the step needs while running
+        'rule_cores': 1,                                        # Number of cores needed by each plot's container run
+        'rule_memory_mb': 1024,                                 # Megabytes of memory needed by each plot's container run
         'force_dataset': False,                                 # Force the output to a dataset if not specified
         'dataset_name_template': '{date}_{experiment}_{name}',  # Template for dataset names
         'preprocess_json': _preprocess_canopy_cover_json,       # Function for preprocessing JSON
         'copy_cached_folders': True,                            # Do we copy cached folders from previous step
         'use_extended_results_path': True,                      # Use a path specifier for results that's not the default
-        'discover_run_results': True                            # Perform a folder search for results file instead of the default
+        'container_batch_size': 8,                              # Number of plots processed by each container run
+        'container_entrypoint': '/home/extractor/entrypoint.py',  # Command run in the container for each plot of a batch
+        'discover_run_results': True,                           # Perform a folder search for results file instead of the default
+        'stream_from_previous': True                            # Process the previous step's results as they're cached
     }
 ]
+# Optional workflow step keys:
+#   'timeout_sec': the number of seconds the step's makeflow may run before it's stopped (default is PROC_WAIT_TOTAL_SEC)
+#   'container_batch_size': the number of files a JX workflow that supports batching processes with each container run;
+#                           files are processed by separate container runs when not specified
+#   'container_entrypoint': the command a batching JX workflow runs in the container for each file of a batch
+#   'stream_from_previous': when True, and streaming is enabled, the step is run on batches of the previous step's cached
+#                           file entries that have metadata, as they're written, while the previous step is running
+#   'cache_input_extensions': the extensions of the input files that identify a step run when the step cache is enabled;
+#                             all input files are used when not specified
+#   'cores', 'memory_mb': the number of cores and megabytes of memory reserved while the step runs (defaults are
+#                         STEP_DEFAULT_CORES and STEP_DEFAULT_MEMORY_MB); makeflow is limited to them
+#   'exclusive': when True the step is given all the cores and memory available to the extractor
+#   'rule_cores', 'rule_memory_mb': the resources declared by each item of the step's fan-out rules (defaults are
+#                                   RULE_DEFAULT_CORES and RULE_DEFAULT_MEMORY_MB)
+#   'tile_image': the name of the image in the step's data folder that's split into tiles when it's larger than a tile;
+#                 the step's JX workflow receives the tiles in TILE_LIST (requires GDAL)
+#   'tile_size', 'tile_overlap': the size of the tiles and the number of pixels they overlap by, in pixels (defaults are
+#                                TILE_DEFAULT_SIZE and TILE_DEFAULT_OVERLAP); a size of 0 turns tiling off
+
+
+class DatasetIdCache():
+    """Thread-safe cache of dataset names to their Clowder IDs; datasets that aren't found are never cached since
+    another instance may create them at any time"""
+
+    def __init__(self, ttl_sec: float = DATASET_ID_CACHE_TTL_SEC):
+        """Initializes class instance
+        Arguments:
+            ttl_sec: the number of seconds a dataset ID is cached for
+        """
+        self.ttl_sec = ttl_sec
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, host: str, dataset_name: str) -> tuple:
+        """Looks up a dataset in the cache
+        Arguments:
+            host: the URL of the Clowder instance
+            dataset_name: the name of the dataset
+        Return:
+            Returns a tuple of whether the dataset was found in the cache, and its ID
+        """
+        with self.lock:
+            entry = self.entries.get((host, dataset_name))
+            if entry is None:
+                return False, None
+            if entry[1] < time.monotonic():
+                del self.entries[(host, dataset_name)]
+                return False, None
+            return True, entry[0]
+
+    def store(self, host: str, dataset_name: str, dataset_id: str) -> None:
+        """Stores a dataset ID in the cache
+        Arguments:
+            host: the URL of the Clowder instance
+            dataset_name: the name of the dataset
+            dataset_id: the ID of the dataset
+        """
+        with self.lock:
+            self.entries[(host, dataset_name)] = (dataset_id, time.monotonic() + self.ttl_sec)
+
+    def clear(self) -> None:
+        """Removes all cached entries"""
+        with self.lock:
+            self.entries.clear()
+
+
+# Dataset IDs shared by all requests to Clowder made by this process
+DATASET_ID_CACHE = DatasetIdCache()
+
+
+class SlotScheduler():
+    """Admits workflow steps to run when enough of the host's cores and memory are free"""
+
+    def __init__(self, total_cores: int, total_memory_mb: int):
+        """Initializes class instance
+        Arguments:
+            total_cores: the number of cores available for running workflow steps
+            total_memory_mb: the megabytes of memory available for running workflow steps
+        Notes:
+            Steps are admitted in the order they ask to run so that a step needing many resources isn't passed over by
+            a stream of smaller steps. A step needing more than the totals is admitted once nothing else is running
+        """
+        self.total_cores = total_cores
+        self.total_memory_mb = total_memory_mb
+        self.free_cores = total_cores
+        self.free_memory_mb = total_memory_mb
+        self.waiting = []
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def step_needs(workflow_step: dict) -> tuple:
+        """Returns the resources a workflow step needs
+        Arguments:
+            workflow_step: the information on the workflow step
+        Return:
+            Returns a tuple of the number of cores and megabytes of memory
+        """
+        cores = workflow_step['cores'] if 'cores' in workflow_step else STEP_DEFAULT_CORES
+        memory_mb = workflow_step['memory_mb'] if 'memory_mb' in workflow_step else STEP_DEFAULT_MEMORY_MB
+        return cores, memory_mb
+
+    def step_reservation(self, workflow_step: dict) -> tuple:
+        """Returns the resources reserved for running a workflow step
+        Arguments:
+            workflow_step: the information on the workflow step
+        Return:
+            Returns a tuple of the number of cores and megabytes of memory, limited to the totals
+        """
+        if 'exclusive' in workflow_step and workflow_step['exclusive']:
+            return self.total_cores, self.total_memory_mb
+        cores, memory_mb = self.step_needs(workflow_step)
+        return min(cores, self.total_cores), min(memory_mb, self.total_memory_mb)
+
+    def set_env_resources(self, env: dict, workflow_step: dict, share: int = 1) -> None:
+        """Adds the resources that the rules of a workflow step may declare to its environment
+        Arguments:
+            env: the environment of the workflow step
+            workflow_step: the information on the workflow step
+            share: the number of makeflow runs that split the step's reservation
+        """
+        cores, memory_mb = self.step_reservation(workflow_step)
+        rule_cores = workflow_step['rule_cores'] if 'rule_cores' in workflow_step else RULE_DEFAULT_CORES
+        rule_memory_mb = workflow_step['rule_memory_mb'] if 'rule_memory_mb' in workflow_step else RULE_DEFAULT_MEMORY_MB
+        env['RULE_CORES'] = min(rule_cores, cores)
+        env['RULE_MEMORY_MB'] = min(rule_memory_mb, memory_mb)
+        env['STEP_CORES'] = max(cores // share, env['RULE_CORES'])
+        env['STEP_MEMORY_MB'] = max(memory_mb // share, env['RULE_MEMORY_MB'])
+
+    def acquire(self, name: str, cores: int, memory_mb: int) -> tuple:
+        """Waits until the resources are available and reserves them
+        Arguments:
+            name: the name of what's being run, for logging
+            cores: the number of cores needed
+            memory_mb: the megabytes of memory needed
+        Return:
+            Returns a tuple of the reserved cores and memory to pass to release()
+        """
+        cores = min(cores, self.total_cores)
+        memory_mb = min(memory_mb, self.total_memory_mb)
+        ticket = object()
+        queued_time = time.monotonic()
+        with self.condition:
+            self.waiting.append(ticket)
+            if self.waiting[0] is not ticket or cores > self.free_cores or memory_mb > self.free_memory_mb:
+                logging.info("Queueing '%s' needing %s cores and %s MB: %s cores and %s MB free, %s waiting ahead",
+                             name, str(cores), str(memory_mb), str(self.free_cores), str(self.free_memory_mb),
+                             str(len(self.waiting) - 1))
+            while self.waiting[0] is not ticket or cores > self.free_cores or memory_mb > self.free_memory_mb:
+                self.condition.wait()
+            self.waiting.pop(0)
+            self.free_cores -= cores
+            self.free_memory_mb -= memory_mb
+            logging.info("Admitting '%s' with %s cores and %s MB after %.1f seconds: %s cores and %s MB left free",
+                         name, str(cores), str(memory_mb), time.monotonic() - queued_time, str(self.free_cores),
+                         str(self.free_memory_mb))
+            self.condition.notify_all()
+        return cores, memory_mb
+
+    def release(self, name: str, reserved: tuple) -> None:
+        """Returns reserved resources
+        Arguments:
+            name: the name of what was run, for logging
+            reserved: the reserved resources as returned by acquire()
+        """
+        with self.condition:
+            self.free_cores += reserved[0]
+            self.free_memory_mb += reserved[1]
+            logging.info("Released %s cores and %s MB from '%s': %s cores and %s MB free", str(reserved[0]),
+                         str(reserved[1]), name, str(self.free_cores), str(self.free_memory_mb))
+            self.condition.notify_all()
+
+
+class EventCoalescer():
+    """Combines bursts of messages for the same dataset into one run"""
+
+    def __init__(self, quiet_sec: float = COALESCE_QUIET_SEC):
+        """Initializes class instance
+        Arguments:
+            quiet_sec: the number of seconds without new messages for a dataset before a message is processed
+        Notes:
+            A message waits until no newer message for its dataset has arrived for the quiet period, and is dropped if a
+            newer message arrives while waiting. Messages for files that a running, or successful, run of the dataset
+            already included are dropped right away. This only combines messages handled by this process, and waiting
+            only helps when there are several connectors (the '--num' option greater than 1) since the connector that's
+            waiting can't receive the newer message
+        """
+        self.quiet_sec = quiet_sec
+        self.datasets = {}
+        self.lock = threading.Lock()
+
+    def arrive(self, dataset_id: str, file_id: Optional[str]) -> Optional[int]:
+        """Registers a message for a dataset
+        Arguments:
+            dataset_id: the ID of the dataset
+            file_id: the ID of the file that triggered the message, if known
+        Return:
+            Returns the number of the message for the dataset, or None if the file has already been included in a run
+        """
+        now = time.monotonic()
+        with self.lock:
+            for one_id in [one_id for one_id, one_info in self.datasets.items()
+                           if one_info['runs'] == 0 and now - one_info['last_event'] > COALESCE_FORGET_SEC]:
+                del self.datasets[one_id]
+            if dataset_id not in self.datasets:
+                self.datasets[dataset_id] = {'last_event': now, 'event_count': 0, 'covered': set(), 'runs': 0}
+            dataset_info = self.datasets[dataset_id]
+            if file_id is not None and file_id in dataset_info['covered']:
+                return None
+            dataset_info['last_event'] = now
+            dataset_info['event_count'] += 1
+            return dataset_info['event_count']
+
+    def wait_quiet(self, dataset_id: str, event_number: int) -> bool:
+        """Waits for the quiet period of a dataset to pass
+        Arguments:
+            dataset_id: the ID of the dataset
+            event_number: the number of the message as returned by arrive()
+        Return:
+            Returns True if the message is the newest one for the dataset once the quiet period has passed, and False if
+            a newer message arrived in the meantime
+        """
+        while True:
+            with self.lock:
+                dataset_info = self.datasets[dataset_id]
+                if dataset_info['event_count'] != event_number:
+                    return False
+                remaining_sec = self.quiet_sec - (time.monotonic() - dataset_info['last_event'])
+            if remaining_sec <= 0:
+                return True
+            time.sleep(min(remaining_sec, COALESCE_POLL_SEC))
+
+    def start_run(self, dataset_id: str, file_ids: list) -> None:
+        """Registers the start of a run that includes the specified files
+        Arguments:
+            dataset_id: the ID of the dataset
+            file_ids: the IDs of the files in the dataset when the run started
+        """
+        with self.lock:
+            dataset_info = self.datasets[dataset_id]
+            dataset_info['covered'].update(file_ids)
+            dataset_info['runs'] += 1
+
+    def finish_run(self, dataset_id: str, file_ids: list, succeeded: bool) -> None:
+        """Registers the end of a run
+        Arguments:
+            dataset_id: the ID of the dataset
+            file_ids: the IDs of the files passed to start_run()
+            succeeded: whether the run was successful; the files of failed runs can be run again
+        """
+        with self.lock:
+            dataset_info = self.datasets[dataset_id]
+            dataset_info['runs'] -= 1
+            if not succeeded:
+                dataset_info['covered'].difference_update(file_ids)
+
+
+class WorkspaceManager():
+    """Keeps the space used by message working folders, and step cache entries, under a limit by removing the least
+    recently used ones in the background"""
+
+    def __init__(self, working_space: str, max_bytes: int, step_cache_dir: str = None):
+        """Initializes class instance
+        Arguments:
+            working_space: the folder containing the working folders of messages
+            max_bytes: the maximum number of bytes used before folders are removed; zero or less to never remove folders
+            step_cache_dir: optional folder of the step cache whose entries may also be removed
+        Notes:
+            Only working folders started with begin() by any instance sharing the working space are removed, and only
+            after they are no longer in use. Files hard linked into several folders are counted once, and only count as
+            freed when all their links have been removed
+        """
+        self.working_space = os.path.realpath(working_space)
+        self.max_bytes = max_bytes
+        self.step_cache_dir = os.path.realpath(step_cache_dir) if step_cache_dir else None
+        self.active = {}
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.stats = {'usage_bytes': 0, 'collections': 0, 'evicted_folders': 0, 'evicted_bytes': 0}
+
+    def begin(self, folder: str) -> None:
+        """Marks a working folder as being in use
+        Arguments:
+            folder: the working folder of a message
+        """
+        while True:
+            marker_file = open(os.path.join(folder, WORKSPACE_RUN_MARKER_FILE_NAME), 'a')
+            fcntl.flock(marker_file.fileno(), fcntl.LOCK_SH)
+            if os.fstat(marker_file.fileno()).st_nlink > 0:
+                break
+            # The folder was removed as unused before the lock was taken
+            marker_file.close()
+            __internal__.create_folder_default_perms(folder)
+        with self.lock:
+            self.active[os.path.realpath(folder)] = marker_file
+
+    def claim(self, folder: str) -> bool:
+        """Marks a working folder as being in use unless another run, of this or another instance, is using it
+        Arguments:
+            folder: the working folder of a message, which is created if it doesn't exist
+        Return:
+            Returns True if the folder was marked as in use, and False if it's already in use
+        Notes:
+            The marker is locked exclusively until finish() is called so that no other run can claim the folder, or
+            remove it, while the caller prepares and uses it
+        """
+        while True:
+            if not os.path.isdir(folder):
+                __internal__.create_folder_default_perms(folder)
+            try:
+                marker_file = open(os.path.join(folder, WORKSPACE_RUN_MARKER_FILE_NAME), 'a')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(marker_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                marker_file.close()
+                return False
+            if os.fstat(marker_file.fileno()).st_nlink > 0:
+                break
+            # The folder was removed as unused before the lock was taken
+            marker_file.close()
+        with self.lock:
+            self.active[os.path.realpath(folder)] = marker_file
+        return True
+
+    def finish(self, folder: str) -> None:
+        """Marks a working folder as no longer in use and starts removing folders if the space limit is exceeded
+        Arguments:
+            folder: the working folder of a message
+        """
+        with self.lock:
+            marker_file = self.active.pop(os.path.realpath(folder), None)
+        if marker_file is not None:
+            os.utime(marker_file.name)
+            marker_file.close()
+        self.schedule()
+
+    def schedule(self) -> None:
+        """Starts removing folders in the background unless a removal is already waiting to run"""
+        if self.max_bytes <= 0:
+            return
+        with self.lock:
+            if self.pending is not None and not self.pending.running() and not self.pending.done():
+                return
+            self.pending = self.executor.submit(self.collect)
+
+    def get_stats(self) -> dict:
+        """Returns a copy of the usage and eviction statistics
+        Return:
+            Returns a dict with 'usage_bytes', 'collections', 'evicted_folders', and 'evicted_bytes' keys
+        """
+        with self.lock:
+            return dict(self.stats)
+
+    def shutdown(self) -> None:
+        """Waits for any folder removal to finish"""
+        self.executor.shutdown(wait=True)
+
+    @staticmethod
+    def scan_folder(folder: str, inodes: dict) -> list:
+        """Finds the files in a folder tree
+        Arguments:
+            folder: the folder to scan
+            inodes: dict of (device, inode) keys to [size, remaining links] lists that's updated with the found files
+        Return:
+            Returns the list of (device, inode) keys of the files found
+        """
+        found = []
+        folders = [folder]
+        while folders:
+            try:
+                with os.scandir(folders.pop()) as entries:
+                    for one_entry in entries:
+                        if one_entry.is_dir(follow_symlinks=False):
+                            folders.append(one_entry.path)
+                            continue
+                        file_stat = one_entry.stat(follow_symlinks=False)
+                        key = (file_stat.st_dev, file_stat.st_ino)
+                        if key not in inodes:
+                            inodes[key] = [file_stat.st_size, file_stat.st_nlink]
+                        found.append(key)
+            except FileNotFoundError:
+                pass
+        return found
+
+    def is_in_use(self, folder: str) -> bool:
+        """Checks if a working folder is being used by this or another instance
+        Arguments:
+            folder: the working folder to check
+        Return:
+            Returns True if the folder is in use
+        """
+        with self.lock:
+            if folder in self.active:
+                return True
+        try:
+            with open(os.path.join(folder, WORKSPACE_RUN_MARKER_FILE_NAME), 'r') as marker_file:
+                fcntl.flock(marker_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except FileNotFoundError:
+            return False
+        return False
+
+    def lock_unused(self, folder: str, marker_name: str) -> Optional[TextIO]:
+        """Locks a folder that's not in use so that it can be removed
+        Arguments:
+            folder: the working folder or step cache entry to lock
+            marker_name: the name of the file in the folder that users of the folder lock
+        Return:
+            Returns the open marker file holding the lock, or None if the folder is in use or was already removed
+        Notes:
+            The lock is held until the returned file is closed, which keeps the folder from being claimed by begin(),
+            or restored from by restore_step_cache(), while it's being removed
+        """
+        with self.lock:
+            if folder in self.active:
+                return None
+        try:
+            marker_file = open(os.path.join(folder, marker_name), 'r')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(marker_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            marker_file.close()
+            return None
+        if os.fstat(marker_file.fileno()).st_nlink == 0:
+            marker_file.close()
+            return None
+        return marker_file
+
+    def find_candidates(self) -> list:
+        """Finds the folders that may be removed
+        Return:
+            Returns a list of (last used timestamp, folder path, marker file name) tuples
+        """
+        candidates = []
+        with os.scandir(self.working_space) as entries:
+            for one_entry in entries:
+                if not one_entry.is_dir(follow_symlinks=False) or one_entry.path == self.step_cache_dir:
+                    continue
+                try:
+                    marker_stat = os.stat(os.path.join(one_entry.path, WORKSPACE_RUN_MARKER_FILE_NAME))
+                except FileNotFoundError:
+                    continue
+                candidates.append((marker_stat.st_mtime, one_entry.path, WORKSPACE_RUN_MARKER_FILE_NAME))
+        if self.step_cache_dir and os.path.isdir(self.step_cache_dir):
+            with os.scandir(self.step_cache_dir) as entries:
+                for one_entry in entries:
+                    # Entries still being saved have a suffix starting with a '.'
+                    if one_entry.is_dir(follow_symlinks=False) and '.' not in one_entry.name:
+                        candidates.append((one_entry.stat().st_mtime, one_entry.path, STEP_CACHE_INFO_FILE_NAME))
+        return sorted(candidates)
+
+    def collect(self) -> None:
+        """Removes the least recently used folders until the used space is under the limit"""
+        inodes = {}
+        candidates = [(folder, marker_name, self.scan_folder(folder, inodes))
+                      for _, folder, marker_name in self.find_candidates()]
+        self.scan_folder(self.working_space, inodes)
+        if self.step_cache_dir and not self.step_cache_dir.startswith(self.working_space.rstrip('/') + '/'):
+            self.scan_folder(self.step_cache_dir, inodes)
+        usage_bytes = sum(one_inode[0] for one_inode in inodes.values())
+        logging.debug("Workspace usage is %s of %s bytes with %s removable folders", str(usage_bytes), str(self.max_bytes),
+                      str(len(candidates)))
+
+        evicted_folders, evicted_bytes = 0, 0
+        for folder, marker_name, file_keys in candidates:
+            if usage_bytes <= self.max_bytes:
+                break
+            marker_file = self.lock_unused(folder, marker_name)
+            if marker_file is None:
+                continue
+            logging.info("Removing least recently used folder: '%s'", folder)
+            try:
+                shutil.rmtree(folder, ignore_errors=True)
+            finally:
+                marker_file.close()
+            freed_bytes = 0
+            for one_key in file_keys:
+                inodes[one_key][1] -= 1
+                if inodes[one_key][1] <= 0:
+                    freed_bytes += inodes[one_key][0]
+            usage_bytes -= freed_bytes
+            evicted_folders += 1
+            evicted_bytes += freed_bytes
+
+        with self.lock:
+            self.stats['usage_bytes'] = usage_bytes
+            self.stats['collections'] += 1
+            self.stats['evicted_folders'] += evicted_folders
+            self.stats['evicted_bytes'] += evicted_bytes
+            stats = dict(self.stats)
+        logging.info("Workspace usage after removing %s folders (%s bytes): %s", str(evicted_folders), str(evicted_bytes),
+                     str(stats))
+
+
+class ClowderClient():
+    """Makes requests to Clowder over a pool of reused connections"""
+
+    def __init__(self, host: str, key: str, connector: connectors.Connector = None, pool_size: int = CLOWDER_POOL_SIZE,
+                 timeout_sec: float = CLOWDER_TIMEOUT_SEC):
+        """Initializes class instance
+        Arguments:
+            host: the URL of the Clowder instance
+            key: the key to make requests with
+            connector: optional instance of the pyclowder connector object used to check for locally mounted files
+            pool_size: the maximum number of connections to keep open
+            timeout_sec: the number of seconds to wait for a response from Clowder
+        Notes:
+            GET, PUT, DELETE, and HEAD requests are retried with an exponentially increasing wait when a connection fails
+            or when Clowder responds with one of the status codes in CLOWDER_RETRY_STATUS_CODES
+        """
+        self.host = host if host.endswith('/') else host + '/'
+        self.key = key
+        self.connector = connector
+        self.pool_size = pool_size
+        self.timeout_sec = timeout_sec
+        self.verify = connector.ssl_verify if connector and hasattr(connector, 'ssl_verify') else True
+
+        retry = Retry(total=CLOWDER_RETRIES, backoff_factor=CLOWDER_BACKOFF_SEC, status_forcelist=CLOWDER_RETRY_STATUS_CODES,
+                      allowed_methods=frozenset(['GET', 'PUT', 'DELETE', 'HEAD']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        """Returns the instance for use in a 'with' statement"""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Closes the connections when leaving a 'with' statement"""
+        self.close()
+
+    def close(self) -> None:
+        """Closes any open connections"""
+        self.session.close()
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """Makes a request to Clowder
+        Arguments:
+            method: the HTTP method of the request
+            path: the path of the request after the 'api/' portion of the URL
+            kwargs: additional arguments for the request
+        Return:
+            Returns the response
+        Exceptions:
+            Raises requests.HTTPError if Clowder returns an error
+        """
+        params = kwargs.pop('params', {})
+        params['key'] = self.key
+        kwargs.setdefault('timeout', self.timeout_sec)
+        kwargs.setdefault('verify', self.verify)
+        url = '%sapi/%s' % (self.host, path)
+        logging.debug("Clowder request: %s '%s'", method, url)
+        result = self.session.request(method, url, params=params, **kwargs)
+        result.raise_for_status()
+        return result
+
+    def get_dataset_id(self, dataset_name: str) -> Optional[str]:
+        """Looks up the ID of a dataset
+        Arguments:
+            dataset_name: the name of the dataset to find
+        Return:
+            Returns the ID of the dataset or None if it's not found
+        Notes:
+            Previously found IDs are returned from DATASET_ID_CACHE without making a request
+        """
+        found, dataset_id = DATASET_ID_CACHE.lookup(self.host, dataset_name)
+        if found:
+            logging.debug("Using cached dataset ID for '%s': %s", dataset_name, str(dataset_id))
+            return dataset_id
+
+        result = self.request('GET', 'datasets', params={'title': dataset_name, 'exact': 'true'})
+        for one_dataset in result.json():
+            if 'id' in one_dataset:
+                DATASET_ID_CACHE.store(self.host, dataset_name, one_dataset['id'])
+                return one_dataset['id']
+        return None
+
+    def get_dataset_file_ids(self, dataset_id: str) -> list:
+        """Returns the IDs of the files in a dataset
+        Arguments:
+            dataset_id: the ID of the dataset
+        Return:
+            Returns the list of file IDs
+        """
+        result = self.request('GET', 'datasets/%s/files' % dataset_id)
+        return [one_file['id'] for one_file in result.json() if 'id' in one_file]
+
+    def prefetch_dataset_ids(self, dataset_names: list) -> None:
+        """Looks up the IDs of many datasets with one request and caches them
+        Arguments:
+            dataset_names: the names of the datasets to look up
+        Notes:
+            All datasets with titles containing the longer of the common prefix or suffix of the names are fetched.
+            Names that aren't returned are not cached, so they're looked up again before a dataset is created for them.
+            Nothing is fetched if the names don't share a long enough prefix or suffix
+        """
+        uncached_names = set(one_name for one_name in dataset_names if not DATASET_ID_CACHE.lookup(self.host, one_name)[0])
+        if len(uncached_names) < 2:
+            return
+        prefix = os.path.commonprefix(list(uncached_names))
+        suffix = os.path.commonprefix([one_name[::-1] for one_name in uncached_names])[::-1]
+        search_title = prefix if len(prefix) >= len(suffix) else suffix
+        if len(search_title) < DATASET_PREFETCH_MIN_LENGTH:
+            logging.debug("Skipping dataset prefetch, common part of names is too short: '%s'", search_title)
+            return
+
+        logging.debug("Prefetching IDs of %s datasets with names containing '%s'", str(len(uncached_names)), search_title)
+        result = self.request('GET', 'datasets', params={'title': search_title, 'exact': 'false',
+                                                         'limit': DATASET_PREFETCH_LIMIT})
+        found_datasets = result.json()
+        for one_dataset in found_datasets:
+            if 'id' in one_dataset and one_dataset.get('name') in uncached_names:
+                DATASET_ID_CACHE.store(self.host, one_dataset['name'], one_dataset['id'])
+
+    def create_dataset(self, dataset_name: str) -> str:
+        """Creates a dataset. Assumes dataset does not exist already
+        Arguments:
+            dataset_name: the name of the dataset to create
+        Return:
+            Returns the ID of the new dataset
+        Exceptions:
+            Raises RuntimeError if Clowder's response isn't understood
+        """
+        result = self.request('POST', 'datasets/createempty', json={'name': dataset_name, 'description': ''})
+
+        return_json = result.json()
+        if 'id' not in return_json:
+            logging.debug("Unknown result JSON from create dataset: %s", str(return_json))
+            raise RuntimeError("Return result from creating dataset has changed and is not supported")
+
+        DATASET_ID_CACHE.store(self.host, dataset_name, return_json['id'])
+        return return_json['id']
+
+    def remove_dataset_metadata(self, dataset_id: str) -> None:
+        """Removes the metadata of a dataset
+        Arguments:
+            dataset_id: the ID of the dataset
+        """
+        self.request('DELETE', 'datasets/%s/metadata.jsonld' % dataset_id)
+
+    def upload_dataset_metadata(self, dataset_id: str, metadata: dict) -> None:
+        """Adds metadata to a dataset
+        Arguments:
+            dataset_id: the ID of the dataset
+            metadata: the JSON-LD metadata to add
+        """
+        self.request('POST', 'datasets/%s/metadata.jsonld' % dataset_id, json=metadata)
+
+    def remove_file_metadata(self, file_id: str) -> None:
+        """Removes the metadata of a file
+        Arguments:
+            file_id: the ID of the file
+        """
+        self.request('DELETE', 'files/%s/metadata.jsonld' % file_id)
+
+    def upload_file_metadata(self, file_id: str, metadata: dict) -> None:
+        """Adds metadata to a file
+        Arguments:
+            file_id: the ID of the file
+            metadata: the JSON-LD metadata to add
+        """
+        self.request('POST', 'files/%s/metadata.jsonld' % file_id, json=metadata)
+
+    def upload_file(self, dataset_id: str, file_path: str) -> Optional[str]:
+        """Uploads a file into a dataset
+        Arguments:
+            dataset_id: the ID of the dataset
+            file_path: the path of the file to upload
+        Return:
+            Returns the ID of the uploaded file, or None if the file wasn't uploaded
+        Notes:
+            Files on paths the connector has mounted locally are added by pyclowder without uploading their contents
+        """
+        if self.connector and hasattr(self.connector, 'mounted_paths') and self.connector.mounted_paths:
+            for one_path in self.connector.mounted_paths.values():
+                if file_path.startswith(one_path):
+                    return files.upload_to_dataset(self.connector, self.host, self.key, dataset_id, file_path)
+
+        if not os.path.exists(file_path):
+            logging.error("Unable to upload missing file: '%s'", file_path)
+            return None
+        with open(file_path, 'rb') as in_file:
+            encoder = MultipartEncoder(fields={'file': (os.path.basename(file_path), in_file)})
+            result = self.request('POST', 'uploadToDataset/%s' % dataset_id, data=encoder,
+                                  headers={'Content-Type': encoder.content_type})
+        return_json = result.json()
+        return return_json['id'] if 'id' in return_json else None
 
 
 class __internal__():
@@ -200,7 +994,49 @@ class __internal__():
         os.chmod(folder_path, CREATED_FOLDER_PERMISSIONS)
 
     @staticmethod
-    def create_env_json(out_folder: str, image_subfolder: str, mount_volume_name: str, workflow_step: dict, resources: dict) -> dict:
+    def resume_folder_name(dataset_id: str, file_ids: list) -> str:
+        """Returns the name of the working folder used for a message when resuming interrupted runs
+        Arguments:
+            dataset_id: the ID of the dataset of the message
+            file_ids: the IDs of the files in the dataset
+        Return:
+            Returns the folder name, which is the same for every message of the dataset with the same files
+        """
+        key = hashlib.sha256(json.dumps([dataset_id, sorted(file_ids)]).encode('utf-8')).hexdigest()
+        return 'resume_' + key[:32]
+
+    @staticmethod
+    def load_run_info(working_folder: str) -> dict:
+        """Loads the run information of a message's working folder
+        Arguments:
+            working_folder: the working folder of the message
+        Return:
+            Returns the run information, or an empty dict if there isn't any
+        """
+        try:
+            with open(os.path.join(working_folder, RUN_INFO_FILE_NAME), 'r') as in_file:
+                return json.load(in_file)
+        except (FileNotFoundError, json.JSONDecodeError) as ex:
+            logging.debug("No run information loaded from working folder '%s': %s", working_folder, str(ex))
+        return {}
+
+    @staticmethod
+    def save_run_info(working_folder: str, run_info: dict) -> None:
+        """Saves the run information of a message's working folder
+        Arguments:
+            working_folder: the working folder of the message
+            run_info: the run information to save
+        Notes:
+            The file is replaced in one step so that an interrupted save leaves the earlier information in place
+        """
+        info_path = os.path.join(working_folder, RUN_INFO_FILE_NAME)
+        with open(info_path + '.tmp', 'w') as out_file:
+            json.dump(run_info, out_file, indent=2)
+        os.replace(info_path + '.tmp', info_path)
+
+    @staticmethod
+    def create_env_json(out_folder: str, image_subfolder: str, mount_volume_name: str, workflow_step: dict, resources: dict,
+                        separate_results: bool = False) -> dict:
         """Creates the json used by executing workflow steps
         Arguments:
             out_folder: the folder to write the json to
@@ -208,6 +1044,7 @@ class __internal__():
             mount_volume_name: the name of the volume to mount to running containers
             workflow_step: the information on the current workflow step
             resources: the resources associated with the request
+            separate_results: when True the step's results are always placed in their own folder
         Return:
             The environment dict for the specified step
         Exceptions:
@@ -229,6 +1066,10 @@ class __internal__():
         env['CACHE_DIR'] = os.path.join(env['BASE_DIR'], env['RELATIVE_WORKING_FOLDER'], "cache") + '/'
         # Get the folders for our files
         env['DATA_FOLDER_NAME'] = os.path.join(env['RELATIVE_WORKING_FOLDER'], 'images').lstrip('/\\')
+        # Where scripts used by the workflow step are copied to
+        env['SCRIPT_FOLDER'] = os.path.join(env['BASE_DIR'], env['RELATIVE_WORKING_FOLDER'])
+        # Keeps the names of containers started for different messages unique
+        env['CONTAINER_NAME_SUFFIX'] = os.path.basename(image_subfolder.strip('/\\'))
 
         # Get the experiment information file
         found_experiment = None
@@ -245,12 +1086,136 @@ class __internal__():
 
         # Where we want the results.json file to be located
         env['RESULTS_FILE_PATH'] = out_folder.rstrip('/\\') + '/'
-        if 'use_extended_results_path' in workflow_step:
+        if separate_results or 'use_extended_results_path' in workflow_step:
             env['RESULTS_FILE_PATH'] = os.path.join(env['RESULTS_FILE_PATH'], data_folder_name) + '/'
         env['RESULTS_FILE_NAMES'] = [WORKFLOW_STEP_RESULT_FILE_NAME, WORKFLOW_STEP_CACHE_FILE_NAME]
+        env['CURRENT_STEP_CACHE_JSON'] = os.path.join(env['RESULTS_FILE_PATH'], WORKFLOW_STEP_CACHE_FILE_NAME)
+
+        # How containers are run by workflows that can process several files with each container run
+        env['CONTAINER_BATCH_SIZE'] = max(int(workflow_step['container_batch_size']), 1) \
+            if 'container_batch_size' in workflow_step else 1
+        env['CONTAINER_ENTRYPOINT'] = workflow_step['container_entrypoint'] if 'container_entrypoint' in workflow_step else ''
+
+        # Workflows that can split their image into tiles process it whole unless tiles are added
+        env['TILE_LIST'] = []
+        # Workflows that support it hand caching results to a resident service when its socket is set
+        env['CACHE_RESULTS_SOCKET'] = ''
 
         return env
 
+    @staticmethod
+    def create_tile_list(image_path: str, tile_size: int, tile_overlap: int) -> list:
+        """Returns the tiles an image is split into
+        Arguments:
+            image_path: the path to the image
+            tile_size: the width and height of the tiles in pixels, not counting their overlap
+            tile_overlap: the number of pixels each tile overlaps its neighbors by
+        Return:
+            Returns a list of tiles, which is empty when the image fits in one tile. Each tile has a 'NAME', the
+            'WINDOW' of the image it covers, and the 'CORE' window within the tile that doesn't overlap other tiles; the
+            windows are [x offset, y offset, width, height] lists
+        Exceptions:
+            Raises RuntimeError if the image can't be opened
+        Notes:
+            The image isn't split if GDAL isn't available
+        """
+        if tile_size <= 0:
+            return []
+        if gdal is None:
+            logging.warning("Processing '%s' without splitting it into tiles since GDAL is not available", image_path)
+            return []
+        image = gdal.Open(image_path)
+        if image is None:
+            raise RuntimeError("Unable to open image to split into tiles: '%s'" % image_path)
+        width, height = image.RasterXSize, image.RasterYSize
+        image = None
+        if width <= tile_size and height <= tile_size:
+            return []
+
+        tile_overlap = max(tile_overlap, 0)
+        tiles = []
+        for row, core_y in enumerate(range(0, height, tile_size)):
+            for col, core_x in enumerate(range(0, width, tile_size)):
+                core_width, core_height = min(tile_size, width - core_x), min(tile_size, height - core_y)
+                left, top = max(core_x - tile_overlap, 0), max(core_y - tile_overlap, 0)
+                right = min(core_x + core_width + tile_overlap, width)
+                bottom = min(core_y + core_height + tile_overlap, height)
+                tiles.append({'NAME': 'tile_%s_%s' % (str(row), str(col)),
+                              'WINDOW': [left, top, right - left, bottom - top],
+                              'CORE': [core_x - left, core_y - top, core_width, core_height]})
+        logging.info("Splitting %s x %s pixel image '%s' into %s tiles", str(width), str(height), image_path, str(len(tiles)))
+        return tiles
+
+    @staticmethod
+    def stage_file(source_path: str, dest_path: str, stats: dict = None) -> str:
+        """Places the source file at the destination using the least expensive method available
+        Arguments:
+            source_path: the path of the file to stage
+            dest_path: the path to stage the file to; an existing file is replaced
+            stats: optional dict of strategy names to dicts of 'files' and 'bytes' counts to update
+        Return:
+            Returns the name of the strategy used to stage the file (one of STAGING_STRATEGIES)
+        Notes:
+            The strategies in STAGING_STRATEGIES are tried in order: a hard link shares the source file, so staged
+            files must be treated as read-only; a reflink shares the source file's blocks until either is changed;
+            copy_file_range() lets the kernel (or file server) perform the copy; the final fallback is a normal copy.
+            Files with an extension in STAGING_NO_LINK_EXTENSIONS are never hard linked
+        """
+        if os.path.lexists(dest_path):
+            os.unlink(dest_path)
+
+        strategy = None
+        if os.path.splitext(dest_path)[1].lower() not in STAGING_NO_LINK_EXTENSIONS:
+            try:
+                os.link(source_path, dest_path)
+                strategy = 'hardlink'
+            except OSError as ex:
+                logging.debug("Unable to hard link '%s' to '%s': %s", source_path, dest_path, str(ex))
+
+        if strategy is None:
+            with open(source_path, 'rb') as in_file, open(dest_path, 'wb') as out_file:
+                try:
+                    fcntl.ioctl(out_file.fileno(), STAGING_REFLINK_IOCTL, in_file.fileno())
+                    strategy = 'reflink'
+                except OSError as ex:
+                    logging.debug("Unable to reflink '%s' to '%s': %s", source_path, dest_path, str(ex))
+
+                if strategy is None and hasattr(os, 'copy_file_range'):
+                    try:
+                        while os.copy_file_range(in_file.fileno(), out_file.fileno(), STAGING_COPY_CHUNK_SIZE) > 0:
+                            pass
+                        strategy = 'copy_file_range'
+                    except OSError as ex:
+                        if ex.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                            raise
+                        logging.debug("Unable to use copy_file_range for '%s' to '%s': %s", source_path, dest_path, str(ex))
+
+        if strategy is None:
+            shutil.copyfile(source_path, dest_path)
+            strategy = 'copy'
+
+        if stats is not None:
+            if strategy not in stats:
+                stats[strategy] = {'files': 0, 'bytes': 0}
+            stats[strategy]['files'] += 1
+            stats[strategy]['bytes'] += os.path.getsize(dest_path)
+
+        return strategy
+
+    @staticmethod
+    def log_staging_stats(stats: dict, dest_dir: str) -> None:
+        """Logs a summary of how files were staged
+        Arguments:
+            stats: the staging statistics as updated by stage_file()
+            dest_dir: the folder the files were staged into
+        """
+        for strategy in STAGING_STRATEGIES:
+            if strategy in stats:
+                logging.info("Staged %s files (%s bytes) to '%s' using %s", str(stats[strategy]['files']),
+                             str(stats[strategy]['bytes']), dest_dir, strategy)
+        avoided_bytes = sum(stats[strategy]['bytes'] for strategy in ['hardlink', 'reflink'] if strategy in stats)
+        logging.info("Avoided copying %s bytes while staging files to '%s'", str(avoided_bytes), dest_dir)
+
     @staticmethod
     def relocate_files(env: dict, resources: Union[dict, str], copy_folders: bool = False) -> tuple:
         """Prepares the files for processing by relocating them
@@ -271,24 +1236,26 @@ class __internal__():
             source_list = [os.path.join(resources, file_name) for file_name in os.listdir(resources)]
         else:
             raise RuntimeError("Parameter 'resource' must be of type dict or str for relocate_files() call")
+        staging_stats = {}
         for one_file in source_list:
             if one_file.endswith(env['EXPERIMENT_METADATA_RELATIVE_PATH']):
                 updated_experiment_metadata_path = os.path.join(env['BASE_DIR'], env['RELATIVE_WORKING_FOLDER'], os.path.basename(one_file))
-                logging.debug("Copying experiment metadata '%s' to '%s'", one_file, updated_experiment_metadata_path)
-                shutil.copyfile(one_file, updated_experiment_metadata_path)
+                logging.debug("Staging experiment metadata '%s' to '%s'", one_file, updated_experiment_metadata_path)
+                __internal__.stage_file(one_file, updated_experiment_metadata_path, staging_stats)
             elif os.path.isfile(one_file):
                 if not os.path.basename(one_file).lower() == WORKFLOW_STEP_RESULT_FILE_NAME:
                     dest_filename = os.path.join(dest_dir, os.path.basename(one_file))
-                    logging.debug("Copying file '%s' to '%s'", one_file, dest_filename)
-                    shutil.copyfile(one_file, dest_filename)
+                    logging.debug("Staging file '%s' to '%s'", one_file, dest_filename)
+                    __internal__.stage_file(one_file, dest_filename, staging_stats)
                 else:
                     logging.debug("Skipping result file: '%s'", one_file)
             elif os.path.isdir(one_file):
                 if copy_folders:
                     dest_folder = os.path.join(dest_dir, os.path.basename(one_file))
-                    logging.debug("Copying folder '%s' to '%s'", one_file, dest_folder)
+                    logging.debug("Staging folder '%s' to '%s'", one_file, dest_folder)
                     try:
-                        shutil.copytree(one_file, dest_folder)
+                        shutil.copytree(one_file, dest_folder,
+                                        copy_function=lambda src, dst: __internal__.stage_file(src, dst, staging_stats))
                     except Exception as ex:
                         logging.warning("Copying folder '%s' to '%s'", one_file, dest_folder)
                         logging.warning("Exception caught copying folder: %s", str(ex))
@@ -296,15 +1263,326 @@ class __internal__():
                     logging.debug("Skipping copying of folder '%s'", one_file)
             else:
                 logging.warning("Skipping copying of unknown path type: '%s'", one_file)
+        __internal__.log_staging_stats(staging_stats, dest_dir)
 
-        # Copy any needed scripts
-        source_filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache_results.py')
-        dest_filename = os.path.join(env['BASE_DIR'], env['RELATIVE_WORKING_FOLDER'], os.path.basename(source_filename))
-        logging.debug("Copying script '%s' to '%s'", source_filename, dest_filename)
-        shutil.copyfile(source_filename, dest_filename)
+        __internal__.copy_scripts(env)
 
         return dest_dir, updated_experiment_metadata_path
 
+    @staticmethod
+    def copy_scripts(env: dict) -> None:
+        """Copies any scripts needed by the workflow step to the step's script folder
+        Arguments:
+            env: the environment to be used for this workflow step
+        """
+        for one_name in WORKFLOW_SCRIPT_FILE_NAMES:
+            source_filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), one_name)
+            dest_filename = os.path.join(env['SCRIPT_FOLDER'], os.path.basename(source_filename))
+            logging.debug("Copying script '%s' to '%s'", source_filename, dest_filename)
+            shutil.copyfile(source_filename, dest_filename)
+
+    @staticmethod
+    def makeflow_command(makeflow_file: str, jx_args_files: list, log_file: str = None, env: dict = None,
+                         batch_options: list = None) -> list:
+        """Returns the command line for running makeflow
+        Arguments:
+            makeflow_file: the path to the JX workflow file to run
+            jx_args_files: the list of JSON files containing the arguments for the workflow
+            log_file: optional path of the makeflow transaction log; makeflow's default is used when not specified
+            env: optional environment of the workflow step whose STEP_CORES and STEP_MEMORY_MB limit the resources
+                 makeflow's local jobs may use together
+            batch_options: optional makeflow options selecting how the workflow's jobs are run (see batch_options())
+        Return:
+            Returns the command as a list
+        """
+        cmd = [os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cctools/bin/makeflow'), '--jx', makeflow_file]
+        if log_file:
+            cmd.extend(['-l', log_file])
+        if env and 'STEP_CORES' in env:
+            cmd.extend(['--local-cores', str(env['STEP_CORES']), '--local-memory', str(env['STEP_MEMORY_MB'])])
+        if batch_options:
+            cmd.extend(batch_options)
+        for one_file in jx_args_files:
+            cmd.append('--jx-args')
+            cmd.append(one_file)
+        return cmd
+
+    @staticmethod
+    def batch_options(batch_type: str, base_dir: str, wq_project: str = None, wq_port: int = 0,
+                      wq_password_file: str = None, port_file: str = None) -> list:
+        """Returns the makeflow options for running jobs with the batch type
+        Arguments:
+            batch_type: one of BATCH_TYPES
+            base_dir: the folder shared by the extractor and any workers (the workflow steps' BASE_DIR)
+            wq_project: the Work Queue project name workers find the workflow by through the catalog server
+            wq_port: the port workers connect to; zero to use any available port
+            wq_password_file: optional file containing the password workers need to connect
+            port_file: optional file makeflow writes the port workers connect to into
+        Return:
+            Returns the list of options
+        Exceptions:
+            Raises RuntimeError if the batch type isn't supported
+        Notes:
+            The rules that run on Work Queue workers declare their files as absolute paths under base_dir, which makeflow
+            is told is a shared file system so that it doesn't transfer the files to and from the workers. The containers
+            write the files into the named volume they mount, so each worker host needs the named volume backed by
+            storage shared with the extractor (a shared Docker volume driver when workers run on other hosts). Rules
+            marked as 'local_job' are always run by the extractor
+        """
+        if batch_type == 'local':
+            return []
+        if batch_type != 'wq':
+            raise RuntimeError("Unsupported makeflow batch type '%s', expected one of %s" % (batch_type, str(BATCH_TYPES)))
+
+        options = ['-T', 'wq', '--port', str(wq_port), '--shared-fs', base_dir.rstrip('/')]
+        if wq_project:
+            options.extend(['-N', wq_project])
+        if wq_password_file:
+            options.extend(['--password', wq_password_file])
+        if port_file:
+            options.extend(['-Z', port_file])
+        return options
+
+    @staticmethod
+    def create_dag_workflow(out_folder: str, step_envs: list) -> str:
+        """Creates a single JX workflow that runs all the workflow steps
+        Arguments:
+            out_folder: the folder to write the workflow to
+            step_envs: a list of (workflow step, environment) tuples in execution order
+        Return:
+            Returns the path of the written workflow file
+        Notes:
+            The first step's files are expected to be relocated already. Each following step has a rule that stages the
+            previous step's cache into its images folder (the same way relocate_files() does) once the previous step's
+            cache file list has been written, followed by a rule that runs the step's own workflow
+        """
+        script_folder = os.path.dirname(os.path.realpath(__file__))
+        rules = []
+        previous_env = None
+        for workflow_step, env in step_envs:
+            experiment_path = os.path.join(env['BASE_DIR'], env['EXPERIMENT_METADATA_RELATIVE_PATH'])
+            makeflow_file = os.path.join(script_folder, workflow_step['makeflow_file'])
+            if previous_env:
+                data_folder = os.path.join(env['BASE_DIR'], env['DATA_FOLDER_NAME'])
+                if 'copy_cached_folders' in workflow_step and workflow_step['copy_cached_folders']:
+                    copy_command = "cp -r --reflink=auto \"${SOURCE_DIR}.\" \"${DATA_DIR}/\""
+                else:
+                    copy_command = "find \"${SOURCE_DIR}\" -maxdepth 1 -type f ! -name \"%s\" -exec cp --reflink=auto {} \"${DATA_DIR}/\" \\;" % \
+                                   WORKFLOW_STEP_RESULT_FILE_NAME
+                rules.append({
+                    'command': "echo Staging step \"${NAME}\" && mkdir -p \"${DATA_DIR}\" && " + copy_command +
+                               " && cp \"${SOURCE_DIR}${EXPERIMENT_FILE}\" \"${EXPERIMENT_PATH}\"",
+                    'local_job': True,
+                    'environment': {
+                        'NAME': workflow_step['name'],
+                        'SOURCE_DIR': previous_env['CACHE_DIR'],
+                        'DATA_DIR': data_folder,
+                        'EXPERIMENT_FILE': os.path.basename(experiment_path),
+                        'EXPERIMENT_PATH': experiment_path
+                    },
+                    'inputs': [previous_env['CURRENT_STEP_CACHE_JSON']],
+                    'outputs': [experiment_path]
+                })
+                makeflow_file += ' --jx-args ' + previous_env['CURRENT_STEP_CACHE_JSON']
+
+            rules.append({
+                'workflow': makeflow_file,
+                'args': env,
+                'inputs': [experiment_path],
+                'outputs': [env['CURRENT_STEP_CACHE_JSON']]
+            })
+            previous_env = env
+
+        workflow_filename = os.path.join(out_folder, 'workflow.jx')
+        logging.debug("Creating workflow file: '%s'", workflow_filename)
+        with open(workflow_filename, 'w') as out_file:
+            json.dump({'rules': rules}, out_file, indent=2)
+
+        return workflow_filename
+
+    @staticmethod
+    def step_cache_key(env: dict, workflow_step: dict, jx_args_files: list, message_folder: str) -> str:
+        """Returns the key identifying a run of a workflow step with specific inputs
+        Arguments:
+            env: the environment to be used for this workflow step
+            workflow_step: the information on the current workflow step
+            jx_args_files: the JSON files containing the arguments for the workflow step (the first is env.json)
+            message_folder: the name of the working folder of the current message
+        Return:
+            Returns the key as a hex string
+        Notes:
+            The key is a hash of the step's name, image version, and JX workflow; the names and contents of the step's
+            input files (limited to 'cache_input_extensions' if the step specifies it); any cached file lists from the
+            previous step; and the experiment metadata without any Clowder information. Message-specific folder names
+            are removed before hashing
+        """
+        def strip_clowder(value):
+            """Returns a copy of the value with all 'clowder' keys removed from dicts"""
+            if isinstance(value, dict):
+                return {key: strip_clowder(item) for key, item in value.items() if str(key).lower() != 'clowder'}
+            if isinstance(value, list):
+                return [strip_clowder(item) for item in value]
+            return value
+
+        key_hash = hashlib.sha256()
+        key_hash.update(json.dumps([workflow_step['name'], workflow_step['docker_version_number']]).encode('utf-8'))
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), workflow_step['makeflow_file']), 'rb') as in_file:
+            key_hash.update(in_file.read())
+
+        # The input files
+        extensions = None
+        if 'cache_input_extensions' in workflow_step and workflow_step['cache_input_extensions']:
+            extensions = tuple(one_ext.lower() for one_ext in workflow_step['cache_input_extensions'])
+        data_folder = os.path.join(env['BASE_DIR'], env['DATA_FOLDER_NAME'])
+        file_count = 0
+        for root_dir, dir_names, file_names in os.walk(data_folder):
+            dir_names.sort()
+            for one_name in sorted(file_names):
+                if extensions and not one_name.lower().endswith(extensions):
+                    continue
+                file_path = os.path.join(root_dir, one_name)
+                key_hash.update(os.path.relpath(file_path, data_folder).encode('utf-8') + b'\0')
+                with open(file_path, 'rb') as in_file:
+                    for chunk in iter(lambda: in_file.read(STEP_CACHE_HASH_CHUNK_SIZE), b''):
+                        key_hash.update(chunk)
+                file_count += 1
+
+        # Cached file lists from the previous step
+        for one_file in jx_args_files[1:]:
+            with open(one_file, 'r') as in_file:
+                key_hash.update(in_file.read().replace('/' + message_folder + '/', '/').encode('utf-8'))
+
+        # The experiment metadata
+        experiment_path = os.path.join(env['BASE_DIR'], env['EXPERIMENT_METADATA_RELATIVE_PATH'])
+        with open(experiment_path, 'r') as in_file:
+            if os.path.splitext(experiment_path)[1] in ('.yml', '.yaml'):
+                experiment_metadata = yaml.safe_load(in_file)
+            else:
+                experiment_metadata = json.load(in_file)
+        key_hash.update(json.dumps(strip_clowder(experiment_metadata), sort_keys=True, default=str).encode('utf-8'))
+
+        logging.debug("Step cache key for '%s' from %s input files: %s", workflow_step['name'], str(file_count),
+                      key_hash.hexdigest())
+        return key_hash.hexdigest()
+
+    @staticmethod
+    def copy_step_cache_folder(source_dir: str, dest_dir: str, replace_folder: tuple = None, top_level_names: list = None) -> int:
+        """Copies a folder tree into or out of the step cache
+        Arguments:
+            source_dir: the folder to copy
+            dest_dir: the folder to copy to
+            replace_folder: optional tuple of a folder name found in JSON files and the folder name to replace it with
+            top_level_names: optional list of the file names to limit copying to; sub-folders are not copied
+        Return:
+            Returns the number of files copied
+        Notes:
+            Files are staged with stage_file() so they should be treated as read-only; the files that later steps rewrite
+            or append to aren't hard linked (see STAGING_NO_LINK_EXTENSIONS). JSON files are rewritten instead of staged
+            when replace_folder is specified, and replace any existing file so that a file it shares is left unchanged
+        """
+        file_count = 0
+        for root_dir, dir_names, file_names in os.walk(source_dir):
+            if top_level_names is not None:
+                dir_names.clear()
+                file_names = [one_name for one_name in file_names if one_name in top_level_names]
+            cur_dest_dir = os.path.join(dest_dir, os.path.relpath(root_dir, source_dir))
+            os.makedirs(cur_dest_dir, exist_ok=True)
+            for one_name in file_names:
+                source_path = os.path.join(root_dir, one_name)
+                dest_path = os.path.join(cur_dest_dir, one_name)
+                if replace_folder and one_name.lower().endswith('.json'):
+                    with open(source_path, 'r') as in_file:
+                        contents = in_file.read()
+                    with open(dest_path + '.tmp', 'w') as out_file:
+                        out_file.write(contents.replace('/' + replace_folder[0] + '/', '/' + replace_folder[1] + '/'))
+                    os.replace(dest_path + '.tmp', dest_path)
+                else:
+                    __internal__.stage_file(source_path, dest_path)
+                file_count += 1
+        return file_count
+
+    @staticmethod
+    def save_step_cache(step_cache_dir: str, cache_key: str, env: dict, workflow_step: dict, message_folder: str) -> None:
+        """Saves the results of a workflow step run to the step cache
+        Arguments:
+            step_cache_dir: the folder of the step cache
+            cache_key: the key of the workflow step run
+            env: the environment used for this workflow step
+            workflow_step: the information on the workflow step
+            message_folder: the name of the working folder of the current message
+        """
+        entry_dir = os.path.join(step_cache_dir, cache_key)
+        if os.path.isdir(entry_dir):
+            return
+
+        # Fill in a new folder and move it into place when it's complete
+        os.makedirs(step_cache_dir, exist_ok=True)
+        new_entry_dir = tempfile.mkdtemp(prefix=cache_key + '.', dir=step_cache_dir)
+        try:
+            file_count = __internal__.copy_step_cache_folder(env['CACHE_DIR'], os.path.join(new_entry_dir, 'cache'))
+            if 'discover_run_results' in workflow_step:
+                top_level_names = None
+            else:
+                top_level_names = env['RESULTS_FILE_NAMES']
+            file_count += __internal__.copy_step_cache_folder(env['RESULTS_FILE_PATH'], os.path.join(new_entry_dir, 'results'),
+                                                              top_level_names=top_level_names)
+            with open(os.path.join(new_entry_dir, STEP_CACHE_INFO_FILE_NAME), 'w') as out_file:
+                json.dump({'name': workflow_step['name'],
+                           'message_folder': message_folder,
+                           'created': datetime.datetime.now().isoformat(),
+                           'file_count': file_count}, out_file, indent=2)
+            os.rename(new_entry_dir, entry_dir)
+            logging.info("Saved %s files from workflow step '%s' to the step cache: '%s'", str(file_count),
+                         workflow_step['name'], entry_dir)
+        finally:
+            if os.path.isdir(new_entry_dir):
+                shutil.rmtree(new_entry_dir, ignore_errors=True)
+
+    @staticmethod
+    def restore_step_cache(step_cache_dir: str, cache_key: str, env: dict, workflow_step: dict, message_folder: str) -> bool:
+        """Restores the results of a previous run of a workflow step from the step cache
+        Arguments:
+            step_cache_dir: the folder of the step cache
+            cache_key: the key of the workflow step run
+            env: the environment to be used for this workflow step
+            workflow_step: the information on the workflow step
+            message_folder: the name of the working folder of the current message
+        Return:
+            Returns True if the results were restored and False if they're not in the cache
+        """
+        entry_dir = os.path.join(step_cache_dir, cache_key)
+        info_path = os.path.join(entry_dir, STEP_CACHE_INFO_FILE_NAME)
+        try:
+            in_file = open(info_path, 'r')
+        except FileNotFoundError:
+            return False
+
+        try:
+            # Keep the entry from being removed while restoring from it (see WorkspaceManager.lock_unused())
+            try:
+                fcntl.flock(in_file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info("Not restoring workflow step '%s' from step cache entry being removed: '%s'",
+                             workflow_step['name'], entry_dir)
+                return False
+            if os.fstat(in_file.fileno()).st_nlink == 0:
+                return False
+            entry_info = json.load(in_file)
+            replace_folder = (entry_info['message_folder'], message_folder)
+            file_count = __internal__.copy_step_cache_folder(os.path.join(entry_dir, 'cache'), env['CACHE_DIR'], replace_folder)
+            file_count += __internal__.copy_step_cache_folder(os.path.join(entry_dir, 'results'), env['RESULTS_FILE_PATH'],
+                                                              replace_folder)
+            os.utime(entry_dir)
+        except Exception as ex:
+            logging.warning("Unable to restore workflow step '%s' from the step cache '%s': %s", workflow_step['name'],
+                            entry_dir, str(ex))
+            return False
+        finally:
+            in_file.close()
+        logging.info("Restored %s files for workflow step '%s' from the step cache: '%s'", str(file_count),
+                     workflow_step['name'], entry_dir)
+        return True
+
     @staticmethod
     def setup_processing_step(env: dict, out_folder: str, workflow_step: dict) -> None:
         """Creates the json file to be used by the workflow step
@@ -321,48 +1599,113 @@ class __internal__():
         with open(env_filename, 'w') as out_file:
             json.dump(env, out_file, indent=2)
 
+    @staticmethod
+    def terminate_process_tree(proc: subprocess.Popen) -> None:
+        """Terminates the process and any processes it started
+        Arguments:
+            proc: the process to terminate
+        Notes:
+            The process is expected to be the leader of its own process group (see run_process()). The process group
+            is asked to terminate first and is killed if the process doesn't exit in PROC_TERMINATE_TIMEOUT_SEC seconds
+        """
+        logging.info("Terminating process group %s", str(proc.pid))
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait(timeout=PROC_TERMINATE_TIMEOUT_SEC)
+        except ProcessLookupError:
+            pass
+        except subprocess.TimeoutExpired:
+            logging.warning("Process %s did not exit after being terminated, killing it", str(proc.pid))
+
+        # Remove anything left behind in the process group
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+
+    @staticmethod
+    def run_process(cmd: list, timeout_sec: float = PROC_WAIT_TOTAL_SEC) -> int:
+        """Runs the command to completion while logging its output as it's produced
+        Arguments:
+            cmd: the command to run
+            timeout_sec: the maximum number of seconds the command is allowed to run
+        Return:
+            Returns the return code of the process
+        Exceptions:
+            Raises RuntimeError if the process runs longer than the timeout; the process and any processes it started
+            are stopped before the exception is raised
+        Notes:
+            Output is read until the process exits and its output is closed, or for PROC_EXIT_DRAIN_SEC seconds after it
+            exits if a process it started in the background keeps the output open
+        """
+        logging.debug("Running command: %s", str(cmd))
+        start_time = time.monotonic()
+        deadline = start_time + timeout_sec
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+
+        # Log the output until the process closes it, or we run out of time
+        partial_line = b''
+        with selectors.DefaultSelector() as selector:
+            selector.register(proc.stdout, selectors.EVENT_READ)
+            while selector.get_map():
+                if proc.poll() is not None and deadline > time.monotonic() + PROC_EXIT_DRAIN_SEC:
+                    deadline = time.monotonic() + PROC_EXIT_DRAIN_SEC
+                remaining_sec = deadline - time.monotonic()
+                if remaining_sec <= 0:
+                    break
+                for key, _ in selector.select(timeout=min(remaining_sec, PROC_POLL_SEC)):
+                    data = os.read(key.fd, PROC_READ_BUFFER_SIZE)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        continue
+                    lines = (partial_line + data).split(b'\n')
+                    partial_line = lines.pop()
+                    for one_line in lines:
+                        logging.debug(one_line.decode('utf-8', 'replace').rstrip())
+        if partial_line:
+            logging.debug(partial_line.decode('utf-8', 'replace').rstrip())
+
+        # Wait for the process to finish
+        try:
+            proc.wait(timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            msg = "Processing is running too long (%s sec): %s" % (str(time.monotonic() - start_time), str(cmd))
+            logging.error(msg)
+            __internal__.terminate_process_tree(proc)
+            raise RuntimeError(msg) from None
+        finally:
+            proc.stdout.close()
+
+        logging.info("Process completed")
+        logging.debug("Process return code: %s", str(proc.returncode))
+        return proc.returncode
+
     @staticmethod # Clowder
-    def create_dataset(host: str, request_key: str, dataset_name: str) -> str:
+    def create_dataset(clowder: ClowderClient, dataset_name: str) -> str:
         """Creates a dataset on the remote host. Assumes dataset does not exist already
         Arguments:
-            host: the URL of the origination request
-            request_key: the key associated with request
+            clowder: the client for making Clowder requests
             dataset_name: the name of the dataset to create
         """
-        url = '%sapi/datasets/createempty?key=%s' % (host, request_key)
-
-        result = requests.post(url, headers={'Content-Type': 'application/json'},
-                               data=json.dumps({'name': dataset_name, 'description': ''}))
-        result.raise_for_status()
-
-        return_json = result.json()
-        if 'id' not in return_json:
-            logging.debug("Unknown result JSON from create dataset: %s", str(return_json))
-            raise RuntimeError("Return result from creating dataset has changed and is not supported")
-
-        return return_json['id']
+        return clowder.create_dataset(dataset_name)
 
     @staticmethod # Clowder
-    def update_file_metadata(file_id: str, replace_metadata: bool, metadata: Union[str, dict], connector: connectors.Connector,
-                             host: str, request_key: str) -> None:
+    def update_file_metadata(file_id: str, replace_metadata: bool, metadata: Union[str, dict], clowder: ClowderClient) -> None:
         """Handles updating metadata associated with the file. Will add metadata if it doesn't exist already
         Arguments:
             file_id: Clowder ID of the file for which metadata is to be updated
             replace_metadata: set to True if existing metadata is to be removed
             metadata: the metadata to update with. If a string is specified, metadata is replaced
-            connector: an instance of the pyclowder connector object
-            host: the URL of the origination request
-            request_key: the key associated with request
+            clowder: the client for making Clowder requests
         Exceptions:
             Raises RuntimeError if the metadata is not properly formatted or other problems are found
         """
         try:
             # Remove metadata if asked
             if replace_metadata is True:
-                url = '%sapi/files/%s/metadata.jsonld?key=%s' % (host, file_id, request_key)
-                logging.debug("Deleting file metadata: '%s'", url)
-                result = requests.delete(url)
-                result.raise_for_status()
+                logging.debug("Deleting file metadata: '%s'", file_id)
+                clowder.remove_file_metadata(file_id)
 #        else:
 #            # Merge with existing metadata
 #            original_md = files.download_metadata(connector, host, request_key, file_id)
@@ -373,20 +1716,18 @@ class __internal__():
 
             # Update the metadata
             logging.debug("Updating file '%s' metadata with: %s", file_id, str(metadata))
-            files.upload_metadata(connector, host, request_key, file_id, metadata)
+            clowder.upload_file_metadata(file_id, metadata)
         except Exception as ex:
             logging.warning("update_file_metadata failed: %s", str(ex))
 
     @staticmethod # Clowder
-    def update_dataset_metadata(dataset_id: str, replace_metadata: bool, connector: connectors.Connector, host: str,
-                                request_key: str, container_metadata: dict = None) -> None:
+    def update_dataset_metadata(dataset_id: str, replace_metadata: bool, clowder: ClowderClient,
+                                container_metadata: dict = None) -> None:
         """Updates the metadata for the dataset
         Arguments:
             dataset_id: the Clowder ID of the dataset to update
             replace_metadata: set to True if existing metadata is to be removed, only relevant if container_metadata specified
-            connector: an instance of the pyclowder connector object
-            host: the URL of the origination request
-            request_key: the key associated with request
+            clowder: the client for making Clowder requests
             container_metadata: optional metadata for the container
         Exceptions:
             Raises RuntimeError if the metadata is not properly formatted or other problems are found
@@ -398,7 +1739,7 @@ class __internal__():
                 # Remove metadata if asked
                 if replace_metadata is True:
                     logging.debug("HACK: update_dataset_metadata: about to remove dataset metadata: %s", dataset_id)
-                    datasets.remove_metadata(connector, host, request_key, dataset_id)
+                    clowder.remove_dataset_metadata(dataset_id)
     #            else:
     #               # Merge with existing metadata
     #                original_md = datasets.download_metadata(connector, host, request_key, dataset_id)
@@ -409,76 +1750,106 @@ class __internal__():
 
                 # Update the metadata
                 logging.debug("HACK: update_dataset_metadata: about to upload container metadata: %s %s", dataset_id, container_metadata)
-                datasets.upload_metadata(connector, host, request_key, dataset_id, container_metadata)
+                clowder.upload_dataset_metadata(dataset_id, container_metadata)
         except Exception as ex:
             logging.debug("HACK: update_dataset_metadata: EXCEPTION CAUGHT: %s", str(ex))
 
     @staticmethod # Clowder
-    def upload_files(dataset_id: str, file_results: list, workflow_step: dict, connector: connectors.Connector, host: str,
-                     request_key: str) -> list:
+    def upload_one_file(dataset_id: str, one_result: dict, workflow_step: dict, clowder: ClowderClient) -> dict:
+        """Uploads one file, and any metadata associated with it, into the dataset
+        Arguments:
+            dataset_id: the ID of the dataset to upload the file into
+            one_result: the result file entry to upload
+            workflow_step: the information on the current workflow step
+            clowder: the client for making Clowder requests
+        Return:
+            Returns the result file entry with the Clowder ID of the file added as 'id'
+        Exceptions:
+            Raises RuntimeError if the file wasn't uploaded
+        """
+        # Perform either an upload or a soft upload
+        logging.debug("Uploading one file to dataset %s: '%s'", dataset_id, str(one_result['path']))
+        file_id = clowder.upload_file(dataset_id, one_result['path'])
+        if file_id is None:
+            raise RuntimeError("Unable to upload file to dataset ID %s: '%s'" % (dataset_id, one_result['path']))
+        logging.debug("    file ID: %s", str(file_id))
+
+        # Check if there's metadata associated with the file
+        if 'metadata' in one_result:
+            logging.debug("Uploading file metadata %s: '%s' %s", file_id, one_result['path'], str(one_result['metadata']))
+            replace_metadata = True
+            if 'replace' in one_result['metadata']:
+                replace_metadata = (not one_result['metadata']['replace']) is False
+            if 'data' in one_result['metadata']:
+                working_metadata = one_result['metadata']['data']
+            else:
+                working_metadata = one_result['metadata']
+
+            prepared_metadata = __internal__.prepare_metadata(clowder.host, workflow_step['docker_version_number'],
+                                                              workflow_step['makeflow_file'], working_metadata,
+                                                              file_id, target_is_dataset=False)
+            logging.debug("Prepared metadata for file upload: %s", str(prepared_metadata))
+            __internal__.update_file_metadata(file_id, replace_metadata, prepared_metadata, clowder)
+
+        return {**one_result, **{'id': file_id}}
+
+    @staticmethod # Clowder
+    def upload_files(dataset_id: str, file_results: list, workflow_step: dict, clowder: ClowderClient) -> list:
         """Uploads the specified files into the dataset
         Arguments:
             dataset_id: the ID of the dataset to upload files into
             file_results: the results file set to upload
             workflow_step: the information on the current workflow step
-            connector: an instance of the pyclowder connector object
-            host: the URL of the origination request
-            request_key: the key associated with request
+            clowder: the client for making Clowder requests
         Return:
-            Returns a list of information on the uploaded files.
+            Returns a list of information on the uploaded files, in the same order as file_results.
             [{
                 'path': <file path>,    # Path of the uploaded file (same as file_results entries)
                 'key': <file key>,      # Key associated with the file (same as file_results entries)
                 'id': <ID of uploaded file> # The Clowder ID of the file
             },
             ...]
+        Exceptions:
+            Raises RuntimeError if any of the files failed to upload, after all the other files have been attempted
+        Notes:
+            Files are uploaded concurrently using no more workers than the client has pooled connections
         """
+        if not file_results:
+            return []
+
+        max_workers = max(1, min(clowder.pool_size, len(file_results)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(__internal__.upload_one_file, dataset_id, one_result, workflow_step, clowder)
+                       for one_result in file_results]
+
         uploaded_files = []
-        for one_result in file_results:
-            # Perform either an upload or a soft upload
-            logging.debug("Uploading one file to dataset %s: '%s'", dataset_id, str(one_result['path']))
-            file_id = files.upload_to_dataset(connector, host, request_key, dataset_id, one_result['path'])
-            if file_id is None:
+        failed_files = []
+        for one_result, one_future in zip(file_results, futures):
+            upload_ex = one_future.exception()
+            if upload_ex is not None:
                 logging.error("Unable to upload file to dataset %s: '%s'", dataset_id, one_result['path'])
-                raise RuntimeError("Unable to upload file to dataset ID %s: '%s'" % (dataset_id, one_result['path']))
-            logging.debug("    file ID: %s", str(file_id))
-
-            # Check if there's metadata associated with the file
-            if 'metadata' in one_result:
-                logging.debug("Uploading file metadata %s: '%s' %s", file_id, one_result['path'], str(one_result['metadata']))
-                replace_metadata = True
-                if 'replace' in one_result['metadata']:
-                    replace_metadata = (not one_result['metadata']['replace']) is False
-                if 'data' in one_result['metadata']:
-                    working_metadata = one_result['metadata']['data']
-                else:
-                    working_metadata = one_result['metadata']
-
-                prepared_metadata = __internal__.prepare_metadata(host, workflow_step['docker_version_number'],
-                                                                  workflow_step['makeflow_file'], working_metadata,
-                                                                  file_id, target_is_dataset=False)
-                logging.debug("Prepared metadata for file upload: %s", str(prepared_metadata))
-                __internal__.update_file_metadata(file_id, replace_metadata, prepared_metadata, connector, host, request_key)
+                logging.error("    exception caught: %s", str(upload_ex))
+                failed_files.append(one_result['path'])
+                continue
+            uploaded_files.append(one_future.result())
 
-            # Save the file information
-            uploaded_files.append({**one_result, **{'id': file_id}})
+        if failed_files:
+            raise RuntimeError("Unable to upload %s of %s files to dataset ID %s: %s" %
+                               (str(len(failed_files)), str(len(file_results)), dataset_id, str(failed_files)))
 
         logging.debug("Uploaded %s files", str(len(uploaded_files)))
         return uploaded_files
 
     @staticmethod # Clowder
     def process_result_file(file_results: list, experiment_info: dict, workflow_step: dict, process_metadata: dict,
-                            connector: connectors.Connector, host: str, request_key: str, workstep_metadata: dict,
-                            clowder_credentials: dict, resources: dict) -> list:
+                            clowder: ClowderClient, workstep_metadata: dict, clowder_credentials: dict, resources: dict) -> list:
         """Processes the results as a Clowder dataset
         Arguments:
             file_results: the results file set to upload
             experiment_info: the experimental information
             workflow_step: the information on the current workflow step
             process_metadata: additional metadata for the container; may be None
-            connector: an instance of the pyclowder connector object
-            host: the URL of the origination request
-            request_key: the key associated with request
+            clowder: the client for making Clowder requests
             workstep_metadata: the metadata associated with this workstep
             clowder_credentials: the access information for clowder
             resources: the resources associated with this request
@@ -502,21 +1873,18 @@ class __internal__():
 
         # Load the files to the dataset
         logging.debug("process_result_file: found dataset ID: %s", str(dataset_id))
-        return __internal__.upload_files(dataset_id, file_results, workflow_step, connector, host, request_key)
+        return __internal__.upload_files(dataset_id, file_results, workflow_step, clowder)
 
     @staticmethod # Clowder
     def process_result_dataset(container_results: list, experiment_info: dict, workflow_step: dict, process_metadata: dict,
-                               connector: connectors.Connector, host: str, request_key: str, workstep_metadata: dict,
-                               clowder_credentials: dict, resources: dict) -> list:
+                               clowder: ClowderClient, workstep_metadata: dict, clowder_credentials: dict, resources: dict) -> list:
         """Processes the results as a Clowder dataset
         Arguments:
             container_results: the results for a container
             experiment_info: the experimental information
             workflow_step: the information on the current workflow step
             process_metadata: additional metadata for the container; may be None
-            connector: an instance of the pyclowder connector object
-            host: the URL of the origination request
-            request_key: the key associated with request
+            clowder: the client for making Clowder requests
             workstep_metadata: the metadata associated with this workstep
             clowder_credentials: the access information for clowder
             resources: the resources associated with this request
@@ -532,21 +1900,29 @@ class __internal__():
         # pylint: disable=unused-argument
         return_info = []
         template_metadata = deepcopy(workstep_metadata)
+        dataset_names = []
         for one_container in container_results:
             # Create the name of the dataset
             template_metadata['name'] = one_container['name']
             if 'dataset_name_template' in workflow_step:
-                dataset_name = workflow_step['dataset_name_template'].format(**template_metadata).replace(' ', '_')
+                dataset_names.append(workflow_step['dataset_name_template'].format(**template_metadata).replace(' ', '_'))
             else:
-                dataset_name = '{name}_{date}_{experiment}'.format(**template_metadata).replace(' ', '_')
+                dataset_names.append('{name}_{date}_{experiment}'.format(**template_metadata).replace(' ', '_'))
+
+        # Look up the datasets together before handling them one at a time
+        try:
+            clowder.prefetch_dataset_ids(dataset_names)
+        except requests.RequestException as ex:
+            logging.warning("Unable to prefetch dataset IDs, continuing with individual lookups: %s", str(ex))
 
+        for one_container, dataset_name in zip(container_results, dataset_names):
             # Check for dataset existence and create it if needed
             created_dataset = False
             logging.debug("Getting the ID for the dataset: %s", dataset_name)
-            dataset_id = extractors.get_datasetid_by_name(host, request_key, dataset_name)
+            dataset_id = clowder.get_dataset_id(dataset_name)
             if dataset_id is None:
                 logging.debug("Creating dataset: %s", dataset_name)
-                dataset_id = __internal__.create_dataset(host, request_key, dataset_name)
+                dataset_id = __internal__.create_dataset(clowder, dataset_name)
                 created_dataset = True
             logging.debug("Using dataset ID: %s", str(dataset_id))
 
@@ -556,7 +1932,7 @@ class __internal__():
             for key in ['file', 'files']:
                 if key in one_container:
                     logging.debug("Uploading files to dataset [key: %s]: %s", key, str(one_container[key]))
-                    uploaded_files = __internal__.upload_files(dataset_id, one_container[key], workflow_step, connector, host, request_key)
+                    uploaded_files = __internal__.upload_files(dataset_id, one_container[key], workflow_step, clowder)
 
             # Update the dataset metadata
             replace_metadata = True
@@ -573,12 +1949,12 @@ class __internal__():
                     logging.debug("Merging container metadata with process metadata")
                     working_metadata = {**working_metadata, **process_metadata}
 
-                container_metadata = __internal__.prepare_metadata(host, workflow_step['docker_version_number'],
+                container_metadata = __internal__.prepare_metadata(clowder.host, workflow_step['docker_version_number'],
                                                                    workflow_step['makeflow_file'], working_metadata,
                                                                    dataset_id, target_is_dataset=True)
                 logging.debug("Prepared metadata for dataset upload: %s", str(container_metadata))
 
-            __internal__.update_dataset_metadata(dataset_id, replace_metadata, connector, host, request_key, container_metadata)
+            __internal__.update_dataset_metadata(dataset_id, replace_metadata, clowder, container_metadata)
 
             return_info.append({'id': dataset_id, 'created': created_dataset, 'file_ids': uploaded_files})
 
@@ -586,49 +1962,197 @@ class __internal__():
         return return_info
 
     @staticmethod # Clowder
-    def process_results_json(proc_results: dict, experiment_info: dict, workflow_step: dict, connector: connectors.Connector,
-                             host: str, request_key: str, workstep_metadata: dict, clowder_credentials: dict, resources: dict) -> bool:
-        """Handles processing the results of running a workflow
+    def process_results_json(results_file: str, experiment_info: dict, workflow_step: dict, clowder: ClowderClient,
+                             workstep_metadata: dict, clowder_credentials: dict, resources: dict) -> bool:
+        """Handles processing the results file of running a workflow without loading the entire file
         Arguments:
-            proc_results: the results of the workflow process
+            results_file: the path of the results of the workflow process
             experiment_info: the experimental information
             workflow_step: the information on the current workflow step
-            connector: an instance of the pyclowder connector object
-            host: the URL of the origination request
-            request_key: the key associated with request
+            clowder: the client for making Clowder requests
+            workstep_metadata: the metadata associated with this workstep
+            clowder_credentials: the access information for clowder
+            resources: the resources associated with this request
+        Notes:
+            The file is read twice: first for the return code and other top-level values, and then for the containers and
+            files, which are handled a batch at a time
+        """
+        result_info = {key: value for key, value in cache_results.iter_results(results_file, RESULT_LIST_KEYS)
+                       if key not in RESULT_LIST_KEYS}
+        result_items = ((key, value) for key, value in cache_results.iter_results(results_file, RESULT_LIST_KEYS)
+                        if key in RESULT_LIST_KEYS)
+        return __internal__.process_result_items(result_info, result_items, experiment_info, workflow_step, clowder,
+                                                 workstep_metadata, clowder_credentials, resources)
+
+    @staticmethod # Clowder
+    def process_result_items(result_info: dict, result_items, experiment_info: dict, workflow_step: dict,
+                             clowder: ClowderClient, workstep_metadata: dict, clowder_credentials: dict, resources: dict) -> bool:
+        """Handles processing the containers and files in the results of running a workflow
+        Arguments:
+            result_info: the results of the workflow process without the containers and files
+            result_items: iterable of (key, value) tuples of the containers ('container' key) and files ('file' or 'files'
+                          keys) of the results
+            experiment_info: the experimental information
+            workflow_step: the information on the current workflow step
+            clowder: the client for making Clowder requests
             workstep_metadata: the metadata associated with this workstep
             clowder_credentials: the access information for clowder
             resources: the resources associated with this request
+        Notes:
+            Containers and files are handed to Clowder in batches of up to RESULT_PUBLISH_BATCH_SIZE items
         """
         # Check the return code for success
-        if not workflow_step['return_code_success'](proc_results['code']):
-            logging.error("Error code from processing: %s", str(proc_results['code']))
-            logging.debug("Processing results: %s", str(proc_results))
+        if not workflow_step['return_code_success'](result_info['code']):
+            logging.error("Error code from processing: %s", str(result_info['code']))
+            logging.debug("Processing results: %s", str(result_info))
             return False
 
         # Get additional information in the processing results
-        process_metadata_keys = set(proc_results.keys()).difference(frozenset(['container', 'file', 'files', 'code', 'error', 'message']))
+        process_metadata_keys = set(result_info.keys()).difference(frozenset(['code', 'error', 'message']))
         logging.debug("Found process metadata keys: %s", str(process_metadata_keys))
         process_metadata = {}
         for one_key in process_metadata_keys:
-            process_metadata[one_key] = proc_results[one_key]
+            process_metadata[one_key] = result_info[one_key]
 
         # Get the results sent to Clowder
-        logging.debug("About to check for 'container' in results")
-        if 'container' in proc_results:
-            logging.debug("Processing container as dataset: %s", proc_results['container'])
-            __internal__.process_result_dataset(proc_results['container'], experiment_info, workflow_step, process_metadata,
-                                                connector, host, request_key, workstep_metadata, clowder_credentials, resources)
-        logging.debug("About to check for 'file' in results")
-        for file_key in ['file', 'files']:
-            if file_key in proc_results:
-                logging.debug("Processing file (%s): %s", file_key, proc_results[file_key])
-                __internal__.process_result_file(proc_results[file_key], experiment_info, workflow_step, process_metadata,
-                                                 connector, host, request_key, workstep_metadata, clowder_credentials, resources)
+        def process_batch(key: str, batch: list) -> None:
+            """Processes a batch of containers or files"""
+            if key == 'container':
+                logging.debug("Processing %s containers as datasets", str(len(batch)))
+                __internal__.process_result_dataset(batch, experiment_info, workflow_step, process_metadata,
+                                                    clowder, workstep_metadata, clowder_credentials, resources)
+            else:
+                logging.debug("Processing %s files (%s)", str(len(batch)), key)
+                __internal__.process_result_file(batch, experiment_info, workflow_step, process_metadata,
+                                                 clowder, workstep_metadata, clowder_credentials, resources)
+
+        batch_key, batch = None, []
+        for key, one_item in result_items:
+            if batch and (key != batch_key or len(batch) >= RESULT_PUBLISH_BATCH_SIZE):
+                process_batch(batch_key, batch)
+                batch = []
+            batch_key = key
+            batch.append(one_item)
+        if batch:
+            process_batch(batch_key, batch)
 
         logging.debug("Finished processing return JSON")
         return True
 
+    @staticmethod # Clowder
+    def publish_recorded_step_results(env: dict, workflow_step: dict, clowder: ClowderClient, resources: dict,
+                                      working_folder: str) -> None:
+        """Publishes the results of a finished workflow step and records that they were published
+        Arguments:
+            env: the environment used for the workflow step
+            workflow_step: the information on the workflow step
+            clowder: the client for making Clowder requests
+            resources: the resources associated with the request
+            working_folder: the working folder of the message whose run information is updated
+        Notes:
+            A resumed run doesn't publish the results of the steps recorded here a second time
+        """
+        __internal__.publish_step_results(env, workflow_step, clowder, resources)
+        run_info = __internal__.load_run_info(working_folder)
+        run_info['published_steps'] = run_info.get('published_steps', []) + [workflow_step['name']]
+        __internal__.save_run_info(working_folder, run_info)
+
+    @staticmethod
+    def wait_for_published_steps(published: list) -> None:
+        """Waits for the results of workflow steps to finish being published
+        Arguments:
+            published: a list of tuples of the workflow step and the future publishing its results
+        Exceptions:
+            Raises RuntimeError if publishing the results of any step failed, after all steps have finished
+        """
+        failed_steps = []
+        first_ex = None
+        for workflow_step, one_future in published:
+            publish_ex = one_future.exception()
+            if publish_ex is not None:
+                logging.error("Unable to publish the results of workflow step '%s'", workflow_step['name'])
+                logging.error("    exception caught: %s", str(publish_ex))
+                failed_steps.append(workflow_step['name'])
+                first_ex = first_ex or publish_ex
+        if failed_steps:
+            raise RuntimeError("Unable to publish the results of workflow steps: %s" % str(failed_steps)) from first_ex
+
+    @staticmethod # Clowder
+    def publish_step_results(env: dict, workflow_step: dict, clowder: ClowderClient, resources: dict) -> None:
+        """Loads the results of a finished workflow step and sends them to Clowder
+        Arguments:
+            env: the environment used for the workflow step
+            workflow_step: the information on the workflow step
+            clowder: the client for making Clowder requests
+            resources: the resources associated with the request
+        Exceptions:
+            Raises RuntimeError if an expected result file is not found
+        """
+        # Load the experiment data into a form processing the results file can use
+        experiment_path = os.path.join(env['BASE_DIR'], env['EXPERIMENT_METADATA_RELATIVE_PATH'])
+        logging.debug("Loading experiment metadata before looking at result: '%s'", experiment_path)
+        workstep_metadata = deepcopy(workflow_step)
+        clowder_info = {}
+        if os.path.splitext(experiment_path)[1] in ('.yml', '.yaml'):
+            load_func = yaml.safe_load
+        else:
+            load_func = json.load
+        with open(experiment_path, 'r') as in_file:
+            experiment_metadata = load_func(in_file)
+            if 'pipeline' in experiment_metadata:
+                logging.debug("Found 'pipeline' key in experiment metadata, using its value as top level metadata")
+                experiment_metadata = experiment_metadata['pipeline']
+            experiment_info = {}
+            if experiment_metadata:
+                # Fix up experiment information
+                for key, value in experiment_metadata.items():
+                    experiment_info[key] = str(value)
+                if 'observationTimeStamp' in experiment_info:
+                    workstep_metadata['date'] = experiment_info['observationTimeStamp'][0:10]
+                elif 'date' in experiment_info:
+                    workstep_metadata['date'] = experiment_info['date']
+                else:
+                    logging.info("No timestamp or date was specified in experiment metadata, using current date")
+                    workstep_metadata['date'] = datetime.datetime.now().strftime('%Y-%m-%d')
+                if 'studyName' in experiment_info:
+                    workstep_metadata['experiment'] = experiment_info['studyName']
+                # Check for a username and password for Clowder
+                clowder_md = __internal__.find_dict_key(experiment_metadata, 'clowder')
+                if clowder_md:
+                    space = __internal__.find_dict_key(clowder_md[1], 'space')
+                    username = __internal__.find_dict_key(clowder_md[1], 'username')
+                    password = __internal__.find_dict_key(clowder_md[1], 'password')
+                    if space:
+                        clowder_info['space'] = space[1]
+                        workstep_metadata['password'] = space[1]
+                    if username:
+                        clowder_info['username'] = username[1]
+                        workstep_metadata['password'] = username[1]
+                    if password:
+                        clowder_info['password'] = password[1]
+                        workstep_metadata['password'] = __internal__.secure_string(clowder_info['password'])
+
+        # Process the results file
+        if 'discover_run_results' in workflow_step:
+            result_filenames = __internal__.discover_result_files(env['RESULTS_FILE_PATH'], WORKFLOW_STEP_RESULT_FILE_NAME)
+            if not result_filenames:
+                logging.warning("Did not find any result files through discovery for step %s, this may not be an issue",
+                                workflow_step['name'])
+        else:
+            result_filenames = [os.path.join(env['RESULTS_FILE_PATH'], WORKFLOW_STEP_RESULT_FILE_NAME)]
+        logging.info("Loading and processing results: '%s'", str(result_filenames))
+        for one_filename in result_filenames:
+            if os.path.exists(one_filename):
+                logging.debug("Result processing for file: '%s'", one_filename)
+                __internal__.process_results_json(one_filename, experiment_info, workflow_step, clowder, workstep_metadata,
+                                                  clowder_info, resources)
+                logging.debug("Removing copied result file: '%s'", one_filename)
+#                    os.unlink(one_filename)
+            else:
+                msg = "Result file from current step '%s' is not found: %s" % (workflow_step['name'], env['RESULTS_FILE_PATH'])
+                logging.error(msg)
+                raise RuntimeError(msg)
+
     @staticmethod
     def discover_result_files(source_folder: str, file_name: str) -> list:
         """Recursively searches the specified folder for first instances of the file name
@@ -637,26 +2161,15 @@ class __internal__():
             file_name: the name of the file to find
         Return:
             A list of all the fully qualified names of the files found
+        Notes:
+            The files listed in a result index written by cache_results.py are returned instead of searching, when the
+            folder has one
         """
-        found = []
         if not os.path.isdir(source_folder):
             logging.debug("Ignoring invalid folder parameter while recursively searching for result file")
-            return found
+            return []
 
-        found_dirs = []
-        for one_file in os.listdir(source_folder):
-            found_name = os.path.join(source_folder, one_file)
-            if os.path.basename(found_name) == file_name:
-                if found_name not in found:
-                    found.append(found_name)
-            elif os.path.isdir(found_name):
-                found_dirs.append(found_name)
-
-        if not found:
-            for one_dir in found_dirs:
-                found.extend(__internal__.discover_result_files(one_dir, file_name))
-
-        return found
+        return cache_results.find_files(source_folder, file_name, first_found_only=True)
 
     @staticmethod
     def find_dict_key(haystack: dict, key: str, case_insensitive: bool = True) -> Optional[tuple]:
@@ -715,55 +2228,177 @@ class DroneMakeflow(extractors.TerrarefExtractor):
                                  help="the folder to use as a workspace - will be created if it doesn't exist")
         self.parser.add_argument('--named_volume', default=os.getenv("NAMED_VOLUME"),
                                  help="the name of the Docker volume to use when starting other images (must contain working_space)")
+        self.parser.add_argument('--clowder_pool_size', type=int, default=int(os.getenv("CLOWDER_POOL_SIZE", str(CLOWDER_POOL_SIZE))),
+                                 help="the maximum number of connections to keep open to Clowder")
+        self.parser.add_argument('--clowder_timeout', type=float, default=float(os.getenv("CLOWDER_TIMEOUT", str(CLOWDER_TIMEOUT_SEC))),
+                                 help="the number of seconds to wait for Clowder to respond to a request")
+        self.parser.add_argument('--coalesce_quiet_sec', type=float,
+                                 default=float(os.getenv("COALESCE_QUIET_SEC", str(COALESCE_QUIET_SEC))),
+                                 help="the number of seconds without new messages for a dataset before it's processed; "
+                                      "messages arriving during this time are combined into one run")
+        self.parser.add_argument('--tile_size', type=int,
+                                 default=int(os.getenv("TILE_SIZE")) if os.getenv("TILE_SIZE") else None,
+                                 help="the width and height in pixels of the tiles the images of steps that support tiling "
+                                      "are split into (0 to not split images; default is the step's 'tile_size')")
+        self.parser.add_argument('--tile_overlap', type=int,
+                                 default=int(os.getenv("TILE_OVERLAP")) if os.getenv("TILE_OVERLAP") else None,
+                                 help="the number of pixels tiles overlap their neighbors by (default is the step's "
+                                      "'tile_overlap')")
+        self.parser.add_argument('--batch_type', choices=BATCH_TYPES, default=os.getenv("BATCH_TYPE", "local"),
+                                 help="how makeflow runs workflow rules: 'local' on this host, or 'wq' on Work Queue workers "
+                                      "that share the working space and named volume")
+        self.parser.add_argument('--wq_project', default=os.getenv("WQ_PROJECT", WQ_DEFAULT_PROJECT),
+                                 help="the Work Queue project name workers use to find workflows through the catalog server")
+        self.parser.add_argument('--wq_port', type=int, default=int(os.getenv("WQ_PORT", "0")),
+                                 help="the port Work Queue workers connect to (0 for any available port)")
+        self.parser.add_argument('--wq_password_file', default=os.getenv("WQ_PASSWORD_FILE"),
+                                 help="file containing the password Work Queue workers need to connect")
+        self.parser.add_argument('--max_cores', type=int, default=int(os.getenv("MAX_CORES", str(os.cpu_count() or 1))),
+                                 help="the number of cores workflow steps of all messages being processed may use")
+        self.parser.add_argument('--max_memory_mb', type=int,
+                                 default=int(os.getenv("MAX_MEMORY_MB", str(os.sysconf('SC_PAGE_SIZE') *
+                                                                            os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)))),
+                                 help="the megabytes of memory workflow steps of all messages being processed may use")
+        self.parser.add_argument('--working_space_max_bytes', type=int, default=int(os.getenv("WORKING_SPACE_MAX_BYTES", "0")),
+                                 help="the number of bytes the working space may use before the least recently used message "
+                                      "folders and step cache entries are removed (0 to never remove them)")
+        self.parser.add_argument('--step_cache_dir', default=os.getenv("STEP_CACHE_DIR"),
+                                 help="folder for reusing workflow step results across messages with the same inputs "
+                                      "(should be on the same volume as working_space)")
+        self.parser.add_argument('--stream_steps', action='store_true',
+                                 default=os.getenv("STREAM_STEPS", "").lower() in ('1', 'true', 'yes'),
+                                 help="run steps that support it on the previous step's cached files as they're cached")
+        self.parser.add_argument('--resume', action='store_true',
+                                 default=os.getenv("RESUME", "").lower() in ('1', 'true', 'yes'),
+                                 help="reuse the working folder and makeflow logs of an interrupted run of the same dataset "
+                                      "files so that only the unfinished rules are run")
+        self.parser.add_argument('--cache_results_service', action='store_true',
+                                 default=os.getenv("CACHE_RESULTS_SERVICE", "").lower() in ('1', 'true', 'yes'),
+                                 help="keep a cache_results.py process running that workflow rules hand caching to instead "
+                                      "of starting a process for each plot")
+        self.parser.add_argument('--single_dag', action='store_true',
+                                 default=os.getenv("SINGLE_DAG", "").lower() in ('1', 'true', 'yes'),
+                                 help="run all the workflow steps as one makeflow workflow instead of one makeflow run per step")
 
         self.setup(sensor='stereoTop')
 
+        self.workspace = None
+        if self.args.working_space:
+            self.workspace = WorkspaceManager(self.args.working_space, self.args.working_space_max_bytes,
+                                              self.args.step_cache_dir)
+        # A connector waiting out the quiet period can't receive the newer message, so only wait with several connectors
+        coalesce_quiet_sec = self.args.coalesce_quiet_sec if self.args.num > 1 else 0
+        if coalesce_quiet_sec != self.args.coalesce_quiet_sec:
+            logging.info("Not waiting for newer messages for the same dataset since only one connector is used (see '--num')")
+        self.coalescer = EventCoalescer(coalesce_quiet_sec)
+        self.scheduler = SlotScheduler(self.args.max_cores, self.args.max_memory_mb)
+        self.run_file_ids = {}
+        self.cache_results_socket = ''
+        if self.args.cache_results_service and self.args.working_space:
+            self.cache_results_socket = self.start_cache_results_service()
+
         #logging.getLogger().setLevel(logging.INFO)
         logging.getLogger().setLevel(logging.DEBUG)
 
-    def process_message(self, connector: connectors.Connector, host: str, secret_key: str, resource: dict, parameters: dict) -> dict:
-        """Processes the request message
+    def start_cache_results_service(self) -> str:
+        """Starts the resident cache_results.py service in the working space
+        Return:
+            Returns the path of the service's socket
+        Notes:
+            The service is stopped when the extractor exits. Workflow rules cache their results themselves if the service
+            isn't running
+        """
+        socket_path = os.path.join(self.args.working_space,
+                                   CACHE_RESULTS_SOCKET_TEMPLATE.format(host=os.uname().nodename, pid=os.getpid()))
+        script_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache_results.py')
+        logging.info("Starting caching service on '%s'", socket_path)
+        # pylint: disable=consider-using-with
+        service = subprocess.Popen(['python3', script_path, '--serve', socket_path])
+        atexit.register(service.terminate)
+        return socket_path
+
+    def set_env_tiles(self, env: dict, workflow_step: dict) -> None:
+        """Adds the tiles that the image of a workflow step is split into to its environment
         Arguments:
-            connector: an instance of the pyclowder connector object
-            host: the URL of the origination request
-            secret_key: the key associated with request
-            resource: the resources associated with this request
-            parameters: the message body
+            env: the environment of the workflow step
+            workflow_step: the information on the workflow step, with the 'tile_image' to split
+        Notes:
+            The tile size and overlap options of the extractor take precedence over the ones of the workflow step
         """
-        # TODO:
-        #  1. cache to date stamped folder, per key, w/ user & experiment
-        #  2. file metadata when no container specified
-        #  3. support force_dataset
-        #  4. use latest dataset ID for subsequent steps
-        #  5. add docker environment variables such as BETYDB_KEY
-        #  6.
-        self.start_message(resource)
-        super(DroneMakeflow, self).process_message(connector, host, secret_key, resource, parameters)
-
-        # Get the Docker volume name to use
-        if not self.args.named_volume:
-            raise RuntimeError("No named volume was specified. Try setting the NAMED_VOLUME environment variable"
-                               " (if using Docker set to a named volume to use)")
-
-        # Get a working folder to use
-        if self.args.working_space:
-            logging.info("Folder for our working space: '%s'", self.args.working_space)
-            # Assume we're sharing out working space with other instances, create a temporary folder
-            working_folder = tempfile.mkdtemp(dir=self.args.working_space)
-            working_subfolder = working_folder[len(self.args.working_space):]
-            logging.debug("Creating working space folder for our instance: '%s'", working_folder)
-            __internal__.create_folder_default_perms(working_folder)
-        else:
-            raise RuntimeError("No working space folder was specified. Try setting the WORKING_SPACE environment variable "
-                               "(if using Docker set to a folder to mount)")
+        tile_size = workflow_step['tile_size'] if 'tile_size' in workflow_step else TILE_DEFAULT_SIZE
+        tile_overlap = workflow_step['tile_overlap'] if 'tile_overlap' in workflow_step else TILE_DEFAULT_OVERLAP
+        if self.args.tile_size is not None:
+            tile_size = self.args.tile_size
+        if self.args.tile_overlap is not None:
+            tile_overlap = self.args.tile_overlap
+        image_path = os.path.join(env['BASE_DIR'], env['DATA_FOLDER_NAME'], workflow_step['tile_image'])
+        env['TILE_LIST'] = __internal__.create_tile_list(image_path, int(tile_size), int(tile_overlap))
+
+    def batch_options(self, env: dict, working_folder: str, name: str) -> list:
+        """Returns the makeflow options for the batch type the extractor is configured with
+        Arguments:
+            env: the environment of the workflow step
+            working_folder: the working folder of the message
+            name: the name of the makeflow run, used for the file the Work Queue port is written to
+        Return:
+            Returns the list of options
+        """
+        port_file = os.path.join(working_folder, name + '.wqport') if self.args.batch_type == 'wq' else None
+        return __internal__.batch_options(self.args.batch_type, env['BASE_DIR'], self.args.wq_project, self.args.wq_port,
+                                          self.args.wq_password_file, port_file)
 
-        # Process the steps sequentially
+    def run_workflow_steps(self, working_folder: str, working_subfolder: str, clowder: ClowderClient, resource: dict) -> None:
+        """Runs the workflow steps one after the other, each with its own makeflow run
+        Arguments:
+            working_folder: the folder to run the workflow in
+            working_subfolder: the working folder relative to the working space
+            clowder: the client for making Clowder requests
+            resource: the resources associated with this request
+        Exceptions:
+            Raises RuntimeError if the results of any step couldn't be published. An exception raised while running the
+            steps is raised instead of a publishing failure, which is only logged in that case
+        Notes:
+            The results of each step are published in the background, in step order, while the following steps run.
+            This function only returns after all the results have been published
+        """
+        published = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as publisher:
+            try:
+                self.run_workflow_step_loop(working_folder, working_subfolder, clowder, resource, publisher, published)
+            except BaseException:
+                logging.info("Waiting for the results of %s workflow steps to be published", str(len(published)))
+                try:
+                    __internal__.wait_for_published_steps(published)
+                except RuntimeError as ex:
+                    logging.error("Publishing failed while handling a workflow step failure: %s", str(ex))
+                raise
+            logging.info("Waiting for the results of %s workflow steps to be published", str(len(published)))
+            __internal__.wait_for_published_steps(published)
+
+    def run_workflow_step_loop(self, working_folder: str, working_subfolder: str, clowder: ClowderClient, resource: dict,
+                               publisher: concurrent.futures.Executor, published: list) -> None:
+        """Runs each workflow step and queues its results for publishing
+        Arguments:
+            working_folder: the folder to run the workflow in
+            working_subfolder: the working folder relative to the working space
+            clowder: the client for making Clowder requests
+            resource: the resources associated with this request
+            publisher: the executor publishing step results
+            published: the list to add tuples of each step and the future publishing its results to
+        """
         env = {}
         step_number = 0
+        message_folder = os.path.basename(working_folder.rstrip('/\\'))
+        published_steps = __internal__.load_run_info(working_folder).get('published_steps', [])
         previous_step_cache_dir = None
         previous_step_cached_file = None
+        streamed_step, streamed_env = None, None
         for current_step in WORKFLOW:
             step_number += 1
+            if current_step is streamed_step:
+                logging.info("Workflow step %s: '%s' was run along with the previous step", str(step_number), current_step['name'])
+                env = streamed_env
+                continue
             logging.info("Starting workflow step %s: '%s' with named volume '%s'", str(step_number), current_step['name'],
                          self.args.named_volume)
 
@@ -774,7 +2409,10 @@ class DroneMakeflow(extractors.TerrarefExtractor):
                 if not os.path.exists(previous_step_cached_file):
                     logging.warning("Continuing after not finding cache file results from previous step: %s", previous_step_cached_file)
                     previous_step_cached_file = None
-            env = __internal__.create_env_json(working_folder, working_subfolder, self.args.named_volume, current_step, resource)
+            # Each step has its own results folder so that publishing a step's results can overlap later steps
+            env = __internal__.create_env_json(working_folder, working_subfolder, self.args.named_volume, current_step, resource,
+                                               separate_results=True)
+            __internal__.create_folder_default_perms(env['RESULTS_FILE_PATH'])
             logging.debug("Makefile data: %s", str(env))
 
             # Relocate the files so docker-within-docker images can access them
@@ -807,121 +2445,358 @@ class DroneMakeflow(extractors.TerrarefExtractor):
                 env['EXPERIMENT_METADATA_RELATIVE_PATH'] = new_experiment_path[len(env['BASE_DIR']):]
 
             # Prepare for processing
+            if 'tile_image' in current_step and current_step['tile_image']:
+                self.set_env_tiles(env, current_step)
+            self.scheduler.set_env_resources(env, current_step)
+            env['CACHE_RESULTS_SOCKET'] = self.cache_results_socket
             logging.debug("Working env.json file: %s", str(env))
             __internal__.setup_processing_step(env, working_folder, current_step)
 
             # Run the command
-            cmd = [os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cctools/bin/makeflow'),
-                   '--jx', current_step['makeflow_file'],
-                   '--jx-args', os.path.join(working_folder, 'env.json')]
+            jx_args_files = [os.path.join(working_folder, 'env.json')]
             if previous_step_cached_file:
-                cmd.append('--jx-args')
-                cmd.append(previous_step_cached_file)
-            logging.debug("Running command: %s", str(cmd))
-            proc = subprocess.Popen(cmd, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-            # Wait for it to finish
-            loop_iteration = 1
-            start_time = datetime.datetime.now()
-            while (datetime.datetime.now() - start_time).total_seconds() <= PROC_WAIT_TOTAL_SEC:
-                if proc.returncode is None:
-                    logging.info("Waiting for process to finish %s", str(loop_iteration))
-                    if proc.stdout:
-                        try:
-                            while True:
-                                line = proc.stdout.readline()
-                                if line:
-                                    logging.debug(line.rstrip(b'\n'))
-                                else:
-                                    break
-                        except Exception as ex:
-                            logging.debug("Ignoring exception while waiting for process %s", str(ex))
-                    proc.poll()
-                    time.sleep(PROC_WAIT_SLEEP_SEC)
-                else:
-                    logging.info("Process completed")
-                    logging.debug("Process return code: %s", str(proc.returncode))
-                    break
-
-                loop_iteration += 1
-
-                processing_time = (datetime.datetime.now() - start_time).total_seconds()
-                if processing_time > PROC_WAIT_TOTAL_SEC:
-                    msg = "Processing is running too long (%s sec): %s" % (str(processing_time), str(cmd))
-                    logging.error(msg)
-                    raise RuntimeError(msg)
-
-            # Load the experiment data into a form processing the results file can use
-            experiment_path = os.path.join(env['BASE_DIR'], env['EXPERIMENT_METADATA_RELATIVE_PATH'])
-            logging.debug("Loading experiment metadata before looking at result: '%s'", experiment_path)
-            workstep_metadata = deepcopy(current_step)
-            clowder_info = {}
-            if os.path.splitext(experiment_path)[1] in ('.yml', '.yaml'):
-                load_func = yaml.safe_load
+                jx_args_files.append(previous_step_cached_file)
+            cmd = __internal__.makeflow_command(current_step['makeflow_file'], jx_args_files,
+                                                os.path.join(working_folder, current_step['makeflow_file'] + '.makeflowlog'), env,
+                                                self.batch_options(env, working_folder, current_step['makeflow_file']))
+            timeout_sec = current_step['timeout_sec'] if 'timeout_sec' in current_step else PROC_WAIT_TOTAL_SEC
+            next_step = WORKFLOW[step_number] if step_number < len(WORKFLOW) else None
+            cache_key = None
+            if self.args.step_cache_dir:
+                cache_key = __internal__.step_cache_key(env, current_step, jx_args_files, message_folder)
+            if cache_key and __internal__.restore_step_cache(self.args.step_cache_dir, cache_key, env, current_step,
+                                                             message_folder):
+                logging.info("Skipping running workflow step '%s' after restoring its results", current_step['name'])
+                return_code = None
+            elif self.args.stream_steps and next_step and 'stream_from_previous' in next_step and next_step['stream_from_previous']:
+                streamed_step = next_step
+                cores, memory_mb = [sum(pair) for pair in zip(self.scheduler.step_reservation(current_step),
+                                                              self.scheduler.step_reservation(next_step))]
+                run_name = "%s + %s (%s)" % (current_step['name'], next_step['name'], message_folder)
+                reserved = self.scheduler.acquire(run_name, cores, memory_mb)
+                try:
+                    streamed_env, return_code = self.run_streamed_steps(cmd, timeout_sec, current_step, env, next_step,
+                                                                        working_folder, working_subfolder, resource)
+                finally:
+                    self.scheduler.release(run_name, reserved)
             else:
-                load_func = json.load
-            with open(experiment_path, 'r') as in_file:
-                experiment_metadata = load_func(in_file)
-                if 'pipeline' in experiment_metadata:
-                    logging.debug("Found 'pipeline' key in experiment metadata, using its value as top level metadata")
-                    experiment_metadata = experiment_metadata['pipeline']
-                experiment_info = {}
-                if experiment_metadata:
-                    # Fix up experiment information
-                    for key, value in experiment_metadata.items():
-                        experiment_info[key] = str(value)
-                    if 'observationTimeStamp' in experiment_info:
-                        workstep_metadata['date'] = experiment_info['observationTimeStamp'][0:10]
-                    elif 'date' in experiment_info:
-                        workstep_metadata['date'] = experiment_info['date']
-                    else:
-                        logging.info("No timestamp or date was specified in experiment metadata, using current date")
-                        workstep_metadata['date'] = datetime.datetime.now().strftime('%Y-%m-%d')
-                    if 'studyName' in experiment_info:
-                        workstep_metadata['experiment'] = experiment_info['studyName']
-                    # Check for a username and password for Clowder
-                    clowder_md = __internal__.find_dict_key(experiment_metadata, 'clowder')
-                    if clowder_md:
-                        space = __internal__.find_dict_key(clowder_md[1], 'space')
-                        username = __internal__.find_dict_key(clowder_md[1], 'username')
-                        password = __internal__.find_dict_key(clowder_md[1], 'password')
-                        if space:
-                            clowder_info['space'] = space[1]
-                            workstep_metadata['password'] = space[1]
-                        if username:
-                            clowder_info['username'] = username[1]
-                            workstep_metadata['password'] = username[1]
-                        if password:
-                            clowder_info['password'] = password[1]
-                            workstep_metadata['password'] = __internal__.secure_string(clowder_info['password'])
-
-            # Process the results file
-            if 'discover_run_results' in current_step:
-                result_filenames = __internal__.discover_result_files(env['RESULTS_FILE_PATH'], WORKFLOW_STEP_RESULT_FILE_NAME)
-                if not result_filenames:
-                    logging.warning("Did not find any result files through discovery for step %s, this may not be an issue",
-                                    current_step['name'])
+                run_name = "%s (%s)" % (current_step['name'], message_folder)
+                reserved = self.scheduler.acquire(run_name, *self.scheduler.step_reservation(current_step))
+                try:
+                    return_code = __internal__.run_process(cmd, timeout_sec)
+                finally:
+                    self.scheduler.release(run_name, reserved)
+                if return_code != 0:
+                    logging.error("Makeflow returned %s for workflow step '%s'", str(return_code), current_step['name'])
+
+            # Keep successful results for other messages with the same inputs
+            if cache_key and return_code == 0:
+                try:
+                    __internal__.save_step_cache(self.args.step_cache_dir, cache_key, env, current_step, message_folder)
+                except Exception as ex:
+                    logging.warning("Continuing after failing to save workflow step '%s' to the step cache: %s",
+                                    current_step['name'], str(ex))
+
+            # Queue the results of the step for publishing while the next step runs
+            publish_steps = [(current_step, env)]
+            if streamed_step is not None and streamed_step is next_step:
+                publish_steps.append((streamed_step, streamed_env))
+            for one_step, one_env in publish_steps:
+                if one_step['name'] in published_steps:
+                    logging.info("Not publishing the results of workflow step '%s' again for resumed run", one_step['name'])
+                    continue
+                published.append((one_step, publisher.submit(__internal__.publish_recorded_step_results, one_env, one_step,
+                                                             clowder, resource, working_folder)))
+
+    def run_streamed_steps(self, producer_cmd: list, producer_timeout_sec: float, producer_step: dict, producer_env: dict,
+                           consumer_step: dict, working_folder: str, working_subfolder: str, resource: dict) -> dict:
+        """Runs a workflow step while running the following step on the files the first step caches as they're cached
+        Arguments:
+            producer_cmd: the command that runs the first step
+            producer_timeout_sec: the maximum number of seconds the first step is allowed to run
+            producer_step: the information on the first step
+            producer_env: the environment of the first step
+            consumer_step: the information on the following step
+            working_folder: the folder to run the workflow in
+            working_subfolder: the working folder relative to the working space
+            resource: the resources associated with this request
+        Return:
+            Returns a tuple of the environment of the following step and the return code of the first step
+        Notes:
+            The following step is run with separate makeflow runs, each on a batch of up to STREAM_BATCH_SIZE cached file
+            entries that have metadata. The entries refer to files in the first step's cache so the cache isn't copied
+        """
+        consumer_env = __internal__.create_env_json(working_folder, working_subfolder, self.args.named_volume, consumer_step, resource,
+                                                    separate_results=True)
+        consumer_folder = os.path.join(consumer_env['BASE_DIR'], consumer_env['RELATIVE_WORKING_FOLDER'])
+        __internal__.create_folder_default_perms(consumer_folder)
+        __internal__.create_folder_default_perms(os.path.join(consumer_env['BASE_DIR'], consumer_env['DATA_FOLDER_NAME']))
+        __internal__.copy_scripts(consumer_env)
+
+        # The experiment metadata of the first step is used by the following step
+        consumer_env['EXPERIMENT_METADATA_RELATIVE_PATH'] = os.path.join(consumer_env['RELATIVE_WORKING_FOLDER'],
+                                                                         consumer_env['EXPERIMENT_METADATA_FILENAME'])
+        __internal__.stage_file(os.path.join(producer_env['BASE_DIR'], producer_env['EXPERIMENT_METADATA_RELATIVE_PATH']),
+                                os.path.join(consumer_env['BASE_DIR'], consumer_env['EXPERIMENT_METADATA_RELATIVE_PATH']))
+        self.scheduler.set_env_resources(consumer_env, consumer_step, STREAM_MAX_RUNS)
+        consumer_env['CACHE_RESULTS_SOCKET'] = self.cache_results_socket
+        __internal__.setup_processing_step(consumer_env, consumer_folder, consumer_step)
+        consumer_timeout_sec = consumer_step['timeout_sec'] if 'timeout_sec' in consumer_step else PROC_WAIT_TOTAL_SEC
+
+        def run_consumer_batch(batch_number: int, batch: list) -> None:
+            """Runs the following step on a batch of cached file entries
+            Arguments:
+                batch_number: the number of the batch
+                batch: the list of cached file entries
+            """
+            batch_name = 'stream_batch_%s' % str(batch_number)
+            batch_filename = os.path.join(consumer_folder, batch_name + '.json')
+            with open(batch_filename, 'w') as out_file:
+                json.dump({'FILE_LIST': batch}, out_file)
+            logging.info("Running workflow step '%s' on batch %s of %s entries", consumer_step['name'], str(batch_number),
+                         str(len(batch)))
+            cmd = __internal__.makeflow_command(consumer_step['makeflow_file'],
+                                                [os.path.join(consumer_folder, 'env.json'), batch_filename],
+                                                os.path.join(consumer_folder, batch_name + '.makeflowlog'), consumer_env,
+                                                self.batch_options(consumer_env, consumer_folder, batch_name))
+            return_code = __internal__.run_process(cmd, consumer_timeout_sec)
+            if return_code != 0:
+                logging.error("Makeflow returned %s for workflow step '%s' batch %s", str(return_code), consumer_step['name'],
+                              str(batch_number))
+
+        # Start the first step and the following step as cached files are found
+        file_list_path = os.path.join(producer_env['CACHE_DIR'], WORKFLOW_STEP_CACHE_FILE_NAME)
+        logging.info("Running workflow step '%s' on cached files of step '%s' as they're found in '%s'", consumer_step['name'],
+                     producer_step['name'], file_list_path)
+        batch_count = 0
+        consumer_runs = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=STREAM_MAX_RUNS + 1) as executor:
+            producer_run = executor.submit(__internal__.run_process, producer_cmd, producer_timeout_sec)
+            for new_entries in cache_results.follow_file_list(file_list_path, producer_run.done, STREAM_POLL_SEC):
+                new_entries = [one_entry for one_entry in new_entries if one_entry['BASE_METADATA_NAME']]
+                for idx in range(0, len(new_entries), STREAM_BATCH_SIZE):
+                    batch_count += 1
+                    consumer_runs.append(executor.submit(run_consumer_batch, batch_count, new_entries[idx:idx + STREAM_BATCH_SIZE]))
+
+            # Wait for everything to finish
+            return_code = producer_run.result()
+            if return_code != 0:
+                logging.error("Makeflow returned %s for workflow step '%s'", str(return_code), producer_step['name'])
+            for one_run in consumer_runs:
+                one_run.result()
+
+        logging.info("Finished running workflow step '%s' on %s batches", consumer_step['name'], str(batch_count))
+        return consumer_env, return_code
+
+    def run_workflow_dag(self, working_folder: str, working_subfolder: str, clowder: ClowderClient, resource: dict) -> None:
+        """Runs all the workflow steps as a single makeflow run and then publishes the results of each step
+        Arguments:
+            working_folder: the folder to run the workflow in
+            working_subfolder: the working folder relative to the working space
+            clowder: the client for making Clowder requests
+            resource: the resources associated with this request
+        Notes:
+            Each step keeps its results in its own folder so that they are all available once makeflow finishes. The
+            'preprocess_json' step hook isn't called since the steps' JX files already filter the cached file lists
+        """
+        step_envs = []
+        timeout_sec = 0
+        for current_step in WORKFLOW:
+            env = __internal__.create_env_json(working_folder, working_subfolder, self.args.named_volume, current_step, resource,
+                                               separate_results=True)
+            env['EXPERIMENT_METADATA_RELATIVE_PATH'] = os.path.join(env['RELATIVE_WORKING_FOLDER'],
+                                                                    env['EXPERIMENT_METADATA_FILENAME'])
+            __internal__.create_folder_default_perms(env['SCRIPT_FOLDER'])
+            __internal__.create_folder_default_perms(env['RESULTS_FILE_PATH'])
+            if not step_envs:
+                # Relocate the files so docker-within-docker images can access them
+                copy_cached_folders = 'copy_cached_folders' in current_step and current_step['copy_cached_folders']
+                _, new_experiment_path = __internal__.relocate_files(env, resource, copy_cached_folders)
+                if not new_experiment_path:
+                    raise RuntimeError("No experiment metadata file is available")
             else:
-                result_filenames = [os.path.join(env['RESULTS_FILE_PATH'], WORKFLOW_STEP_RESULT_FILE_NAME)]
-            logging.info("Loading and processing results: '%s'", str(result_filenames))
-            for one_filename in result_filenames:
-                if os.path.exists(one_filename):
-                    logging.debug("Result processing for file: '%s'", one_filename)
-                    with open(one_filename, 'r') as in_file:
-                        proc_results = json.load(in_file)
-                        __internal__.process_results_json(proc_results, experiment_info, current_step, connector, host, secret_key,
-                                                          workstep_metadata, clowder_info, resource)
-                    logging.debug("Removing copied result file: '%s'", one_filename)
-#                    os.unlink(one_filename)
-                else:
-                    msg = "Result file from current step '%s' is not found: %s" % (current_step['name'], env['RESULTS_FILE_PATH'])
-                    logging.error(msg)
-                    raise RuntimeError(msg)
+                __internal__.copy_scripts(env)
+            self.scheduler.set_env_resources(env, current_step)
+            env['CACHE_RESULTS_SOCKET'] = self.cache_results_socket
+            logging.debug("Makefile data for step '%s': %s", current_step['name'], str(env))
+            step_envs.append((current_step, env))
+            timeout_sec += current_step['timeout_sec'] if 'timeout_sec' in current_step else PROC_WAIT_TOTAL_SEC
+
+        # Run all the steps
+        logging.info("Starting workflow of %s steps with named volume '%s'", str(len(step_envs)), self.args.named_volume)
+        workflow_filename = __internal__.create_dag_workflow(working_folder, step_envs)
+        run_name = "workflow (%s)" % os.path.basename(working_folder.rstrip('/\\'))
+        reserved = self.scheduler.acquire(run_name, max(env['STEP_CORES'] for _, env in step_envs),
+                                          max(env['STEP_MEMORY_MB'] for _, env in step_envs))
+        try:
+            cmd = __internal__.makeflow_command(workflow_filename, [], None,
+                                                {'STEP_CORES': reserved[0], 'STEP_MEMORY_MB': reserved[1]},
+                                                self.batch_options(step_envs[0][1], working_folder, 'workflow'))
+            return_code = __internal__.run_process(cmd, timeout_sec)
+        finally:
+            self.scheduler.release(run_name, reserved)
+        if return_code != 0:
+            logging.error("Makeflow returned %s for workflow '%s'", str(return_code), workflow_filename)
+
+        # Publish the results of each step
+        published_steps = __internal__.load_run_info(working_folder).get('published_steps', [])
+        for current_step, env in step_envs:
+            if current_step['name'] in published_steps:
+                logging.info("Not publishing the results of workflow step '%s' again for resumed run", current_step['name'])
+                continue
+            logging.info("Publishing results of workflow step '%s'", current_step['name'])
+            __internal__.publish_recorded_step_results(env, current_step, clowder, resource, working_folder)
+
+    def check_message(self, connector: connectors.Connector, host: str, secret_key: str, resource: dict,
+                      parameters: dict) -> CheckMessage:
+        """Determines if the message is processed, combining bursts of messages for the same dataset
+        Arguments:
+            connector: an instance of the pyclowder connector object
+            host: the URL of the origination request
+            secret_key: the key associated with request
+            resource: the resources associated with this request
+            parameters: the message body
+        Return:
+            Returns CheckMessage.download when the message is processed and CheckMessage.ignore when it has been
+            combined with another message
+        """
+        # pylint: disable=unused-argument
+        dataset_id = resource['id']
+        file_id = parameters['id'] if 'id' in parameters and parameters['id'] != dataset_id else None
+        event_number = self.coalescer.arrive(dataset_id, file_id)
+        if event_number is None:
+            logging.info("Ignoring message for file %s of dataset %s, a run already included it", str(file_id), dataset_id)
+            return CheckMessage.ignore
+        if not self.coalescer.wait_quiet(dataset_id, event_number):
+            logging.info("Ignoring message for file %s of dataset %s, a newer message for the dataset will include it",
+                         str(file_id), dataset_id)
+            return CheckMessage.ignore
+
+        # Remember the files the run is for, the run is started by process_message()
+        with ClowderClient(host, secret_key, connector, 1, self.args.clowder_timeout) as clowder:
+            file_ids = clowder.get_dataset_file_ids(dataset_id)
+        resource['coalesce_event_number'] = event_number
+        resource['coalesce_file_ids'] = file_ids
+        logging.info("Processing %s files of dataset %s for message %s", str(len(file_ids)), dataset_id, str(event_number))
+        return CheckMessage.download
+
+    def process_message(self, connector: connectors.Connector, host: str, secret_key: str, resource: dict, parameters: dict) -> dict:
+        """Processes the request message
+        Arguments:
+            connector: an instance of the pyclowder connector object
+            host: the URL of the origination request
+            secret_key: the key associated with request
+            resource: the resources associated with this request
+            parameters: the message body
+        """
+        # TODO:
+        #  1. cache to date stamped folder, per key, w/ user & experiment
+        #  2. file metadata when no container specified
+        #  3. support force_dataset
+        #  4. use latest dataset ID for subsequent steps
+        #  5. add docker environment variables such as BETYDB_KEY
+        #  6.
+        run_key = (resource['id'], resource['coalesce_event_number']) if 'coalesce_event_number' in resource else None
+        if run_key:
+            self.coalescer.start_run(run_key[0], resource['coalesce_file_ids'])
+            self.run_file_ids[run_key] = resource['coalesce_file_ids']
+        succeeded = False
+        try:
+            self.start_message(resource)
+            super(DroneMakeflow, self).process_message(connector, host, secret_key, resource, parameters)
+            self.run_message(connector, host, secret_key, resource)
+            succeeded = True
+        finally:
+            if run_key in self.run_file_ids:
+                self.coalescer.finish_run(run_key[0], self.run_file_ids.pop(run_key), succeeded)
 
         # Finish up
         logging.debug("Finished processing message")
         self.end_message(resource)
 
+    def run_message(self, connector: connectors.Connector, host: str, secret_key: str, resource: dict) -> None:
+        """Runs the workflow steps for the request message
+        Arguments:
+            connector: an instance of the pyclowder connector object
+            host: the URL of the origination request
+            secret_key: the key associated with request
+            resource: the resources associated with this request
+        """
+        # Get the Docker volume name to use
+        if not self.args.named_volume:
+            raise RuntimeError("No named volume was specified. Try setting the NAMED_VOLUME environment variable"
+                               " (if using Docker set to a named volume to use)")
+
+        # Get a working folder to use
+        if self.args.working_space:
+            logging.info("Folder for our working space: '%s'", self.args.working_space)
+            run_key = (resource['id'], resource['coalesce_event_number']) if 'coalesce_event_number' in resource else None
+            file_ids = self.run_file_ids.get(run_key)
+            if file_ids is None and self.args.resume:
+                # The resume folder is named after the dataset's files, which messages that weren't combined haven't fetched
+                with ClowderClient(host, secret_key, connector, 1, self.args.clowder_timeout) as clowder:
+                    file_ids = clowder.get_dataset_file_ids(resource['id'])
+            run_info = {'dataset_id': resource['id'], 'file_ids': file_ids if file_ids is not None else [],
+                        'status': RUN_STATUS_RUNNING, 'published_steps': []}
+            working_folder = self.claim_resume_folder(run_info) if self.args.resume else None
+            if not working_folder:
+                # Assume we're sharing out working space with other instances, create a temporary folder
+                working_folder = tempfile.mkdtemp(dir=self.args.working_space)
+                logging.debug("Creating working space folder for our instance: '%s'", working_folder)
+                __internal__.create_folder_default_perms(working_folder)
+                self.workspace.begin(working_folder)
+            working_subfolder = working_folder[len(self.args.working_space):]
+            if not __internal__.load_run_info(working_folder):
+                __internal__.save_run_info(working_folder, run_info)
+        else:
+            raise RuntimeError("No working space folder was specified. Try setting the WORKING_SPACE environment variable "
+                               "(if using Docker set to a folder to mount)")
+
+        # Process the steps
+        try:
+            with ClowderClient(host, secret_key, connector, self.args.clowder_pool_size, self.args.clowder_timeout) as clowder:
+                if self.args.single_dag:
+                    self.run_workflow_dag(working_folder, working_subfolder, clowder, resource)
+                else:
+                    self.run_workflow_steps(working_folder, working_subfolder, clowder, resource)
+            run_info = __internal__.load_run_info(working_folder)
+            run_info['status'] = RUN_STATUS_FINISHED
+            __internal__.save_run_info(working_folder, run_info)
+        finally:
+            self.workspace.finish(working_folder)
+
+    def claim_resume_folder(self, run_info: dict) -> Optional[str]:
+        """Finds the working folder for resuming an interrupted run of a message and marks it as being in use
+        Arguments:
+            run_info: the run information of the message, with the 'dataset_id' and 'file_ids' used to name the folder
+        Return:
+            Returns the path of the working folder, or None if another run is using it
+        Notes:
+            The folder of an interrupted run is kept as-is so that makeflow recovers from its transaction logs. The folder
+            of a finished run is emptied and the message is run again. The folder's marker is locked exclusively for the
+            whole claim (see WorkspaceManager.claim()) so that instances sharing the working space can't both use it
+        """
+        working_folder = os.path.join(self.args.working_space,
+                                      __internal__.resume_folder_name(run_info['dataset_id'], run_info['file_ids']))
+        if not self.workspace.claim(working_folder):
+            logging.warning("Not resuming run in working folder '%s' since it's in use", working_folder)
+            return None
+        previous_info = __internal__.load_run_info(working_folder)
+        if previous_info.get('status') == RUN_STATUS_RUNNING:
+            logging.info("Resuming interrupted run in working folder '%s', already published steps: %s", working_folder,
+                         str(previous_info.get('published_steps', [])))
+        else:
+            logging.info("Clearing working folder '%s' for resumable run", working_folder)
+            with os.scandir(working_folder) as entries:
+                for one_entry in entries:
+                    if one_entry.name == WORKSPACE_RUN_MARKER_FILE_NAME:
+                        continue
+                    if one_entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(one_entry.path)
+                    else:
+                        os.unlink(one_entry.path)
+        return working_folder
+
 
 if __name__ == "__main__":
     EXTRACTOR = DroneMakeflow()
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+"""Script for merging the images produced by transformer runs on the tiles of an image
+"""
+
+import argparse
+import json
+import logging
+import os
+
+from osgeo import gdal
+
+# The image file extensions looked for in the results of a tile
+TILE_IMAGE_EXTENSIONS = ('.tif', '.tiff')
+
+# Creation options of the merged image
+MERGED_CREATION_OPTIONS = ['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+
+
+def _map_container_path(file_path: str, mount_point: str) -> str:
+    """Maps a path in a container to a path relative to the folder mounted in the container
+    Arguments:
+        file_path: the path to map
+        mount_point: the folder the working space is mounted on in the container
+    Return:
+        Returns the mapped path; paths outside of the mount point are returned unchanged
+    """
+    if file_path.startswith(mount_point):
+        return file_path[len(mount_point):]
+    return file_path
+
+
+def _find_tile_image(results_file: str) -> dict:
+    """Finds the image in the results of a transformer run on a tile
+    Arguments:
+        results_file: the path to the results of the tile
+    Return:
+        Returns the file entry of the image
+    Exceptions:
+        Raises RuntimeError if there isn't exactly one image in the results
+    """
+    with open(results_file, 'r') as in_file:
+        results = json.load(in_file)
+
+    found_files = []
+    for key in ['file', 'files']:
+        if key in results:
+            found_files = results[key]
+            break
+    images = [one_file for one_file in found_files
+              if 'path' in one_file and os.path.splitext(one_file['path'])[1].lower() in TILE_IMAGE_EXTENSIONS]
+    if len(images) != 1:
+        raise RuntimeError("Expected one image in tile results '%s', found %s" % (results_file, str(len(images))))
+    return images[0]
+
+
+def merge_tiles(tiles: list, merged_path: str, results_path: str, mount_point: str) -> None:
+    """Merges the images of tiles into one image and writes the results for the merged image
+    Arguments:
+        tiles: list of tuples of the results file of a tile and the tile's [x offset, y offset, width, height] window
+               that doesn't overlap other tiles, relative to the tile
+        merged_path: the path of the merged image
+        results_path: the path of the results file to write
+        mount_point: the folder the working space is mounted on in the container
+    Notes:
+        The results written are those of the first tile with the image path replaced by the merged image
+    """
+    first_entry = None
+    core_images = []
+    for idx, (results_file, window) in enumerate(tiles):
+        tile_entry = _find_tile_image(results_file)
+        if first_entry is None:
+            first_entry = tile_entry
+        tile_path = _map_container_path(tile_entry['path'], mount_point)
+        logging.debug("Using window %s of tile image '%s'", str(window), tile_path)
+        core_path = '/vsimem/merge_tiles_%s.vrt' % str(idx)
+        gdal.Translate(core_path, tile_path, format='VRT', srcWin=window)
+        core_images.append(core_path)
+
+    logging.info("Merging %s tile images into '%s'", str(len(core_images)), merged_path)
+    mosaic = gdal.BuildVRT('/vsimem/merge_tiles_mosaic.vrt', core_images)
+    if mosaic is None:
+        raise RuntimeError("Unable to combine the images of %s tiles" % str(len(core_images)))
+    merged = gdal.Translate(merged_path, mosaic, format='GTiff', creationOptions=MERGED_CREATION_OPTIONS)
+    if merged is None:
+        raise RuntimeError("Unable to write merged image '%s'" % merged_path)
+    merged = None
+    mosaic = None
+
+    merged_entry = dict(first_entry)
+    merged_entry['path'] = os.path.join(mount_point, merged_path)
+    with open(results_path, 'w') as out_file:
+        json.dump({'code': 0, 'file': [merged_entry]}, out_file, indent=2)
+
+
+def _parse_tile(tile_param: str) -> tuple:
+    """Parses a tile command line parameter
+    Arguments:
+        tile_param: the parameter in the form of <results file>:<x offset>,<y offset>,<width>,<height>
+    Return:
+        Returns a tuple of the results file and the window as a list of integers
+    """
+    results_file, window = tile_param.rsplit(':', 1)
+    return results_file, [int(value) for value in window.split(',')]
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Adds arguments to command line parser
+    Parameters:
+        parser: parser instance to add arguments to
+    """
+    parser.add_argument('--mount_point', default='/mnt/',
+                        help='the folder the working space is mounted on in the containers (default=/mnt/)')
+    parser.add_argument('--tile', action='append', type=_parse_tile, required=True,
+                        help='the results of a tile and its window: <results file>:<x offset>,<y offset>,<width>,<height>')
+    parser.add_argument('merged_image', metavar='<image>', type=str,
+                        help='the path of the merged image')
+    parser.add_argument('results_file', metavar='<results>', type=str,
+                        help='the path of the results file to write')
+
+
+if __name__ == "__main__":
+    # Setup command line parameters and parse them
+    PARSER = argparse.ArgumentParser(description="Merges the images of transformer runs on tiles of an image")
+    add_arguments(PARSER)
+    ARGS = PARSER.parse_args()
+
+    logging.getLogger().setLevel(logging.DEBUG)
+
+    merge_tiles(ARGS.tile, ARGS.merged_image, ARGS.results_file, ARGS.mount_point)
@@ -42,6 +42,12 @@ if 'workflow' in y:
         step['next_step'] = int(step['execution_order']) + 1
         step['step_folder'] = os.path.splitext(os.path.basename(step['makeflow_file']))[0] + '/'
         step['sources_folder'] = step_source_files[int(step['execution_order'])]
+        step['container_batch_size'] = max(int(step.get('container_batch_size', 1)), 1)
+        step.setdefault('container_entrypoint', '')
+        step.setdefault('cores', os.cpu_count() or 1)
+        step.setdefault('memory_mb', os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024))
+        step.setdefault('rule_cores', 1)
+        step.setdefault('rule_memory_mb', 1024)
 with open('${CONFIGURATION_JSON_FILE}','w') as o:
     json.dump(y, o, indent=2)
 if 'workflow' in y:
@@ -0,0 +1,37 @@
+#!/bin/bash
+
+# Starts Work Queue workers on this machine for testing the extractor's "wq" batch type
+# Usage: run_wq_workers.sh [number of workers] [project name | host:port]
+
+NUM_WORKERS=2
+WQ_MASTER="${WQ_PROJECT:-drone_makeflow}"
+CCTOOLS_BIN="${CCTOOLS_BIN:-$(dirname "$(realpath "${0}")")/cctools/bin}"
+
+if [ -n "${1}" ]; then
+  NUM_WORKERS="${1}"
+fi;
+if [ -n "${2}" ]; then
+  WQ_MASTER="${2}"
+fi;
+
+WORKER_ARGS=(--cores 1)
+if [[ "${WQ_MASTER}" == *:* ]]; then
+  echo "Connecting ${NUM_WORKERS} workers to: ${WQ_MASTER}"
+  WORKER_ARGS+=("${WQ_MASTER%:*}" "${WQ_MASTER##*:}")
+else
+  echo "Connecting ${NUM_WORKERS} workers to project: ${WQ_MASTER}"
+  WORKER_ARGS+=(-M "${WQ_MASTER}")
+fi;
+if [ -n "${WQ_PASSWORD_FILE}" ]; then
+  WORKER_ARGS+=(--password "${WQ_PASSWORD_FILE}")
+fi;
+
+WORKER_PIDS=()
+trap 'echo Stopping workers; kill "${WORKER_PIDS[@]}" 2>/dev/null' EXIT
+
+for idx in $(seq 1 "${NUM_WORKERS}"); do
+  "${CCTOOLS_BIN}/work_queue_worker" "${WORKER_ARGS[@]}" &
+  WORKER_PIDS+=($!)
+done;
+
+wait
@@ -0,0 +1,6 @@
+"""Test configuration: makes the scripts in the repository folder importable"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
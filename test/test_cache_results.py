@@ -0,0 +1,68 @@
+"""Tests for cache_results.py"""
+
+import json
+import os
+
+import cache_results
+
+
+def _write_file(file_path: str, contents: bytes) -> str:
+    """Writes a file, creating its folder
+    Arguments:
+        file_path: the path of the file
+        contents: the contents to write
+    Return:
+        Returns the path of the file
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as out_file:
+        out_file.write(contents)
+    return file_path
+
+
+def _read_file(file_path: str) -> bytes:
+    """Returns the contents of a file"""
+    with open(file_path, 'rb') as in_file:
+        return in_file.read()
+
+
+def test_csv_merge_without_header_lines(tmp_path):
+    """Tests that every file is appended when there are no header lines"""
+    cache_dir = str(tmp_path / 'cache')
+    os.makedirs(cache_dir)
+    for plot_name in ('p1', 'p2', 'p3'):
+        source = _write_file(str(tmp_path / plot_name / 'm.csv'), plot_name.encode('utf-8') + b',1\n')
+        cache_results._handle_csv_merge(source, cache_dir)
+
+    assert _read_file(os.path.join(cache_dir, 'm.csv')) == b'p1,1\np2,1\np3,1\n'
+
+
+def test_csv_merge_header_at_block_boundary(tmp_path, monkeypatch):
+    """Tests that the rows after a header that ends at the end of a read block are appended"""
+    monkeypatch.setattr(cache_results, 'CSV_MERGE_BLOCK_SIZE', 8)
+    cache_dir = str(tmp_path / 'cache')
+    os.makedirs(cache_dir)
+    header = b'plot,va\n'
+    assert len(header) == cache_results.CSV_MERGE_BLOCK_SIZE
+    first = _write_file(str(tmp_path / 'p1' / 'm.csv'), header + b'p1,1\n')
+    second = _write_file(str(tmp_path / 'p2' / 'm.csv'), header + b'p2,22222222\np2,3')
+
+    cache_results._handle_csv_merge(first, cache_dir, header_lines=1)
+    cache_results._handle_csv_merge(second, cache_dir, header_lines=1)
+
+    assert _read_file(os.path.join(cache_dir, 'm.csv')) == header + b'p1,1\np2,22222222\np2,3\n'
+
+
+def test_metadata_records_are_one_json_document(tmp_path):
+    """Tests that a metadata file stays a valid JSON document as records are appended to it"""
+    metadata_file = str(tmp_path / 'plot.json')
+    cache_results._save_result_metadata(metadata_file, {'data': {'plot': 1}})
+    assert json.loads(_read_file(metadata_file)) == {'plot': 1}
+
+    for index in range(2, 5):
+        cache_results._append_metadata_to_file({'data': {'plot': index}}, metadata_file)
+        assert json.loads(_read_file(metadata_file)) == [{'plot': one_index} for one_index in range(1, index + 1)]
+    assert cache_results.read_metadata_file(metadata_file) == [{'plot': 1}, {'plot': 2}, {'plot': 3}, {'plot': 4}]
+
+    cache_results._save_result_metadata(metadata_file, {'data': [1, 2]})
+    assert cache_results.read_metadata_file(metadata_file) == [[1, 2]]
@@ -0,0 +1,90 @@
+"""Tests for drone_makeflow.py"""
+
+import http.server
+import threading
+import time
+
+import pytest
+import requests
+
+pytest.importorskip('pyclowder')
+pytest.importorskip('terrautils')
+import drone_makeflow  # pylint: disable=wrong-import-position
+
+
+class _FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """Answers requests with an error status until the server's failure count is used up"""
+
+    def _respond(self) -> None:
+        """Records the request and sends the response"""
+        self.server.requests.append((self.command, time.monotonic()))
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            status = 503
+        else:
+            status = 200
+        body = b'[]'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keeps the test output quiet"""
+
+
+@pytest.fixture(name='flaky_server')
+def fixture_flaky_server():
+    """Runs a stub Clowder server on a local port"""
+    server = http.server.HTTPServer(('127.0.0.1', 0), _FlakyHandler)
+    server.requests = []
+    server.failures = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(server) -> drone_makeflow.ClowderClient:
+    """Returns a client for the stub server"""
+    return drone_makeflow.ClowderClient('http://127.0.0.1:%d' % server.server_address[1], 'key', timeout_sec=5)
+
+
+def test_get_is_retried_with_backoff(flaky_server, monkeypatch):
+    """Tests that a failing GET is retried with an increasing wait until it succeeds"""
+    monkeypatch.setattr(drone_makeflow, 'CLOWDER_BACKOFF_SEC', 0.1)
+    flaky_server.failures = 3
+    with _client(flaky_server) as clowder:
+        assert clowder.request('GET', 'datasets').json() == []
+
+    assert len(flaky_server.requests) == 4
+    waits = [later[1] - earlier[1] for earlier, later in zip(flaky_server.requests, flaky_server.requests[1:])]
+    assert waits[1] >= 0.15
+    assert waits[2] >= 0.35
+    assert waits[2] > waits[1]
+
+
+def test_get_gives_up_after_retries(flaky_server, monkeypatch):
+    """Tests that the error is returned once the retries are used up"""
+    monkeypatch.setattr(drone_makeflow, 'CLOWDER_BACKOFF_SEC', 0)
+    flaky_server.failures = drone_makeflow.CLOWDER_RETRIES + 10
+    with _client(flaky_server) as clowder:
+        with pytest.raises(requests.HTTPError):
+            clowder.request('GET', 'datasets')
+
+    assert len(flaky_server.requests) == drone_makeflow.CLOWDER_RETRIES + 1
+
+
+def test_post_is_not_retried(flaky_server):
+    """Tests that requests that aren't idempotent are sent once"""
+    flaky_server.failures = 1
+    with _client(flaky_server) as clowder:
+        with pytest.raises(requests.HTTPError):
+            clowder.request('POST', 'datasets/createempty', json={'name': 'test'})
+
+    assert [one_request[0] for one_request in flaky_server.requests] == ['POST']